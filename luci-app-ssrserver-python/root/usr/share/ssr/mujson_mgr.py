@@ -2,7 +2,7 @@
 # -*- coding: UTF-8 -*-
 
 import traceback
-from shadowsocks import shell, common
+from shadowsocks import shell, common, encrypt
 from configloader import load_config, get_config
 import random
 import getopt
@@ -225,6 +225,7 @@ Options:
   -p PORT              server port (only this option must be set if add a user)
   -k PASSWORD          password
   -m METHOD            encryption method, default: aes-128-ctr
+                       auto: the fastest AEAD method on this machine
   -O PROTOCOL          protocol plugin, default: auth_aes128_md5
   -o OBFS              obfs plugin, default: tls1.2_ticket_auth_compatible
   -G PROTOCOL_PARAM    protocol plugin param
@@ -329,6 +330,10 @@ def main():
 		print(e)
 		sys.exit(2)
 
+	if user.get('method') == 'auto':
+		user['method'] = encrypt.auto_method()
+		print("method auto: %s" % user['method'])
+
 	manage = MuMgr()
 	if action == 0:
 		manage.clear_ud(user)
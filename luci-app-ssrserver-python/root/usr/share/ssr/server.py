@@ -43,6 +43,9 @@ class MainThread(threading.Thread):
 
 def main():
 	shell.check_python()
+	# fork the workers while this is the only thread
+	worker_socks, transfer_table = server_pool.ServerPool.fork_workers()
+	server_pool.ServerPool.instance = server_pool.ServerPool(worker_socks, transfer_table)
 	if False:
 		db_transfer.DbTransfer.thread_db()
 	else:
@@ -25,7 +25,7 @@ import os
 import logging
 import struct
 import time
-from shadowsocks import shell, eventloop, tcprelay, udprelay, asyncdns, common
+from shadowsocks import shell, eventloop, tcprelay, udprelay, asyncdns, common, workers, encrypt
 import threading
 import sys
 import traceback
@@ -44,10 +44,10 @@ class ServerPool(object):
 
 	instance = None
 
-	def __init__(self):
+	def __init__(self, worker_socks=(), transfer_table=None, master_sock=None):
 		shell.check_python()
 		self.config = shell.get_config(False)
-		self.dns_resolver = asyncdns.DNSResolver()
+		self.dns_resolver = asyncdns.DNSResolver(min_ttl=self.config['dns_min_ttl'], max_ttl=self.config['dns_max_ttl'], negative_ttl=self.config['dns_negative_ttl'])
 		if not self.config.get('dns_ipv6', False):
 			asyncdns.IPV6_CONNECTION_SUPPORT = False
 
@@ -59,7 +59,25 @@ class ServerPool(object):
 		self.udp_ipv6_servers_pool = {}
 		self.stat_counter = {}
 
-		self.loop = eventloop.EventLoop()
+		# with workers > 1 this process is one of them, the others are forked
+		# by fork_workers and run the same servers on SO_REUSEPORT sockets,
+		# everyone counts the transfer into a table in shared memory
+		self.worker_channels = []
+		self.transfer_table = transfer_table
+		if transfer_table is not None:
+			self.config['reuse_port'] = True
+
+		self.loop = eventloop.EventLoop(self.config['edge_triggered'], self.config['max_events'])
+		for sock in worker_socks:
+			channel = workers.Channel(sock, None, self._worker_closed)
+			channel.add_to_loop(self.loop)
+			self.worker_channels.append(channel)
+		if master_sock is not None:
+			# a worker, the loop runs in the process' own thread
+			channel = workers.Channel(master_sock, self._on_command, lambda c: self.loop.stop())
+			channel.add_to_loop(self.loop)
+			self.thread = None
+			return
 		self.thread = MainThread( (self.loop, self.dns_resolver, self.mgr) )
 		self.thread.start()
 
@@ -72,6 +90,44 @@ class ServerPool(object):
 	def stop(self):
 		self.loop.stop()
 
+	@staticmethod
+	def fork_workers():
+		# call from the main thread before any other thread is started, a
+		# child forked from another thread may inherit locks nobody releases.
+		# returns the sockets to the workers and the transfer table
+		config = shell.get_config(False)
+		count = int(config['workers'])
+		if count <= 1 or os.name != 'posix':
+			return [], None
+		transfer_table = workers.TransferTable(count, int(config['transfer_slots']))
+		worker_list = workers.fork_workers(count - 1,
+			lambda index, sock: ServerPool._worker(index, sock, transfer_table))
+		return [sock for pid, sock in worker_list], transfer_table
+
+	@staticmethod
+	def _worker(index, sock, transfer_table):
+		# runs in the forked worker, the loop is ours in this process
+		transfer_table.attach(index + 1)
+		pool = ServerPool(transfer_table=transfer_table, master_sock=sock)
+		ServerPool.instance = pool
+		logging.info('worker %d started' % (index + 1,))
+		ServerPool._loop(pool.loop, pool.dns_resolver, None)
+
+	def _on_command(self, msg):
+		if msg[0] in ('new_server', 'cb_del_server', 'update_mu_users'):
+			getattr(self, msg[0])(*msg[1:])
+
+	def _worker_closed(self, channel):
+		logging.error('a worker exited')
+		self.worker_channels.remove(channel)
+
+	def _broadcast(self, *msg):
+		for channel in self.worker_channels[:]:
+			try:
+				channel.send(msg)
+			except (OSError, IOError) as e:
+				logging.warn(e)
+
 	@staticmethod
 	def _loop(loop, dns_resolver, mgr):
 		try:
@@ -109,6 +165,14 @@ class ServerPool(object):
 		ret = True
 		port = int(port)
 		ipv6_ok = False
+		if common.to_str(user_config.get('method', self.config['method'])) == 'table':
+			# derive the table here in the db thread, the loop thread and the
+			# workers then find it in the cache instead of stalling on it
+			try:
+				encrypt.try_cipher(user_config.get('password', self.config['password']), 'table')
+			except Exception as e:
+				logging.warn(e)
+		self._broadcast('new_server', port, user_config)
 
 		if 'server_ipv6' in self.config:
 			if port in self.tcp_ipv6_servers_pool:
@@ -126,11 +190,11 @@ class ServerPool(object):
 				try:
 					logging.info("starting server at [%s]:%d" % (common.to_str(a_config['server']), port))
 
-					tcp_server = tcprelay.TCPRelay(a_config, self.dns_resolver, False, stat_counter=self.stat_counter)
+					tcp_server = tcprelay.TCPRelay(a_config, self.dns_resolver, False, stat_counter=self.stat_counter, transfer_table=self.transfer_table)
 					tcp_server.add_to_loop(self.loop)
 					self.tcp_ipv6_servers_pool.update({port: tcp_server})
 
-					udp_server = udprelay.UDPRelay(a_config, self.dns_resolver, False, stat_counter=self.stat_counter)
+					udp_server = udprelay.UDPRelay(a_config, self.dns_resolver, False, stat_counter=self.stat_counter, transfer_table=self.transfer_table)
 					udp_server.add_to_loop(self.loop)
 					self.udp_ipv6_servers_pool.update({port: udp_server})
 
@@ -152,11 +216,11 @@ class ServerPool(object):
 				try:
 					logging.info("starting server at %s:%d" % (common.to_str(a_config['server']), port))
 
-					tcp_server = tcprelay.TCPRelay(a_config, self.dns_resolver, False)
+					tcp_server = tcprelay.TCPRelay(a_config, self.dns_resolver, False, transfer_table=self.transfer_table)
 					tcp_server.add_to_loop(self.loop)
 					self.tcp_servers_pool.update({port: tcp_server})
 
-					udp_server = udprelay.UDPRelay(a_config, self.dns_resolver, False)
+					udp_server = udprelay.UDPRelay(a_config, self.dns_resolver, False, transfer_table=self.transfer_table)
 					udp_server.add_to_loop(self.loop)
 					self.udp_servers_pool.update({port: udp_server})
 
@@ -179,6 +243,12 @@ class ServerPool(object):
 
 	def cb_del_server(self, port):
 		port = int(port)
+		self._broadcast('cb_del_server', port)
+		users = set()
+		if port in self.tcp_servers_pool:
+			users.update(self.tcp_servers_pool[port].server_users.keys())
+		if port in self.tcp_ipv6_servers_pool:
+			users.update(self.tcp_ipv6_servers_pool[port].server_users.keys())
 
 		if port not in self.tcp_servers_pool:
 			logging.info("stopped server at %s:%d already stop" % (self.config['server'], port))
@@ -211,10 +281,31 @@ class ServerPool(object):
 				except Exception as e:
 					logging.warn(e)
 
+		self._free_transfer([port] + [struct.unpack('<I', uid)[0] for uid in users])
 		return True
 
+	def _free_transfer(self, keys):
+		# stopped ports and removed users give their slots in the table back,
+		# unless another running port still counts to the same id
+		if self.transfer_table is None:
+			return
+		servers = list(self.tcp_servers_pool.values()) + list(self.tcp_ipv6_servers_pool.values())
+		for key in keys:
+			if self.server_is_run(key) > 0:
+				continue
+			uid = struct.pack('<I', key)
+			if any(uid in server.server_users for server in servers):
+				continue
+			self.transfer_table.remove(key)
+
 	def update_mu_users(self, port, users):
 		port = int(port)
+		self._broadcast('update_mu_users', port, users)
+		removed = set()
+		for pool in (self.tcp_servers_pool, self.tcp_ipv6_servers_pool):
+			if port in pool:
+				removed.update(struct.unpack('<I', uid)[0] for uid in pool[port].server_users)
+		removed.difference_update(users)
 		if port in self.tcp_servers_pool:
 			try:
 				self.tcp_servers_pool[port].update_users(users)
@@ -233,6 +324,7 @@ class ServerPool(object):
 				self.udp_ipv6_servers_pool[port].update_users(users)
 			except Exception as e:
 				logging.warn(e)
+		self._free_transfer(removed)
 
 	def get_server_transfer(self, port):
 		port = int(port)
@@ -270,6 +362,8 @@ class ServerPool(object):
 			user_dict[port][1] += d[uid]
 
 	def get_servers_transfer(self):
+		if self.transfer_table is not None:
+			return self.transfer_table.snapshot()
 		servers = self.tcp_servers_pool.copy()
 		servers.update(self.tcp_ipv6_servers_pool)
 		servers.update(self.udp_servers_pool)
@@ -22,6 +22,8 @@ import os
 import socket
 import struct
 import re
+import errno
+import random
 import logging
 
 if __name__ == '__main__':
@@ -35,6 +37,35 @@ from shadowsocks import common, lru_cache, eventloop, shell
 
 CACHE_SWEEP_INTERVAL = 30
 
+# answers are cached for their TTL clamped to [min, max], NXDOMAIN for the
+# SOA minimum (rfc2308) capped at the negative TTL
+DNS_MIN_TTL = 10
+DNS_MAX_TTL = 3600
+DNS_NEGATIVE_TTL = 60
+
+# a query goes to the best DNS_SERVERS_PER_QUERY servers and is sent again
+# when no answer came in DNS_TIMEOUT seconds, doubled on every try
+DNS_SERVERS_PER_QUERY = 2
+DNS_TIMEOUT = 1.0
+DNS_TRIES = 3
+# a server that timed out ranks lower until it answers again, or until it
+# has had no timeout for this long
+DNS_PENALTY_TIME = 60
+
+# EDNS0 UDP payload size, small enough not to fragment (dnsflagday 2020); a
+# reply that doesn't fit comes back truncated and is asked again over TCP
+DNS_EDNS_PAYLOAD = 1232
+DNS_BUF_SIZE = 65536
+DNS_TCP_TIMEOUT = 5
+
+# queries go out from a pool of UDP sockets on random source ports, a socket
+# is swapped for a new one after DNS_SOCKET_QUERIES queries. A reply must
+# match the id, name and type of a query sent from the socket it comes in
+# on, to the server it comes from, within DNS_QUERY_LIFETIME seconds
+DNS_SOCKETS = 4
+DNS_SOCKET_QUERIES = 256
+DNS_QUERY_LIFETIME = DNS_TIMEOUT * 2 ** DNS_TRIES
+
 VALID_HOSTNAME = re.compile(br"(?!-)[A-Z\d_-]{1,63}(?<!-)$", re.IGNORECASE)
 
 common.patch_socket()
@@ -75,25 +106,37 @@ QTYPE_A = 1
 QTYPE_AAAA = 28
 QTYPE_CNAME = 5
 QTYPE_NS = 2
+QTYPE_SOA = 6
+QTYPE_OPT = 41
 QCLASS_IN = 1
 
+RCODE_FORMERR = 1
+RCODE_NXDOMAIN = 3
+
 
 def detect_ipv6_supprot():
     if 'has_ipv6' in dir(socket):
         try:
             s = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
             s.connect(('::1', 0))
-            print('IPv6 support')
+            logging.info('IPv6 support')
             return True
         except:
             pass
-    print('IPv6 not support')
+    logging.info('IPv6 not support')
     return False
 
 
 IPV6_CONNECTION_SUPPORT = detect_ipv6_supprot()
 
 
+def _query_types():
+    # in order of preference, both are asked at the same time
+    if IPV6_CONNECTION_SUPPORT:
+        return (QTYPE_AAAA, QTYPE_A)
+    return (QTYPE_A,)
+
+
 def build_address(address):
     address = address.strip(b'.')
     labels = address.split(b'.')
@@ -108,12 +151,16 @@ def build_address(address):
     return b''.join(results)
 
 
-def build_request(address, qtype):
+def build_request(address, qtype, edns=True):
     request_id = os.urandom(2)
-    header = struct.pack('!BBHHHH', 1, 0, 1, 0, 0, 0)
+    header = struct.pack('!BBHHHH', 1, 0, 1, 0, 0, 1 if edns else 0)
     addr = build_address(address)
     qtype_qclass = struct.pack('!HH', qtype, QCLASS_IN)
-    return request_id + header + addr + qtype_qclass
+    if not edns:
+        return request_id + header + addr + qtype_qclass
+    # rfc6891 OPT pseudo record: root name, the payload size in the class
+    opt = b'\0' + struct.pack('!HHIH', QTYPE_OPT, DNS_EDNS_PAYLOAD, 0, 0)
+    return request_id + header + addr + qtype_qclass + opt
 
 
 def parse_ip(addrtype, data, length, offset):
@@ -227,19 +274,28 @@ def parse_response(data):
                 offset += l
                 if r:
                     ans.append(r)
+            nss = []
             for i in range(0, res_nscount):
                 l, r = parse_record(data, offset)
                 offset += l
+                if r:
+                    nss.append(r)
             for i in range(0, res_arcount):
                 l, r = parse_record(data, offset)
                 offset += l
             response = DNSResponse()
+            response.rcode = res_rcode
             if qds:
                 response.hostname = qds[0][0]
             for an in qds:
                 response.questions.append((an[1], an[2], an[3]))
             for an in ans:
-                response.answers.append((an[1], an[2], an[3]))
+                response.answers.append((an[1], an[2], an[3], an[4]))
+            for ns in nss:
+                if ns[2] == QTYPE_SOA and len(ns[1]) >= 4:
+                    # the last field of the SOA rdata is MINIMUM
+                    minimum = struct.unpack('!I', ns[1][-4:])[0]
+                    response.negative_ttl = min(ns[4], minimum)
             return response
     except Exception as e:
         shell.print_exception(e)
@@ -257,25 +313,77 @@ def is_valid_hostname(hostname):
 class DNSResponse(object):
     def __init__(self):
         self.hostname = None
+        self.rcode = 0
+        self.negative_ttl = None
         self.questions = []  # each: (addr, type, class)
-        self.answers = []  # each: (addr, type, class)
+        self.answers = []  # each: (addr, type, class, ttl)
 
     def __str__(self):
         return '%s: %s' % (self.hostname, str(self.answers))
 
 
-STATUS_IPV4 = 0
-STATUS_IPV6 = 1
+class DNSServerStats(object):
+    """Health of one upstream server, the lower the score the better."""
+
+    def __init__(self):
+        self.sent = 0
+        self.answered = 0
+        self.timeouts = 0
+        self.rtt = None  # smoothed, seconds
+        self.failures = 0  # timeouts since the last answer
+        self.last_failure = 0
+        self.edns = True  # cleared when the server rejects EDNS0
+
+    def score(self, now):
+        score = DNS_TIMEOUT if self.rtt is None else self.rtt
+        if self.failures and now - self.last_failure < DNS_PENALTY_TIME:
+            score *= 2 ** min(self.failures, 8)
+        return score
+
+    def on_answer(self, rtt):
+        self.answered += 1
+        self.failures = 0
+        if rtt is not None:
+            if self.rtt is None:
+                self.rtt = rtt
+            else:
+                # rfc6298 smoothing
+                self.rtt += (rtt - self.rtt) / 8
+
+    def on_timeout(self, now):
+        self.timeouts += 1
+        self.failures += 1
+        self.last_failure = now
+
+    def to_dict(self):
+        return {'sent': self.sent, 'answered': self.answered,
+                'timeouts': self.timeouts, 'failures': self.failures,
+                'edns': self.edns,
+                'rtt_ms': None if self.rtt is None
+                else round(self.rtt * 1000, 1)}
 
 
 class DNSResolver(object):
-    def __init__(self, black_hostname_list=None):
+    def __init__(self, black_hostname_list=None, min_ttl=DNS_MIN_TTL,
+                 max_ttl=DNS_MAX_TTL, negative_ttl=DNS_NEGATIVE_TTL):
         self._loop = None
         self._hosts = {}
+        # hostname -> {qtype: (tries, last sent, servers)} for the queries
+        # not answered yet
         self._hostname_status = {}
+        self._server_stats = {}
+        # sock -> [hostname, qtype, server, data to send, data received]
+        # of the queries asked again over TCP
+        self._tcp_queries = {}
         self._hostname_to_cb = {}
         self._cb_to_hostname = {}
-        self._cache = lru_cache.LRUCache(timeout=300)
+        self._min_ttl = min_ttl
+        self._max_ttl = max(min_ttl, max_ttl)
+        self._negative_ttl = negative_ttl
+        # (hostname, qtype) -> (ip, expire time), ip is None for NXDOMAIN.
+        # Expired entries are dropped on lookup, the LRU sweeps the idle ones
+        self._cache = lru_cache.LRUCache(timeout=self._max_ttl,
+                                         clock=eventloop.clock)
         # read black_hostname_list from config
         if type(black_hostname_list) != list:
             self._black_hostname_list = []
@@ -285,7 +393,12 @@ class DNSResolver(object):
                 black_hostname_list
             ))
         logging.info('black_hostname_list init as : ' + str(self._black_hostname_list))
-        self._sock = None
+        # the sockets queries are sent from, and every open UDP socket with
+        # the number of queries it sent, including the retired ones
+        self._socks = []
+        self._sock_uses = {}
+        # (id, name, qtype) -> [sock, servers not answered, expire time]
+        self._inflight = {}
         self._servers = None
         self._parse_resolv()
         self._parse_hosts()
@@ -359,13 +472,72 @@ class DNSResolver(object):
         if self._loop:
             raise Exception('already add to loop')
         self._loop = loop
-        # TODO when dns server is IPv6
-        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
-                                   socket.SOL_UDP)
-        self._sock.setblocking(False)
-        loop.add(self._sock, eventloop.POLL_IN, self)
+        self._socks = [self._new_socket() for i in range(DNS_SOCKETS)]
         loop.add_periodic(self.handle_periodic)
 
+    def _new_socket(self):
+        # TODO when dns server is IPv6
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
+                             socket.SOL_UDP)
+        # the kernel picks a random source port within ip_local_port_range
+        # and skips ip_local_reserved_ports, where the user ports may live
+        sock.bind(('0.0.0.0', 0))
+        sock.setblocking(False)
+        self._sock_uses[sock] = 0
+        self._loop.add(sock, eventloop.POLL_IN, self)
+        return sock
+
+    def _retire_socket(self, sock):
+        # a new source port, the old one still takes late replies for a while
+        if sock in self._socks:
+            self._socks[self._socks.index(sock)] = self._new_socket()
+        self._loop.call_later(DNS_QUERY_LIFETIME,
+                              lambda: self._close_udp(sock))
+
+    def _close_udp(self, sock):
+        if sock in self._sock_uses:
+            del self._sock_uses[sock]
+            self._loop.remove(sock)
+            sock.close()
+
+    def _send_query(self, sock, req, hostname, qtype, servers):
+        request_id = struct.unpack('!H', req[:2])[0]
+        self._inflight[(request_id, hostname.strip(b'.'), qtype)] = \
+            [sock, set(servers), eventloop.clock.now + DNS_QUERY_LIFETIME]
+        for server in servers:
+            sock.sendto(req, server)
+        self._sock_uses[sock] += 1
+        if self._sock_uses[sock] >= DNS_SOCKET_QUERIES:
+            self._retire_socket(sock)
+
+    def _match_reply(self, sock, data, server):
+        # (hostname, qtype) of the query the reply answers, or None
+        header = parse_header(data)
+        if not header:
+            return None
+        if not header[5] and header[4] == RCODE_FORMERR:
+            # a server that doesn't know EDNS0 may leave the question out,
+            # the id has to do on its own then
+            keys = [key for key, query in self._inflight.items()
+                    if key[0] == header[0] and query[0] is sock and
+                    server in query[1]]
+            if len(keys) != 1:
+                return None
+            key = keys[0]
+        else:
+            try:
+                question = parse_record(data, 12, True)[1]
+            except Exception:
+                return None
+            key = (header[0], question[0], question[2])
+        query = self._inflight.get(key)
+        if query is None or query[0] is not sock or server not in query[1]:
+            return None
+        query[1].discard(server)
+        if not query[1]:
+            del self._inflight[key]
+        return key[1:]
+
     def _call_callback(self, hostname, ip, error=None):
         callbacks = self._hostname_to_cb.get(hostname, [])
         for callback in callbacks:
@@ -381,66 +553,274 @@ class DNSResolver(object):
         if hostname in self._hostname_status:
             del self._hostname_status[hostname]
 
-    def _handle_data(self, data):
+    def _cache_answer(self, hostname, qtype, ip, ttl):
+        if ip is None:
+            if ttl is None:
+                ttl = self._negative_ttl
+            ttl = min(ttl, self._negative_ttl)
+        else:
+            ttl = min(max(ttl, self._min_ttl), self._max_ttl)
+        if ttl > 0:
+            self._cache[(hostname, qtype)] = (ip, eventloop.clock.now + ttl)
+
+    def _get_cache(self, hostname, qtype):
+        # (ip,) for a live entry, ip None for a cached NXDOMAIN
+        key = (hostname, qtype)
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        if entry[1] <= eventloop.clock.now:
+            del self._cache[key]
+            return None
+        return entry[:1]
+
+    def _lookup_cache(self, hostname):
+        # the first live answer in order of preference, (None,) if the name
+        # is cached as NXDOMAIN and there is nothing better
+        result = None
+        for qtype in _query_types():
+            cached = self._get_cache(hostname, qtype)
+            if cached is not None:
+                if cached[0] is not None:
+                    return cached
+                result = cached
+        return result
+
+    def get_cached(self, hostname, family):
+        """Cached address of the given family for hostname, or None.
+
+        resolve() hands out the first answer that comes back; a caller that
+        wants to try the other family too picks its answer up here.
+        """
+        if type(hostname) != bytes:
+            hostname = hostname.encode('utf8')
+        qtype = QTYPE_AAAA if family == socket.AF_INET6 else QTYPE_A
+        cached = self._get_cache(hostname, qtype)
+        if cached is None:
+            return None
+        return cached[0]
+
+    def _get_server_stats(self, server):
+        stats = self._server_stats.get(server)
+        if stats is None:
+            stats = self._server_stats[server] = DNSServerStats()
+        return stats
+
+    def get_server_stats(self):
+        return dict(('%s:%d' % server, self._get_server_stats(server).to_dict())
+                    for server in self._servers)
+
+    def _pick_servers(self):
+        now = eventloop.clock.now
+        servers = sorted(self._servers,
+                         key=lambda server:
+                         self._get_server_stats(server).score(now))
+        return servers[:DNS_SERVERS_PER_QUERY]
+
+    def _count_answer(self, response, server):
+        queries = self._hostname_status.get(response.hostname)
+        rtt = None
+        if queries and response.questions:
+            query = queries.get(response.questions[0][1])
+            # only a query sent once tells the round trip time (Karn)
+            if query and query[0] == 1 and server in query[2]:
+                rtt = eventloop.clock.now - query[1]
+        self._get_server_stats(server).on_answer(rtt)
+
+    def _on_query_timeout(self, hostname, qtype, tries):
+        queries = self._hostname_status.get(hostname)
+        if not queries or qtype not in queries or queries[qtype][0] != tries:
+            # answered, or sent again since
+            return
+        now = eventloop.clock.now
+        for server in queries[qtype][2]:
+            self._get_server_stats(server).on_timeout(now)
+        if tries < DNS_TRIES:
+            self._send_req(hostname, qtype)
+            return
+        logging.debug('query for %s with type %d timed out', hostname, qtype)
+        del queries[qtype]
+        if not queries:
+            self._call_callback(hostname, None,
+                                Exception('DNS query for %s timed out' %
+                                          common.to_str(hostname)))
+
+    def _query_tcp(self, data, server):
+        # the answer didn't fit in UDP (TC bit), ask the same server over TCP
+        try:
+            question = parse_record(data, 12, True)[1]
+        except Exception as e:
+            shell.print_exception(e)
+            return
+        hostname, qtype = question[0], question[2]
+        queries = self._hostname_status.get(hostname)
+        if not queries or qtype not in queries:
+            return
+        for query in self._tcp_queries.values():
+            if query[0] == hostname and query[1] == qtype:
+                return
+        self._get_server_stats(server).on_answer(None)
+        req = build_request(hostname, qtype, False)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        err = sock.connect_ex(server)
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            logging.debug('connect to dns server %s: %s', server,
+                          os.strerror(err))
+            sock.close()
+            return
+        logging.debug('resolving %s with type %d using server %s over TCP',
+                      hostname, qtype, server)
+        self._tcp_queries[sock] = [hostname, qtype, server,
+                                   struct.pack('!H', len(req)) + req, b'',
+                                   struct.unpack('!H', req[:2])[0]]
+        self._loop.add(sock, eventloop.POLL_OUT | eventloop.POLL_ERR, self)
+        # the TCP query replaces the UDP one, its own timeout voids theirs
+        tries = queries[qtype][0] + 1
+        queries[qtype] = (tries, eventloop.clock.now, (server,))
+        self._loop.call_later(DNS_TCP_TIMEOUT,
+                              lambda: self._on_tcp_timeout(sock, hostname,
+                                                           qtype, tries))
+
+    def _on_tcp_timeout(self, sock, hostname, qtype, tries):
+        self._close_tcp(sock)
+        self._on_query_timeout(hostname, qtype, tries)
+
+    def _close_tcp(self, sock):
+        if sock in self._tcp_queries:
+            del self._tcp_queries[sock]
+            self._loop.remove(sock)
+            sock.close()
+
+    def _match_tcp_reply(self, data, query):
+        # the id, name and type of the request sent on the connection
+        header = parse_header(data)
+        if not header or header[0] != query[5]:
+            return False
+        try:
+            question = parse_record(data, 12, True)[1]
+        except Exception:
+            return False
+        return question[0] == query[0] and question[2] == query[1]
+
+    def _handle_tcp_event(self, sock, event):
+        query = self._tcp_queries[sock]
+        try:
+            if event & eventloop.POLL_ERR:
+                raise eventloop.get_sock_error(sock)
+            if event & eventloop.POLL_OUT and query[3]:
+                query[3] = query[3][sock.send(query[3]):]
+                if not query[3]:
+                    self._loop.modify(sock,
+                                      eventloop.POLL_IN | eventloop.POLL_ERR)
+            if event & (eventloop.POLL_IN | eventloop.POLL_HUP):
+                data = sock.recv(DNS_BUF_SIZE)
+                if not data:
+                    self._close_tcp(sock)
+                    return
+                query[4] += data
+                if len(query[4]) >= 2:
+                    length = struct.unpack('!H', query[4][:2])[0]
+                    if len(query[4]) >= 2 + length:
+                        self._close_tcp(sock)
+                        data = query[4][2:2 + length]
+                        if self._match_tcp_reply(data, query):
+                            self._handle_data(data, query[2], query[:2])
+                        else:
+                            logging.debug('dropped a reply from %s over TCP '
+                                          'that matches no query', query[2])
+        except (OSError, IOError) as e:
+            if eventloop.errno_from_exception(e) in (errno.EAGAIN,
+                                                     errno.EWOULDBLOCK):
+                return
+            logging.debug('dns server %s over TCP: %s', query[2], e)
+            # the timeout of the query sends it again
+            self._close_tcp(sock)
+
+    def _handle_data(self, data, server=None, query=None):
+        # query is the (hostname, qtype) the reply was matched to
         response = parse_response(data)
+        if response and response.rcode == RCODE_FORMERR and \
+                server is not None:
+            stats = self._get_server_stats(server)
+            if stats.edns:
+                # a server that doesn't know EDNS0, ask it again without
+                stats.edns = False
+                hostname = response.hostname
+                qtypes = [question[1] for question in response.questions]
+                if not qtypes and query:
+                    hostname, qtypes = query[0], [query[1]]
+                for qtype in qtypes:
+                    if qtype in self._hostname_status.get(hostname, ()):
+                        self._send_query(random.choice(self._socks),
+                                         build_request(hostname, qtype,
+                                                       False),
+                                         hostname, qtype, [server])
+            return
         if response and response.hostname:
             hostname = response.hostname
-            ip = None
+            if server is not None:
+                self._count_answer(response, server)
+            if response.rcode == RCODE_NXDOMAIN:
+                # the name has no records of any type, don't ask again
+                if hostname in self._hostname_status:
+                    for qtype in (QTYPE_A, QTYPE_AAAA):
+                        self._cache_answer(hostname, qtype, None,
+                                           response.negative_ttl)
+                    self._call_callback(hostname, None)
+                return
             for answer in response.answers:
                 if answer[1] in (QTYPE_A, QTYPE_AAAA) and \
                                 answer[2] == QCLASS_IN:
-                    ip = answer[0]
-                    break
-            if IPV6_CONNECTION_SUPPORT:
-                if not ip and self._hostname_status.get(hostname, STATUS_IPV4) \
-                        == STATUS_IPV6:
-                    self._hostname_status[hostname] = STATUS_IPV4
-                    self._send_req(hostname, QTYPE_A)
-                else:
-                    if ip:
-                        self._cache[hostname] = ip
-                        self._call_callback(hostname, ip)
-                    elif self._hostname_status.get(hostname, None) == STATUS_IPV4:
-                        for question in response.questions:
-                            if question[1] == QTYPE_A:
-                                self._call_callback(hostname, None)
-                                break
-            else:
-                if not ip and self._hostname_status.get(hostname, STATUS_IPV6) \
-                        == STATUS_IPV4:
-                    self._hostname_status[hostname] = STATUS_IPV6
-                    self._send_req(hostname, QTYPE_AAAA)
-                else:
-                    if ip:
-                        self._cache[hostname] = ip
-                        self._call_callback(hostname, ip)
-                    elif self._hostname_status.get(hostname, None) == STATUS_IPV6:
-                        for question in response.questions:
-                            if question[1] == QTYPE_AAAA:
-                                self._call_callback(hostname, None)
-                                break
+                    # the A and AAAA queries run side by side, the first
+                    # answer goes to the callbacks and the late one is
+                    # only cached
+                    self._cache_answer(hostname, answer[1], answer[0],
+                                       answer[3])
+                    self._call_callback(hostname, answer[0])
+                    return
+            pending = self._hostname_status.get(hostname)
+            if pending:
+                for question in response.questions:
+                    pending.pop(question[1], None)
+                if not pending:
+                    # both types came back empty
+                    self._call_callback(hostname, None)
 
     def handle_event(self, sock, fd, event):
-        if sock != self._sock:
+        if sock in self._tcp_queries:
+            self._handle_tcp_event(sock, event)
+            return
+        if sock not in self._sock_uses:
             return
         if event & eventloop.POLL_ERR:
             logging.error('dns socket err')
-            self._loop.remove(self._sock)
-            self._sock.close()
-            # TODO when dns server is IPv6
-            self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
-                                       socket.SOL_UDP)
-            self._sock.setblocking(False)
-            self._loop.add(self._sock, eventloop.POLL_IN, self)
+            if sock in self._socks:
+                self._socks[self._socks.index(sock)] = self._new_socket()
+            self._close_udp(sock)
         else:
-            data, addr = sock.recvfrom(1024)
+            data, addr = sock.recvfrom(DNS_BUF_SIZE)
             if addr not in self._servers:
                 logging.warn('received a packet other than our dns')
                 return
-            self._handle_data(data)
+            query = self._match_reply(sock, data, addr)
+            if query is None:
+                logging.debug('dropped a reply from %s that matches no query',
+                              addr)
+                return
+            header = parse_header(data)
+            if header and header[2]:
+                self._query_tcp(data, addr)
+            else:
+                self._handle_data(data, addr, query)
 
     def handle_periodic(self):
         self._cache.sweep()
+        now = eventloop.clock.now
+        expired = [key for key, query in self._inflight.items()
+                   if query[2] <= now]
+        for key in expired:
+            del self._inflight[key]
 
     def remove_callback(self, callback):
         hostname = self._cb_to_hostname.get(callback)
@@ -455,15 +835,38 @@ class DNSResolver(object):
                         del self._hostname_status[hostname]
 
     def _send_req(self, hostname, qtype):
-        req = build_request(hostname, qtype)
-        for server in self._servers:
+        queries = self._hostname_status.get(hostname)
+        if not queries or qtype not in queries:
+            return
+        tries = queries[qtype][0] + 1
+        servers = self._pick_servers()
+        edns_servers = []
+        plain_servers = []
+        for server in servers:
             logging.debug('resolving %s with type %d using server %s',
                           hostname, qtype, server)
-            self._sock.sendto(req, server)
+            stats = self._get_server_stats(server)
+            stats.sent += 1
+            if stats.edns:
+                edns_servers.append(server)
+            else:
+                plain_servers.append(server)
+        sock = random.choice(self._socks)
+        if edns_servers:
+            self._send_query(sock, build_request(hostname, qtype), hostname,
+                             qtype, edns_servers)
+        if plain_servers:
+            self._send_query(sock, build_request(hostname, qtype, False),
+                             hostname, qtype, plain_servers)
+        queries[qtype] = (tries, eventloop.clock.now, servers)
+        self._loop.call_later(DNS_TIMEOUT * 2 ** (tries - 1),
+                              lambda: self._on_query_timeout(hostname, qtype,
+                                                             tries))
 
     def resolve(self, hostname, callback):
         if type(hostname) != bytes:
             hostname = hostname.encode('utf8')
+        cached = self._lookup_cache(hostname)
         if not hostname:
             callback(None, Exception('empty hostname'))
         elif common.is_ip(hostname):
@@ -472,10 +875,14 @@ class DNSResolver(object):
             logging.debug('hit hosts: %s', hostname)
             ip = self._hosts[hostname]
             callback((hostname, ip), None)
-        elif hostname in self._cache:
-            logging.debug('hit cache: %s ==>> %s', hostname, self._cache[hostname])
-            ip = self._cache[hostname]
-            callback((hostname, ip), None)
+        elif cached is not None:
+            ip = cached[0]
+            logging.debug('hit cache: %s ==>> %s', hostname, ip)
+            if ip is None:
+                callback((hostname, None),
+                         Exception('unable to parse hostname %s' % hostname))
+            else:
+                callback((hostname, ip), None)
         elif any(hostname.endswith(t) for t in self._black_hostname_list):
             callback(None, Exception('hostname <%s> is block by the black hostname list' % hostname))
             return
@@ -489,34 +896,31 @@ class DNSResolver(object):
                 if addrs:
                     af, socktype, proto, canonname, sa = addrs[0]
                     logging.debug('DNS resolve %s %s' % (hostname, sa[0]))
-                    self._cache[hostname] = sa[0]
+                    self._cache_answer(hostname, QTYPE_A, sa[0],
+                                       self._min_ttl)
                     callback((hostname, sa[0]), None)
                     return
             arr = self._hostname_to_cb.get(hostname, None)
             if not arr:
-                if IPV6_CONNECTION_SUPPORT:
-                    self._hostname_status[hostname] = STATUS_IPV6
-                    self._send_req(hostname, QTYPE_AAAA)
-                else:
-                    self._hostname_status[hostname] = STATUS_IPV4
-                    self._send_req(hostname, QTYPE_A)
+                qtypes = _query_types()
+                self._hostname_status[hostname] = \
+                    dict((qtype, (0, 0, ())) for qtype in qtypes)
+                for qtype in qtypes:
+                    self._send_req(hostname, qtype)
                 self._hostname_to_cb[hostname] = [callback]
                 self._cb_to_hostname[callback] = hostname
             else:
+                # already asked, sent again on its timeout if need be
                 arr.append(callback)
-                # TODO send again only if waited too long
-                if IPV6_CONNECTION_SUPPORT:
-                    self._send_req(hostname, QTYPE_AAAA)
-                else:
-                    self._send_req(hostname, QTYPE_A)
 
     def close(self):
-        if self._sock:
-            if self._loop:
-                self._loop.remove_periodic(self.handle_periodic)
-                self._loop.remove(self._sock)
-            self._sock.close()
-            self._sock = None
+        for sock in list(self._tcp_queries):
+            self._close_tcp(sock)
+        if self._socks:
+            self._loop.remove_periodic(self.handle_periodic)
+            for sock in list(self._sock_uses):
+                self._close_udp(sock)
+            self._socks = []
 
 
 def test():
@@ -588,5 +992,353 @@ def test():
     dns_resolver.close()
 
 
+def _test_response(hostname, rcode, ttl, ip=None, soa=None, qtype=QTYPE_A):
+    # a crafted reply, so the tests don't need a name server
+    answers = []
+    if ip:
+        family = socket.AF_INET6 if qtype == QTYPE_AAAA else socket.AF_INET
+        addr = socket.inet_pton(family, ip)
+        answers.append(b'\xc0\x0c' + struct.pack('!HHiH', qtype, QCLASS_IN,
+                                                  ttl, len(addr)) + addr)
+    if soa:
+        rdata = b'\0\0' + struct.pack('!IIIII', 1, 2, 3, 4, soa)
+        answers.append(b'\xc0\x0c' + struct.pack('!HHiH', QTYPE_SOA,
+                                                  QCLASS_IN, ttl,
+                                                  len(rdata)) + rdata)
+    header = struct.pack('!HBBHHHH', 1, 0x81, 0x80 | rcode, 1,
+                         1 if ip else 0, 1 if soa else 0, 0)
+    return header + build_address(hostname) + \
+        struct.pack('!HH', qtype, QCLASS_IN) + b''.join(answers)
+
+
+def test_ttl_cache():
+    response = _test_response
+    results = []
+    dns_resolver = DNSResolver(min_ttl=10, max_ttl=100, negative_ttl=60)
+    loop = eventloop.EventLoop()
+    dns_resolver.add_to_loop(loop)
+    dns_resolver._servers = [('127.0.0.1', 53)]
+    callback = lambda result, error: results.append((result, error))
+    now = eventloop.clock.update()
+    try:
+        for ttl, expected in ((30, 30), (1, 10), (100000, 100)):
+            dns_resolver.resolve(b'cdn.example.com', callback)
+            dns_resolver._handle_data(response(b'cdn.example.com', 0, ttl,
+                                               ip='10.0.0.1'))
+            assert results.pop() == ((b'cdn.example.com', '10.0.0.1'), None)
+            eventloop.clock.now = now + expected - 1
+            dns_resolver.resolve(b'cdn.example.com', callback)
+            assert results.pop()[0][1] == '10.0.0.1'
+            eventloop.clock.now = now + expected
+            dns_resolver.resolve(b'cdn.example.com', callback)
+            assert not results
+            dns_resolver.remove_callback(callback)
+            now = eventloop.clock.now
+
+        # NXDOMAIN is kept for min(SOA ttl, SOA minimum, negative_ttl)
+        dns_resolver.resolve(b'nx.example.com', callback)
+        dns_resolver._handle_data(response(b'nx.example.com', RCODE_NXDOMAIN,
+                                           900, soa=30))
+        assert results.pop()[1] is not None
+        eventloop.clock.now = now + 29
+        dns_resolver.resolve(b'nx.example.com', callback)
+        assert results.pop()[1] is not None
+        eventloop.clock.now = now + 30
+        dns_resolver.resolve(b'nx.example.com', callback)
+        assert not results
+    finally:
+        eventloop.clock.update()
+        dns_resolver.close()
+
+
+def test_parallel_queries():
+    global IPV6_CONNECTION_SUPPORT
+    ipv6_support = IPV6_CONNECTION_SUPPORT
+    IPV6_CONNECTION_SUPPORT = True
+    results = []
+    dns_resolver = DNSResolver()
+    loop = eventloop.EventLoop()
+    dns_resolver.add_to_loop(loop)
+    dns_resolver._servers = [('127.0.0.1', 53)]
+    callback = lambda result, error: results.append((result, error))
+    try:
+        # an IPv4 only name, the empty AAAA answer doesn't hold up the A one
+        dns_resolver.resolve(b'v4.example.com', callback)
+        assert set(dns_resolver._hostname_status[b'v4.example.com']) == \
+            set([QTYPE_A, QTYPE_AAAA])
+        dns_resolver._handle_data(_test_response(b'v4.example.com', 0, 60,
+                                                 qtype=QTYPE_AAAA))
+        assert not results
+        dns_resolver._handle_data(_test_response(b'v4.example.com', 0, 60,
+                                                 ip='10.0.0.1'))
+        assert results.pop() == ((b'v4.example.com', '10.0.0.1'), None)
+
+        # whichever answer comes first wins, the other one is kept for later
+        dns_resolver.resolve(b'dual.example.com', callback)
+        dns_resolver._handle_data(_test_response(b'dual.example.com', 0, 60,
+                                                 ip='10.0.0.2'))
+        assert results.pop() == ((b'dual.example.com', '10.0.0.2'), None)
+        assert dns_resolver.get_cached(b'dual.example.com',
+                                       socket.AF_INET6) is None
+        dns_resolver._handle_data(_test_response(b'dual.example.com', 0, 60,
+                                                 ip='2001:db8::2',
+                                                 qtype=QTYPE_AAAA))
+        assert not results
+        assert dns_resolver.get_cached(b'dual.example.com',
+                                       socket.AF_INET6) == '2001:db8::2'
+        assert dns_resolver.get_cached(b'dual.example.com',
+                                       socket.AF_INET) == '10.0.0.2'
+        # with both cached IPv6 is preferred
+        dns_resolver.resolve(b'dual.example.com', callback)
+        assert results.pop() == ((b'dual.example.com', '2001:db8::2'), None)
+
+        # no address of either type
+        dns_resolver.resolve(b'none.example.com', callback)
+        dns_resolver._handle_data(_test_response(b'none.example.com', 0, 60))
+        assert not results
+        dns_resolver._handle_data(_test_response(b'none.example.com', 0, 60,
+                                                 qtype=QTYPE_AAAA))
+        assert results.pop()[1] is not None
+        assert b'none.example.com' not in dns_resolver._hostname_status
+    finally:
+        IPV6_CONNECTION_SUPPORT = ipv6_support
+        dns_resolver.close()
+
+
+def test_retransmit():
+    class Sock(object):
+        def __init__(self):
+            self.sent = []
+
+        def sendto(self, data, addr):
+            self.sent.append(addr)
+
+    global IPV6_CONNECTION_SUPPORT
+    ipv6_support = IPV6_CONNECTION_SUPPORT
+    IPV6_CONNECTION_SUPPORT = False
+    results = []
+    dns_resolver = DNSResolver()
+    loop = eventloop.EventLoop()
+    dns_resolver.add_to_loop(loop)
+    servers = [('127.0.0.1', 53), ('127.0.0.2', 53), ('127.0.0.3', 53)]
+    dns_resolver._servers = servers
+    real_socks = dns_resolver._socks, dns_resolver._sock_uses
+    sock = Sock()
+    dns_resolver._socks = [sock]
+    dns_resolver._sock_uses = {sock: 0}
+    callback = lambda result, error: results.append((result, error))
+    try:
+        dns_resolver.resolve(b'lost.example.com', callback)
+        assert sock.sent == servers[:2]
+        # asking again waits for the timeout instead of sending again
+        dns_resolver.resolve(b'lost.example.com', lambda result, error: None)
+        assert len(sock.sent) == 2
+        # the servers that timed out rank last, the next try starts with the
+        # one that wasn't asked yet
+        dns_resolver._on_query_timeout(b'lost.example.com', QTYPE_A, 1)
+        assert sock.sent[2:] == [servers[2], servers[0]]
+        # an old timeout is ignored
+        dns_resolver._on_query_timeout(b'lost.example.com', QTYPE_A, 1)
+        assert len(sock.sent) == 4
+        dns_resolver._on_query_timeout(b'lost.example.com', QTYPE_A, 2)
+        assert not results
+        dns_resolver._on_query_timeout(b'lost.example.com', QTYPE_A, 3)
+        assert results.pop()[1] is not None
+        assert b'lost.example.com' not in dns_resolver._hostname_status
+        stats = dns_resolver.get_server_stats()
+        assert stats['127.0.0.3:53']['timeouts'] == 2
+
+        # an answer clears the failures and, for a query sent once, gives
+        # the round trip time
+        dns_resolver.resolve(b'cdn.example.com', callback)
+        server = sock.sent[-1]
+        eventloop.clock.now += 0.05
+        dns_resolver._handle_data(_test_response(b'cdn.example.com', 0, 60,
+                                                 ip='10.0.0.1'), server)
+        assert results.pop() == ((b'cdn.example.com', '10.0.0.1'), None)
+        stats = dns_resolver.get_server_stats()['%s:%d' % server]
+        assert stats['failures'] == 0 and stats['answered'] == 1
+        assert stats['rtt_ms'] == 50
+    finally:
+        IPV6_CONNECTION_SUPPORT = ipv6_support
+        eventloop.clock.update()
+        dns_resolver._socks, dns_resolver._sock_uses = real_socks
+        dns_resolver.close()
+
+
+def test_tcp_fallback():
+    import threading
+
+    req = build_request(b'big.example.com', QTYPE_A)
+    assert struct.unpack('!H', req[10:12])[0] == 1
+    assert req[-11:] == b'\0' + struct.pack('!HHIH', QTYPE_OPT,
+                                            DNS_EDNS_PAYLOAD, 0, 0)
+    assert parse_response(req).hostname == b'big.example.com'
+
+    # a name server that answers over TCP
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    server = listener.getsockname()
+
+    def serve():
+        # an answer for another pending name, one with a wrong id, then the
+        # right one
+        for hostname, flip in ((b'other.example.com', 0),
+                               (b'big.example.com', 1),
+                               (b'big.example.com', 0)):
+            conn = listener.accept()[0]
+            data = b''
+            while len(data) < 2 or len(data) < 2 + \
+                    struct.unpack('!H', data[:2])[0]:
+                data += conn.recv(4096)
+            assert parse_response(data[2:]).hostname == b'big.example.com'
+            request_id = struct.unpack('!H', data[2:4])[0] ^ flip
+            reply = struct.pack('!H', request_id) + \
+                _test_response(hostname, 0, 60, ip='10.0.0.3')[2:]
+            # in two pieces, the length has to be waited for
+            conn.sendall(struct.pack('!H', len(reply)) + reply[:5])
+            conn.sendall(reply[5:])
+            conn.close()
+
+    t = threading.Thread(target=serve)
+    t.start()
+    results = []
+    dns_resolver = DNSResolver()
+    loop = eventloop.EventLoop()
+    dns_resolver.add_to_loop(loop)
+    dns_resolver._servers = [server]
+
+    def callback(result, error):
+        results.append((result, error))
+        loop.stop()
+
+    dns_resolver.resolve(b'big.example.com', callback)
+    dns_resolver.resolve(b'other.example.com', callback)
+    truncated = bytearray(_test_response(b'big.example.com', 0, 60))
+    truncated[2] |= 2
+    for i in range(2):
+        dns_resolver._query_tcp(bytes(truncated), server)
+        assert len(dns_resolver._tcp_queries) == 1
+        while dns_resolver._tcp_queries:
+            loop._stopping = False
+            loop.call_later(0.01, loop.stop)
+            loop.run()
+        assert not results
+    dns_resolver._query_tcp(bytes(truncated), server)
+    loop._stopping = False
+    loop.call_later(DNS_TCP_TIMEOUT, loop.stop)
+    loop.run()
+    t.join()
+    listener.close()
+    assert results == [((b'big.example.com', '10.0.0.3'), None)]
+    assert not dns_resolver._tcp_queries
+    dns_resolver.close()
+
+
+def test_reply_matching():
+    import select
+
+    global IPV6_CONNECTION_SUPPORT
+    ipv6_support = IPV6_CONNECTION_SUPPORT
+    IPV6_CONNECTION_SUPPORT = False
+    name_server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    name_server.bind(('127.0.0.1', 0))
+    results = []
+    dns_resolver = DNSResolver()
+    loop = eventloop.EventLoop()
+    dns_resolver.add_to_loop(loop)
+    dns_resolver._servers = [name_server.getsockname()]
+    callback = lambda result, error: results.append((result, error))
+
+    def reply(request_id, hostname, source):
+        data = _test_response(hostname, 0, 60, ip='10.0.0.4')
+        name_server.sendto(struct.pack('!H', request_id) + data[2:], source)
+        sock = [s for s in dns_resolver._sock_uses
+                if s.getsockname()[1] == source[1]][0]
+        select.select([sock], [], [], 1)
+        dns_resolver.handle_event(sock, sock.fileno(), eventloop.POLL_IN)
+
+    try:
+        assert len(dns_resolver._socks) == DNS_SOCKETS
+        assert len(set(s.getsockname()[1] for s in dns_resolver._socks)) \
+            == DNS_SOCKETS
+        dns_resolver.resolve(b'www.example.com', callback)
+        req, source = name_server.recvfrom(DNS_BUF_SIZE)
+        request_id = struct.unpack('!H', req[:2])[0]
+        # a wrong id, or a reply for another name, doesn't resolve it
+        reply(request_id ^ 1, b'www.example.com', source)
+        reply(request_id, b'ads.example.com', source)
+        assert not results
+        reply(request_id, b'www.example.com', source)
+        assert results.pop() == ((b'www.example.com', '10.0.0.4'), None)
+        assert not dns_resolver._inflight
+
+        # a socket is replaced after DNS_SOCKET_QUERIES queries
+        sock = dns_resolver._socks[0]
+        dns_resolver._sock_uses[sock] = DNS_SOCKET_QUERIES - 1
+        dns_resolver._send_query(sock, build_request(b'a.example.com',
+                                                     QTYPE_A),
+                                 b'a.example.com', QTYPE_A, [])
+        assert sock not in dns_resolver._socks
+        assert sock in dns_resolver._sock_uses
+    finally:
+        IPV6_CONNECTION_SUPPORT = ipv6_support
+        dns_resolver.close()
+        name_server.close()
+    assert not dns_resolver._sock_uses
+
+
+def test_formerr_without_question():
+    import select
+
+    global IPV6_CONNECTION_SUPPORT
+    ipv6_support = IPV6_CONNECTION_SUPPORT
+    IPV6_CONNECTION_SUPPORT = False
+    name_server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    name_server.bind(('127.0.0.1', 0))
+    name_server.settimeout(1)
+    dns_resolver = DNSResolver()
+    loop = eventloop.EventLoop()
+    dns_resolver.add_to_loop(loop)
+    server = name_server.getsockname()
+    dns_resolver._servers = [server]
+
+    def formerr(request_id, source):
+        # FORMERR with QDCOUNT 0, as servers that don't know EDNS0 send it
+        name_server.sendto(struct.pack('!HBBHHHH', request_id, 0x81,
+                                       0x80 | RCODE_FORMERR, 0, 0, 0, 0),
+                           source)
+        sock = [s for s in dns_resolver._sock_uses
+                if s.getsockname()[1] == source[1]][0]
+        select.select([sock], [], [], 1)
+        dns_resolver.handle_event(sock, sock.fileno(), eventloop.POLL_IN)
+
+    try:
+        dns_resolver.resolve(b'old.example.com', lambda result, error: None)
+        req, source = name_server.recvfrom(DNS_BUF_SIZE)
+        assert struct.unpack('!H', req[10:12])[0] == 1
+        request_id = struct.unpack('!H', req[:2])[0]
+        # a wrong id still matches nothing
+        formerr(request_id ^ 1, source)
+        assert dns_resolver.get_server_stats()['%s:%d' % server]['edns']
+        formerr(request_id, source)
+        assert not dns_resolver.get_server_stats()['%s:%d' % server]['edns']
+        # asked again without the OPT record
+        req = name_server.recvfrom(DNS_BUF_SIZE)[0]
+        assert struct.unpack('!H', req[10:12])[0] == 0
+        assert parse_response(req).hostname == b'old.example.com'
+    finally:
+        IPV6_CONNECTION_SUPPORT = ipv6_support
+        dns_resolver.close()
+        name_server.close()
+
+
 if __name__ == '__main__':
+    test_ttl_cache()
+    test_parallel_queries()
+    test_retransmit()
+    test_tcp_fallback()
+    test_reply_matching()
+    test_formerr_without_question()
     test()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# Framing shared by the AEAD ciphers, the same as shadowsocks AEAD (SIP004).
+#
+# The salt takes the place of the iv, the key of a stream is
+# HKDF-SHA1(master key, salt, "ss-subkey"). A TCP stream is a series of
+#   [encrypted payload length][length tag][encrypted payload][payload tag]
+# with a 12 byte little endian nonce counted up after each seal or open.
+# A UDP packet is the salt and one sealed payload with a zero nonce.
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import hmac
+import struct
+import hashlib
+
+__all__ = ['AeadCryptoBase', 'hkdf_sha1']
+
+SUBKEY_INFO = b'ss-subkey'
+TAG_SIZE = 16
+NONCE_SIZE = 12
+# payload length of a chunk, the top two bits of the length must be zero
+CHUNK_SIZE_MASK = 0x3FFF
+CHUNK_HEADER = struct.Struct('>H')
+
+
+def hkdf_sha1(key, salt, info, length):
+    prk = hmac.new(salt, key, hashlib.sha1).digest()
+    okm = b''
+    t = b''
+    i = 1
+    while len(okm) < length:
+        t = hmac.new(prk, t + info + struct.pack('B', i),
+                     hashlib.sha1).digest()
+        okm += t
+        i += 1
+    return okm[:length]
+
+
+class AeadCryptoBase(object):
+    """Chunked stream and single packet framing around a seal/open pair.
+
+    Subclasses implement set_key(subkey), seal(nonce, data) returning the
+    ciphertext with its tag, and open(nonce, data) returning the plaintext
+    or None when the tag doesn't match.
+    """
+
+    nonce_size = NONCE_SIZE
+
+    def __init__(self, cipher_name, key, iv, op):
+        self._op = op
+        self._master_key = key
+        self._subkey = hkdf_sha1(key, iv, SUBKEY_INFO, len(key))
+        self._counter = 0
+        self._recv_buf = b''
+        self._chunk_len = None
+
+    def _nonce(self):
+        nonce = self._counter.to_bytes(self.nonce_size, 'little')
+        self._counter += 1
+        return nonce
+
+    def reset(self, iv, key=None):
+        # a new salt means a new subkey, the nonce starts over from zero
+        if key is not None:
+            self._master_key = key
+        self._subkey = hkdf_sha1(self._master_key, iv, SUBKEY_INFO,
+                                 len(self._master_key))
+        self.set_key(self._subkey)
+        self._counter = 0
+        self._recv_buf = b''
+        self._chunk_len = None
+
+    def update(self, data):
+        if self._op:
+            return self._encrypt_chunks(data)
+        return self._decrypt_chunks(data)
+
+    def update_once(self, data):
+        # one UDP packet, the caller drops it when decryption returns b''
+        if self._op:
+            return self.seal(self._nonce(), data)
+        if len(data) < TAG_SIZE:
+            return b''
+        return self.open(self._nonce(), data) or b''
+
+    def _encrypt_chunks(self, data):
+        ret = []
+        for i in range(0, len(data), CHUNK_SIZE_MASK):
+            chunk = data[i:i + CHUNK_SIZE_MASK]
+            header = CHUNK_HEADER.pack(len(chunk))
+            ret.append(self.seal(self._nonce(), header))
+            ret.append(self.seal(self._nonce(), chunk))
+        return b''.join(ret)
+
+    def _decrypt_chunks(self, data):
+        if self._recv_buf:
+            data = self._recv_buf + data
+        ret = []
+        pos = 0
+        header_size = CHUNK_HEADER.size + TAG_SIZE
+        while True:
+            if self._chunk_len is None:
+                if len(data) - pos < header_size:
+                    break
+                header = self.open(self._nonce(), data[pos:pos + header_size])
+                if header is None:
+                    raise Exception('AEAD chunk length authentication failed')
+                self._chunk_len = CHUNK_HEADER.unpack(header)[0]
+                if self._chunk_len & ~CHUNK_SIZE_MASK:
+                    raise Exception('AEAD chunk length %d too large'
+                                    % self._chunk_len)
+                pos += header_size
+            end = pos + self._chunk_len + TAG_SIZE
+            if len(data) < end:
+                break
+            chunk = self.open(self._nonce(), data[pos:end])
+            if chunk is None:
+                raise Exception('AEAD chunk authentication failed')
+            ret.append(chunk)
+            self._chunk_len = None
+            pos = end
+        self._recv_buf = data[pos:]
+        return b''.join(ret)
+
+
+def test_hkdf_sha1():
+    # RFC 5869 test case 4
+    import binascii
+    salt = binascii.unhexlify('000102030405060708090a0b0c')
+    info = binascii.unhexlify('f0f1f2f3f4f5f6f7f8f9')
+    okm = hkdf_sha1(b'\x0b' * 11, salt, info, 42)
+    assert binascii.hexlify(okm) == \
+        b'085a01ea1b10f36933068b56efa5ad81a4f14b822f5b091568a9' \
+        b'cdd4f155fda2c22e422478d305f3f896'
+
+
+if __name__ == '__main__':
+    test_hkdf_sha1()
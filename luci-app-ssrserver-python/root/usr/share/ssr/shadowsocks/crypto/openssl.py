@@ -17,11 +17,11 @@
 from __future__ import absolute_import, division, print_function, \
     with_statement
 
-from ctypes import c_char_p, c_int, c_long, byref,\
+from ctypes import c_char, c_char_p, c_int, byref, addressof, string_at, \
     create_string_buffer, c_void_p
 
 from shadowsocks import common
-from shadowsocks.crypto import util
+from shadowsocks.crypto import util, aead
 
 __all__ = ['ciphers']
 
@@ -29,10 +29,15 @@ libcrypto = None
 loaded = False
 
 buf_size = 2048
+# EVP_CipherUpdate may write up to one block more than it was given (cbc)
+MAX_BLOCK_SIZE = 32
+
+EVP_CTRL_AEAD_GET_TAG = 0x10
+EVP_CTRL_AEAD_SET_TAG = 0x11
 
 
 def load_openssl():
-    global loaded, libcrypto, buf
+    global loaded, libcrypto
 
     libcrypto = util.find_library(('crypto', 'eay32'),
                                   'EVP_get_cipherbyname',
@@ -47,7 +52,10 @@ def load_openssl():
                                             c_char_p, c_char_p, c_int)
 
     libcrypto.EVP_CipherUpdate.argtypes = (c_void_p, c_void_p, c_void_p,
-                                           c_char_p, c_int)
+                                           c_void_p, c_int)
+    libcrypto.EVP_CipherFinal_ex.argtypes = (c_void_p, c_void_p, c_void_p)
+    libcrypto.EVP_CIPHER_CTX_ctrl.argtypes = (c_void_p, c_int, c_int,
+                                              c_void_p)
 
     if hasattr(libcrypto, "EVP_CIPHER_CTX_cleanup"):
         libcrypto.EVP_CIPHER_CTX_cleanup.argtypes = (c_void_p,)
@@ -61,7 +69,6 @@ def load_openssl():
     if hasattr(libcrypto, 'OpenSSL_add_all_ciphers'):
         libcrypto.OpenSSL_add_all_ciphers()
 
-    buf = create_string_buffer(buf_size)
     loaded = True
 
 
@@ -85,6 +92,12 @@ def rand_bytes(length):
 class OpenSSLCrypto(object):
     def __init__(self, cipher_name, key, iv, op):
         self._ctx = None
+        self._buf = None
+        self._buf_size = 0
+        self._out = None
+        self._out_addr = None
+        self._out_len = c_int(0)
+        self._out_len_ref = byref(self._out_len)
         if not loaded:
             load_openssl()
         cipher = libcrypto.EVP_get_cipherbyname(common.to_bytes(cipher_name))
@@ -92,6 +105,8 @@ class OpenSSLCrypto(object):
             cipher = load_cipher(cipher_name)
         if not cipher:
             raise Exception('cipher %s not found in libcrypto' % cipher_name)
+        # rc4 has no iv, all its state is in the key schedule
+        self._key = key if not iv else None
         key_ptr = c_char_p(key)
         iv_ptr = c_char_p(iv)
         self._ctx = libcrypto.EVP_CIPHER_CTX_new()
@@ -103,17 +118,45 @@ class OpenSSLCrypto(object):
             self.clean()
             raise Exception('can not initialize cipher context')
 
+    def reset(self, iv, key=None):
+        # start over with a new iv, and key if given, on the same context;
+        # the cipher and the direction stay as they are
+        if key is None:
+            key = self._key
+        r = libcrypto.EVP_CipherInit_ex(self._ctx, None, None, key, iv, -1)
+        if not r:
+            raise Exception('can not reinitialize cipher context')
+
+    def update_into(self, data, out):
+        """Encrypt or decrypt data into the writable buffer out.
+
+        out needs room for len(data) + MAX_BLOCK_SIZE bytes, returns the
+        number of bytes written to it. Callers that pass the same buffer
+        every time save looking up its address again.
+        """
+        l = len(data)
+        if not l:
+            return 0
+        if len(out) < l + MAX_BLOCK_SIZE:
+            raise ValueError('output buffer too small')
+        if out is not self._out:
+            # keep a reference so the address stays valid
+            self._out = out
+            self._out_addr = addressof(c_char.from_buffer(out))
+        libcrypto.EVP_CipherUpdate(self._ctx, self._out_addr,
+                                   self._out_len_ref,
+                                   util.buffer_address(data), l)
+        return self._out_len.value
+
     def update(self, data):
-        global buf_size, buf
-        cipher_out_len = c_long(0)
         l = len(data)
-        if buf_size < l:
-            buf_size = l * 2
-            buf = create_string_buffer(buf_size)
-        libcrypto.EVP_CipherUpdate(self._ctx, byref(buf),
-                                   byref(cipher_out_len), c_char_p(data), l)
-        # buf is copied to a str object when we access buf.raw
-        return buf.raw[:cipher_out_len.value]
+        if self._buf_size < l + MAX_BLOCK_SIZE:
+            self._buf_size = max(buf_size, (l + MAX_BLOCK_SIZE) * 2)
+            self._buf = create_string_buffer(self._buf_size)
+        libcrypto.EVP_CipherUpdate(self._ctx, self._buf, self._out_len_ref,
+                                   util.buffer_address(data), l)
+        # copy only what was written, not the whole buffer
+        return string_at(self._buf, self._out_len.value)
 
     def __del__(self):
         self.clean()
@@ -125,6 +168,53 @@ class OpenSSLCrypto(object):
             else:
                 libcrypto.EVP_CIPHER_CTX_reset(self._ctx)
             libcrypto.EVP_CIPHER_CTX_free(self._ctx)
+            # a failed __init__ cleans up, __del__ mustn't free it again
+            self._ctx = None
+
+
+class OpenSSLAeadCrypto(aead.AeadCryptoBase):
+    # the context keeps cipher and subkey, each seal or open sets the nonce
+    def __init__(self, cipher_name, key, iv, op):
+        aead.AeadCryptoBase.__init__(self, cipher_name, key, iv, op)
+        self._crypto = OpenSSLCrypto(cipher_name, self._subkey, None, op)
+        self._ctx = self._crypto._ctx
+        self._out_len = c_int(0)
+        self._out_len_ref = byref(self._out_len)
+        self._buf = None
+        self._buf_size = 0
+
+    def set_key(self, key):
+        self._crypto.reset(None, key)
+
+    def _out(self, size):
+        if self._buf_size < size:
+            self._buf_size = max(buf_size, size * 2)
+            self._buf = create_string_buffer(self._buf_size)
+        return self._buf
+
+    def seal(self, nonce, data):
+        l = len(data)
+        out = self._out(l + aead.TAG_SIZE)
+        libcrypto.EVP_CipherInit_ex(self._ctx, None, None, None, nonce, -1)
+        libcrypto.EVP_CipherUpdate(self._ctx, out, self._out_len_ref,
+                                   util.buffer_address(data), l)
+        libcrypto.EVP_CipherFinal_ex(self._ctx, out, self._out_len_ref)
+        libcrypto.EVP_CIPHER_CTX_ctrl(self._ctx, EVP_CTRL_AEAD_GET_TAG,
+                                      aead.TAG_SIZE, addressof(out) + l)
+        return string_at(out, l + aead.TAG_SIZE)
+
+    def open(self, nonce, data):
+        l = len(data) - aead.TAG_SIZE
+        out = self._out(l + 1)
+        libcrypto.EVP_CipherInit_ex(self._ctx, None, None, None, nonce, -1)
+        libcrypto.EVP_CIPHER_CTX_ctrl(self._ctx, EVP_CTRL_AEAD_SET_TAG,
+                                      aead.TAG_SIZE, bytes(data[l:]))
+        libcrypto.EVP_CipherUpdate(self._ctx, out, self._out_len_ref,
+                                   util.buffer_address(data), l)
+        r = libcrypto.EVP_CipherFinal_ex(self._ctx, out, self._out_len_ref)
+        if r <= 0:
+            return None
+        return string_at(out, l)
 
 
 ciphers = {
@@ -156,6 +246,9 @@ ciphers = {
     'rc2-cfb': (16, 8, OpenSSLCrypto),
     'rc4': (16, 0, OpenSSLCrypto),
     'seed-cfb': (16, 16, OpenSSLCrypto),
+    'aes-128-gcm': (16, 16, OpenSSLAeadCrypto),
+    'aes-192-gcm': (24, 24, OpenSSLAeadCrypto),
+    'aes-256-gcm': (32, 32, OpenSSLAeadCrypto),
 }
 
 
@@ -167,6 +260,40 @@ def run_method(method):
     util.run_cipher(cipher, decipher)
 
 
+def test_update_into():
+    from os import urandom
+    plain = urandom(10000)
+    cipher = OpenSSLCrypto('aes-256-cfb', b'k' * 32, b'i' * 16, 1)
+    decipher = OpenSSLCrypto('aes-256-cfb', b'k' * 32, b'i' * 16, 0)
+    out = bytearray(len(plain) + MAX_BLOCK_SIZE)
+    view = memoryview(out)
+    n = cipher.update_into(plain[:100], view)
+    n += cipher.update_into(bytearray(plain[100:]), view[n:])
+    assert n == len(plain)
+    assert decipher.update(bytes(out[:n])) == plain
+    try:
+        cipher.update_into(plain, view[:len(plain)])
+        assert False
+    except ValueError:
+        pass
+
+
+def test_reset():
+    from os import urandom
+    plain = urandom(1000)
+    for method in ('aes-256-cfb', 'aes-128-ctr', 'aes-128-cfb8', 'rc4'):
+        iv_len = ciphers[method][1]
+        cipher = OpenSSLCrypto(method, b'k' * 32, b'i' * iv_len, 1)
+        decipher = OpenSSLCrypto(method, b'k' * 32, b'i' * iv_len, 0)
+        decipher.update(cipher.update(plain[:333]))
+        fresh = OpenSSLCrypto(method, b'k' * 32, b'j' * iv_len, 1)
+        cipher.reset(b'j' * iv_len)
+        data = cipher.update(plain)
+        assert data == fresh.update(plain)
+        decipher.reset(b'j' * iv_len)
+        assert decipher.update(data) == plain
+
+
 def test_aes_128_cfb():
     run_method('aes-128-cfb')
 
@@ -195,5 +322,15 @@ def test_rc4():
     run_method('rc4')
 
 
+def test_aes_256_gcm():
+    cipher = OpenSSLAeadCrypto('aes-256-gcm', b'k' * 32, b'i' * 32, 1)
+    decipher = OpenSSLAeadCrypto('aes-256-gcm', b'k' * 32, b'i' * 32, 0)
+
+    util.run_cipher(cipher, decipher)
+
+
 if __name__ == '__main__':
+    test_update_into()
+    test_reset()
     test_aes_128_cfb()
+    test_aes_256_gcm()
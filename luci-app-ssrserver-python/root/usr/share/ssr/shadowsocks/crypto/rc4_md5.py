@@ -24,13 +24,28 @@ from shadowsocks.crypto import openssl
 __all__ = ['ciphers']
 
 
-def create_cipher(alg, key, iv, op, key_as_bytes=0, d=None, salt=None,
-                  i=1, padding=1):
+def rc4_key(key, iv):
     md5 = hashlib.md5()
     md5.update(key)
     md5.update(iv)
-    rc4_key = md5.digest()
-    return openssl.OpenSSLCrypto(b'rc4', rc4_key, b'', op)
+    return md5.digest()
+
+
+class RC4MD5Crypto(openssl.OpenSSLCrypto):
+    def __init__(self, key, iv, op):
+        self._md5_key = key
+        super(RC4MD5Crypto, self).__init__(b'rc4', rc4_key(key, iv), b'', op)
+
+    def reset(self, iv, key=None):
+        # the iv is part of the rc4 key
+        if key is not None:
+            self._md5_key = key
+        super(RC4MD5Crypto, self).reset(b'', rc4_key(self._md5_key, iv))
+
+
+def create_cipher(alg, key, iv, op, key_as_bytes=0, d=None, salt=None,
+                  i=1, padding=1):
+    return RC4MD5Crypto(key, iv, op)
 
 
 ciphers = {
@@ -48,5 +63,14 @@ def test():
     util.run_cipher(cipher, decipher)
 
 
+def test_reset():
+    cipher = create_cipher('rc4-md5', b'k' * 32, b'i' * 16, 1)
+    cipher.update(b'x' * 100)
+    cipher.reset(b'j' * 16)
+    fresh = create_cipher('rc4-md5', b'k' * 32, b'j' * 16, 1)
+    assert cipher.update(b'x' * 100) == fresh.update(b'x' * 100)
+
+
 if __name__ == '__main__':
     test()
+    test_reset()
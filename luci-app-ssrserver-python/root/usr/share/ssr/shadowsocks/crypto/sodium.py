@@ -17,10 +17,10 @@
 from __future__ import absolute_import, division, print_function, \
     with_statement
 
-from ctypes import c_char_p, c_int, c_ulong, c_ulonglong, byref, \
-    create_string_buffer, c_void_p
+from ctypes import c_char, c_char_p, c_int, c_ulong, c_ulonglong, byref, \
+    addressof, create_string_buffer, c_void_p, string_at
 
-from shadowsocks.crypto import util
+from shadowsocks.crypto import util, aead
 
 __all__ = ['ciphers']
 
@@ -31,10 +31,11 @@ buf_size = 2048
 
 # for salsa20 and chacha20 and chacha20-ietf
 BLOCK_SIZE = 64
+ZERO_BLOCK = b'\0' * BLOCK_SIZE
 
 
 def load_libsodium():
-    global loaded, libsodium, buf
+    global loaded, libsodium
 
     libsodium = util.find_library('sodium', 'crypto_stream_salsa20_xor_ic',
                                   'libsodium')
@@ -42,26 +43,39 @@ def load_libsodium():
         raise Exception('libsodium not found')
 
     libsodium.crypto_stream_salsa20_xor_ic.restype = c_int
-    libsodium.crypto_stream_salsa20_xor_ic.argtypes = (c_void_p, c_char_p,
+    libsodium.crypto_stream_salsa20_xor_ic.argtypes = (c_void_p, c_void_p,
                                                        c_ulonglong,
                                                        c_char_p, c_ulonglong,
                                                        c_char_p)
     libsodium.crypto_stream_chacha20_xor_ic.restype = c_int
-    libsodium.crypto_stream_chacha20_xor_ic.argtypes = (c_void_p, c_char_p,
+    libsodium.crypto_stream_chacha20_xor_ic.argtypes = (c_void_p, c_void_p,
                                                         c_ulonglong,
                                                         c_char_p, c_ulonglong,
                                                         c_char_p)
 
     try:
         libsodium.crypto_stream_chacha20_ietf_xor_ic.restype = c_int
-        libsodium.crypto_stream_chacha20_ietf_xor_ic.argtypes = (c_void_p, c_char_p,
+        libsodium.crypto_stream_chacha20_ietf_xor_ic.argtypes = (c_void_p, c_void_p,
                                                         c_ulonglong,
                                                         c_char_p, c_ulong,
                                                         c_char_p)
     except:
         pass
 
-    buf = create_string_buffer(buf_size)
+    for name in ('chacha20poly1305_ietf', 'xchacha20poly1305_ietf'):
+        encrypt = getattr(libsodium, 'crypto_aead_%s_encrypt' % name, None)
+        decrypt = getattr(libsodium, 'crypto_aead_%s_decrypt' % name, None)
+        if encrypt is None or decrypt is None:
+            continue
+        encrypt.restype = c_int
+        encrypt.argtypes = (c_void_p, c_void_p, c_char_p, c_ulonglong,
+                            c_char_p, c_ulonglong, c_char_p, c_char_p,
+                            c_char_p)
+        decrypt.restype = c_int
+        decrypt.argtypes = (c_void_p, c_void_p, c_char_p, c_char_p,
+                            c_ulonglong, c_char_p, c_ulonglong, c_char_p,
+                            c_char_p)
+
     loaded = True
 
 
@@ -83,32 +97,122 @@ class SodiumCrypto(object):
             raise Exception('Unknown cipher')
         # byte counter, not block counter
         self.counter = 0
+        # unused end of the keystream block the last update stopped in
+        self._keystream = b''
+        self._out = None
+        self._out_addr = None
+        self._buf = None
+        self._buf_view = None
+
+    def reset(self, iv, key=None):
+        if key is not None:
+            self.key = key
+            self.key_ptr = c_char_p(key)
+        self.iv = iv
+        self.iv_ptr = c_char_p(iv)
+        self.counter = 0
+        self._keystream = b''
+
+    def update_into(self, data, out):
+        # out needs room for len(data) + BLOCK_SIZE bytes, returns how many
+        # bytes of it were written
+        l = len(data)
+        if len(out) < l + BLOCK_SIZE:
+            raise ValueError('output buffer too small')
+        if out is not self._out:
+            self._out = out
+            self._out_addr = addressof(c_char.from_buffer(out))
+        done = 0
+        if self._keystream:
+            # finish the block the last call stopped in
+            keystream = self._keystream
+            done = min(len(keystream), l)
+            x = int.from_bytes(data[:done], 'little') ^ \
+                int.from_bytes(keystream[:done], 'little')
+            out[:done] = x.to_bytes(done, 'little')
+            self._keystream = keystream[done:]
+            self.counter += done
+        if done < l:
+            # block aligned from here on
+            n = l - done
+            pad = -n % BLOCK_SIZE
+            addr = self._out_addr + done
+            if pad:
+                # xor zeros after the data in place, what comes out there
+                # is the keystream the next call starts with
+                out[done:l] = memoryview(data)[done:]
+                out[l:l + pad] = ZERO_BLOCK[:pad]
+                self.cipher(addr, addr, n + pad, self.iv_ptr,
+                            self.counter // BLOCK_SIZE, self.key_ptr)
+                self._keystream = bytes(out[l:l + pad])
+            else:
+                self.cipher(addr, util.buffer_address(data, done), n,
+                            self.iv_ptr, self.counter // BLOCK_SIZE,
+                            self.key_ptr)
+            self.counter += n
+        return l
 
     def update(self, data):
-        global buf_size, buf
         l = len(data)
+        if self._buf is None or len(self._buf) < l + BLOCK_SIZE:
+            self._buf = bytearray(max(buf_size, (l + BLOCK_SIZE) * 2))
+            self._buf_view = memoryview(self._buf)
+        self.update_into(data, self._buf_view)
+        return bytes(self._buf_view[:l])
+
 
-        # we can only prepend some padding to make the encryption align to
-        # blocks
-        padding = self.counter % BLOCK_SIZE
-        if buf_size < padding + l:
-            buf_size = (padding + l) * 2
-            buf = create_string_buffer(buf_size)
+class SodiumAeadCrypto(aead.AeadCryptoBase):
+    # nonce and tag are handled inside one libsodium call per seal or open
+    def __init__(self, cipher_name, key, iv, op):
+        if not loaded:
+            load_libsodium()
+        aead.AeadCryptoBase.__init__(self, cipher_name, key, iv, op)
+        if cipher_name == 'chacha20-ietf-poly1305':
+            name = 'chacha20poly1305_ietf'
+        elif cipher_name == 'xchacha20-ietf-poly1305':
+            name = 'xchacha20poly1305_ietf'
+            self.nonce_size = 24
+        else:
+            raise Exception('Unknown cipher')
+        self._encrypt = getattr(libsodium, 'crypto_aead_%s_encrypt' % name)
+        self._decrypt = getattr(libsodium, 'crypto_aead_%s_decrypt' % name)
+        self._out_len = c_ulonglong(0)
+        self._out_len_ref = byref(self._out_len)
+        self._buf = None
+        self._buf_size = 0
+        self.set_key(self._subkey)
+
+    def set_key(self, key):
+        self._key = key
+
+    def _out(self, size):
+        if self._buf_size < size:
+            self._buf_size = max(buf_size, size * 2)
+            self._buf = create_string_buffer(self._buf_size)
+        return self._buf
+
+    def seal(self, nonce, data):
+        l = len(data)
+        out = self._out(l + aead.TAG_SIZE)
+        self._encrypt(out, self._out_len_ref, data, l, None, 0, None,
+                      nonce, self._key)
+        return string_at(out, self._out_len.value)
 
-        if padding:
-            data = (b'\0' * padding) + data
-        self.cipher(byref(buf), c_char_p(data), padding + l,
-                    self.iv_ptr, int(self.counter / BLOCK_SIZE), self.key_ptr)
-        self.counter += l
-        # buf is copied to a str object when we access buf.raw
-        # strip off the padding
-        return buf.raw[padding:padding + l]
+    def open(self, nonce, data):
+        l = len(data)
+        out = self._out(l)
+        if self._decrypt(out, self._out_len_ref, None, data, l, None, 0,
+                         nonce, self._key) != 0:
+            return None
+        return string_at(out, self._out_len.value)
 
 
 ciphers = {
     'salsa20': (32, 8, SodiumCrypto),
     'chacha20': (32, 8, SodiumCrypto),
     'chacha20-ietf': (32, 12, SodiumCrypto),
+    'chacha20-ietf-poly1305': (32, 32, SodiumAeadCrypto),
+    'xchacha20-ietf-poly1305': (32, 32, SodiumAeadCrypto),
 }
 
 
@@ -134,7 +238,39 @@ def test_chacha20_ietf():
 
     util.run_cipher(cipher, decipher)
 
+
+def test_keystream_leftover():
+    from os import urandom
+    plain = urandom(1000)
+    for name in ('salsa20', 'chacha20', 'chacha20-ietf'):
+        iv_len = ciphers[name][1]
+        whole = SodiumCrypto(name, b'k' * 32, b'i' * iv_len, 1)
+        expected = whole.update(plain)
+        cipher = SodiumCrypto(name, b'k' * 32, b'i' * iv_len, 1)
+        out = bytearray(len(plain) + BLOCK_SIZE)
+        view = memoryview(out)
+        pos = 0
+        for l in (1, 63, 64, 10, 200, 3, 659):
+            cipher.update_into(plain[pos:pos + l], view[pos:])
+            pos += l
+        assert bytes(out[:len(plain)]) == expected
+        cipher.reset(b'j' * iv_len)
+        fresh = SodiumCrypto(name, b'k' * 32, b'j' * iv_len, 1)
+        assert cipher.update(bytearray(plain)) == fresh.update(plain)
+
+
+def test_chacha20_ietf_poly1305():
+
+    cipher = SodiumAeadCrypto('chacha20-ietf-poly1305', b'k' * 32,
+                              b'i' * 32, 1)
+    decipher = SodiumAeadCrypto('chacha20-ietf-poly1305', b'k' * 32,
+                                b'i' * 32, 0)
+
+    util.run_cipher(cipher, decipher)
+
 if __name__ == '__main__':
+    test_keystream_leftover()
+    test_chacha20_ietf_poly1305()
     test_chacha20_ietf()
     test_chacha20()
     test_salsa20()
@@ -17,15 +17,22 @@
 from __future__ import absolute_import, division, print_function, \
     with_statement
 
+import os
 import string
 import struct
 import hashlib
+import logging
+import tempfile
 
 
-__all__ = ['ciphers']
+__all__ = ['ciphers', 'set_cache_dir']
 
 cached_tables = {}
 
+# derived encrypt tables are kept here across restarts, one 256 byte file
+# per key, named after a hash of the key. None turns the disk cache off
+cache_dir = None
+
 if hasattr(string, 'maketrans'):
     maketrans = string.maketrans
     translate = string.translate
@@ -39,16 +46,75 @@ def get_table(key):
     m.update(key)
     s = m.digest()
     a, b = struct.unpack('<QQ', s)
-    table = maketrans(b'', b'')
-    table = [table[i: i + 1] for i in range(len(table))]
+    # the sort key of byte x in round i is a % (x + i), computing the keys
+    # of a round up front leaves the sort a list lookup instead of a lambda
+    table = list(range(256))
+    mod = a.__mod__
     for i in range(1, 1024):
-        table.sort(key=lambda x: int(a % (ord(x) + i)))
-    return table
+        keys = list(map(mod, range(i, i + 256)))
+        table.sort(key=keys.__getitem__)
+    return [struct.pack('B', x) for x in table]
+
+
+def set_cache_dir(path):
+    # the tables decrypt everything sent with their keys, only use a
+    # directory nobody else can read or plant files in
+    global cache_dir
+    cache_dir = None
+    if not path:
+        return
+    try:
+        if not os.path.isdir(path):
+            os.makedirs(path, 0o700)
+        st = os.stat(path)
+    except (OSError, IOError) as e:
+        logging.warning('table cache disabled: %s' % (e,))
+        return
+    if hasattr(os, 'getuid') and \
+            (st.st_uid != os.getuid() or st.st_mode & 0o077):
+        logging.warning('table cache disabled: %s is open to other users'
+                        % path)
+        return
+    cache_dir = path
+
+
+def _cache_path(key):
+    return os.path.join(cache_dir,
+                        hashlib.sha256(b'ssr-table' + key).hexdigest())
+
+
+def _load_table(key):
+    if cache_dir is None:
+        return None
+    try:
+        with open(_cache_path(key), 'rb') as f:
+            data = f.read(257)
+    except (OSError, IOError):
+        return None
+    # a truncated or garbled file is regenerated and written again
+    if len(data) != 256 or len(set(data)) != 256:
+        return None
+    return data
+
+
+def _save_table(key, data):
+    if cache_dir is None:
+        return
+    try:
+        fd, path = tempfile.mkstemp(dir=cache_dir)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(path, _cache_path(key))
+    except (OSError, IOError) as e:
+        logging.warning('can not cache table in %s: %s' % (cache_dir, e))
 
 
 def init_table(key):
     if key not in cached_tables:
-        encrypt_table = b''.join(get_table(key))
+        encrypt_table = _load_table(key)
+        if encrypt_table is None:
+            encrypt_table = b''.join(get_table(key))
+            _save_table(key, encrypt_table)
         decrypt_table = maketrans(encrypt_table, maketrans(b'', b''))
         cached_tables[key] = [encrypt_table, decrypt_table]
     return cached_tables[key]
@@ -59,6 +125,10 @@ class TableCipher(object):
         self._encrypt_table, self._decrypt_table = init_table(key)
         self._op = op
 
+    def reset(self, iv, key=None):
+        if key is not None:
+            self._encrypt_table, self._decrypt_table = init_table(key)
+
     def update(self, data):
         if self._op:
             return translate(data, self._encrypt_table)
@@ -69,6 +139,9 @@ class NoneCipher(object):
     def __init__(self, cipher_name, key, iv, op):
         pass
 
+    def reset(self, iv, key=None):
+        pass
+
     def update(self, data):
         return data
 
@@ -167,6 +240,34 @@ def test_table_result():
         assert (target2[1][i] == ord(decrypt_table[i]))
 
 
+def test_table_cache():
+    global cache_dir
+    import shutil
+    tmp = tempfile.mkdtemp()
+    old_dir = cache_dir
+    try:
+        os.chmod(tmp, 0o755)
+        set_cache_dir(tmp)
+        assert cache_dir is None
+        set_cache_dir(os.path.join(tmp, 'tables'))
+        tmp_tables = cache_dir
+        cached_tables.pop(b'foobar!', None)
+        tables = init_table(b'foobar!')
+        assert len(os.listdir(tmp_tables)) == 1
+        assert _load_table(b'foobar!') == tables[0]
+        # a reload comes from the file, a damaged file is replaced
+        cached_tables.pop(b'foobar!')
+        assert init_table(b'foobar!') == tables
+        with open(_cache_path(b'foobar!'), 'wb') as f:
+            f.write(b'\x00' * 256)
+        cached_tables.pop(b'foobar!')
+        assert init_table(b'foobar!') == tables
+        assert _load_table(b'foobar!') == tables[0]
+    finally:
+        cache_dir = old_dir
+        shutil.rmtree(tmp)
+
+
 def test_encryption():
     from shadowsocks.crypto import util
 
@@ -178,4 +279,5 @@ def test_encryption():
 
 if __name__ == '__main__':
     test_table_result()
+    test_table_cache()
     test_encryption()
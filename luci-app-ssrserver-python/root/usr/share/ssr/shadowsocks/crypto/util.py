@@ -19,6 +19,7 @@ from __future__ import absolute_import, division, print_function, \
 
 import os
 import logging
+from ctypes import c_char, c_void_p, addressof, cast
 
 
 def find_library_nt(name):
@@ -93,34 +94,57 @@ def find_library(possible_lib_names, search_symbol, library_name):
     return None
 
 
-def run_cipher(cipher, decipher):
+def buffer_address(data, offset=0):
+    # pointer argument for a c_void_p parameter, bytes and writable buffers
+    # are passed without a copy
+    if data.__class__ is bytes:
+        if not offset:
+            return data
+        return cast(data, c_void_p).value + offset
+    try:
+        return addressof(c_char.from_buffer(data)) + offset
+    except TypeError:
+        # read-only memoryview
+        return bytes(data[offset:])
+
+
+def run_cipher(cipher, decipher, size=None, total=16 * 1024 * 1024,
+               verbose=True):
+    # encrypt total bytes in pieces of size, random sizes when it is None,
+    # decrypt them again and return the speed in bytes/s
     from os import urandom
     import random
     import time
 
-    BLOCK_SIZE = 16384
-    rounds = 1 * 1024
-    plain = urandom(BLOCK_SIZE * rounds)
+    plain = urandom(total)
+
+    def pieces(data):
+        pos = 0
+        while pos < len(data):
+            l = size or random.randint(100, 32768)
+            yield data[pos:pos + l]
+            pos += l
 
     results = []
-    pos = 0
-    print('test start')
+    if verbose:
+        print('test start')
     start = time.time()
-    while pos < len(plain):
-        l = random.randint(100, 32768)
-        c = cipher.update(plain[pos:pos + l])
-        results.append(c)
-        pos += l
-    pos = 0
-    c = b''.join(results)
+    for piece in pieces(plain):
+        results.append(cipher.update(piece))
+    if size:
+        # decrypt what each update gave, like packets on the wire
+        encrypted = results
+    else:
+        encrypted = pieces(b''.join(results))
     results = []
-    while pos < len(plain):
-        l = random.randint(100, 32768)
-        results.append(decipher.update(c[pos:pos + l]))
-        pos += l
+    for piece in encrypted:
+        results.append(decipher.update(piece))
     end = time.time()
-    print('speed: %d bytes/s' % (BLOCK_SIZE * rounds / (end - start)))
+    speed = total / (end - start)
+    if verbose:
+        print('speed: %d bytes/s' % speed)
     assert b''.join(results) == plain
+    return speed
 
 
 def test_find_library():
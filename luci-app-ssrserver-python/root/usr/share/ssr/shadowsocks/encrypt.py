@@ -21,9 +21,11 @@ import os
 import sys
 import hashlib
 import logging
+import threading
+import collections
 
 from shadowsocks import common
-from shadowsocks.crypto import rc4_md5, openssl, sodium, table
+from shadowsocks.crypto import rc4_md5, openssl, sodium, table, util, aead
 
 
 method_supported = {}
@@ -32,6 +34,17 @@ method_supported.update(openssl.ciphers)
 method_supported.update(sodium.ciphers)
 method_supported.update(table.ciphers)
 
+# room update_into may need past the end of the data, a cbc block for
+# openssl, a keystream block for sodium
+UPDATE_INTO_SLACK = max(openssl.MAX_BLOCK_SIZE, sodium.BLOCK_SIZE)
+
+# a small UDP packet, a full ethernet frame and a large TCP read
+BENCH_SIZES = (64, 1400, 32768)
+BENCH_TOTAL = 1024 * 1024
+# what method auto chooses from: AES-GCM is fastest with AES instructions,
+# chacha20-poly1305 without them
+AUTO_METHODS = ('aes-128-gcm', 'aes-256-gcm', 'chacha20-ietf-poly1305')
+
 
 def random_string(length):
     try:
@@ -39,7 +52,13 @@ def random_string(length):
     except NotImplementedError as e:
         return openssl.rand_bytes(length)
 
-cached_keys = {}
+# derived (key, iv) by (password, key_len, iv_len), least recently used
+# first. The protocol plugins derive a key from a fresh salt on every
+# connection, without a bound those would pile up here forever
+KEY_CACHE_SIZE = 1024
+cached_keys = collections.OrderedDict()
+# the db thread derives keys for new ports and users while the loop runs
+_cached_keys_lock = threading.Lock()
 
 
 def try_cipher(key, method=None):
@@ -51,10 +70,12 @@ def EVP_BytesToKey(password, key_len, iv_len):
     # so that we make the same key and iv as nodejs version
     if hasattr(password, 'encode'):
         password = password.encode('utf-8')
-    cached_key = '%s-%d-%d' % (password, key_len, iv_len)
-    r = cached_keys.get(cached_key, None)
-    if r:
-        return r
+    cached_key = (password, key_len, iv_len)
+    with _cached_keys_lock:
+        r = cached_keys.get(cached_key)
+        if r is not None:
+            cached_keys.move_to_end(cached_key)
+            return r
     m = []
     i = 0
     while len(b''.join(m)) < (key_len + iv_len):
@@ -68,7 +89,10 @@ def EVP_BytesToKey(password, key_len, iv_len):
     ms = b''.join(m)
     key = ms[:key_len]
     iv = ms[key_len:key_len + iv_len]
-    cached_keys[cached_key] = (key, iv)
+    with _cached_keys_lock:
+        cached_keys[cached_key] = (key, iv)
+        if len(cached_keys) > KEY_CACHE_SIZE:
+            cached_keys.popitem(last=False)
     return key, iv
 
 
@@ -82,6 +106,8 @@ class Encryptor(object):
         self.iv_buf = b''
         self.cipher_key = b''
         self.decipher = None
+        self._out = None
+        self._out_view = None
         method = method.lower()
         self._method_info = self.get_method_info(method)
         if self._method_info:
@@ -118,20 +144,37 @@ class Encryptor(object):
         self.cipher_key = key
         return m[2](method, key, iv, op)
 
+    def _update(self, cipher, buf, prefix=b''):
+        # ciphers with update_into write straight into our own buffer, the
+        # only copy left is the bytes we return
+        update_into = getattr(cipher, 'update_into', None)
+        if update_into is None:
+            if prefix:
+                return prefix + cipher.update(buf)
+            return cipher.update(buf)
+        size = len(buf) + UPDATE_INTO_SLACK
+        if self._out is None or len(self._out) < size:
+            self._out = bytearray(max(size * 2, openssl.buf_size))
+            self._out_view = memoryview(self._out)
+        l = update_into(buf, self._out_view)
+        if prefix:
+            return prefix + self._out_view[:l]
+        return bytes(self._out_view[:l])
+
     def encrypt(self, buf):
         if len(buf) == 0:
             return buf
         if self.iv_sent:
-            return self.cipher.update(buf)
+            return self._update(self.cipher, buf)
         else:
             self.iv_sent = True
-            return self.cipher_iv + self.cipher.update(buf)
+            return self._update(self.cipher, buf, self.cipher_iv)
 
     def decrypt(self, buf):
         if len(buf) == 0:
             return buf
         if self.decipher is not None: #optimize
-            return self.decipher.update(buf)
+            return self._update(self.decipher, buf)
 
         decipher_iv_len = self._method_info[1]
         if len(self.iv_buf) <= decipher_iv_len:
@@ -142,10 +185,18 @@ class Encryptor(object):
                                             iv=decipher_iv)
             buf = self.iv_buf[decipher_iv_len:]
             del self.iv_buf
-            return self.decipher.update(buf)
+            return self._update(self.decipher, buf)
         else:
             return b''
 
+def update_packet(cipher, data):
+    # AEAD ciphers seal a UDP packet as a whole instead of as chunks
+    update_once = getattr(cipher, 'update_once', None)
+    if update_once is not None:
+        return update_once(data)
+    return cipher.update(data)
+
+
 def encrypt_all(password, method, op, data):
     result = []
     method = method.lower()
@@ -161,7 +212,7 @@ def encrypt_all(password, method, op, data):
         iv = data[:iv_len]
         data = data[iv_len:]
     cipher = m(method, key, iv, op)
-    result.append(cipher.update(data))
+    result.append(update_packet(cipher, data))
     return b''.join(result)
 
 def encrypt_key(password, method):
@@ -195,10 +246,90 @@ def encrypt_all_iv(key, method, op, data, ref_iv):
         data = data[iv_len:]
         ref_iv[0] = iv
     cipher = m(method, key, iv, op)
-    result.append(cipher.update(data))
+    result.append(update_packet(cipher, data))
     return b''.join(result)
 
 
+class CipherPool(object):
+    """Ciphers kept for encrypt_all_iv, one per method, key and direction.
+
+    Every UDP packet comes with its own iv, so instead of creating and
+    initializing a cipher context per packet the pooled one is reset to
+    the new iv.
+    """
+
+    def __init__(self):
+        self._ciphers = {}
+
+    def get_cipher(self, key, method, op, iv):
+        cipher = self._ciphers.get((method, key, op), None)
+        if cipher is None:
+            m = method_supported[method][2]
+            cipher = m(method, key, iv, op)
+            self._ciphers[(method, key, op)] = cipher
+        else:
+            cipher.reset(iv)
+        return cipher
+
+    def encrypt_all_iv(self, key, method, op, data, ref_iv):
+        method = method.lower()
+        iv_len = method_supported[method][1]
+        if op:
+            iv = ref_iv[0]
+            prefix = iv
+        else:
+            iv = data[:iv_len]
+            data = data[iv_len:]
+            ref_iv[0] = iv
+            prefix = b''
+        cipher = self.get_cipher(key, method, op, iv)
+        return prefix + update_packet(cipher, data)
+
+
+def bench_ciphers(methods=None, sizes=BENCH_SIZES, total=BENCH_TOTAL):
+    """Time each method with util.run_cipher at every packet size.
+
+    Returns a list of {'method', 'speed': {size: bytes/s}, 'score', 'aead'}
+    with the fastest first, the score is the geometric mean of the speeds.
+    Methods whose library can't be loaded are left out, and so are the cbc
+    ones, which hold back the last block and only work on whole blocks.
+    """
+    if methods is None:
+        methods = sorted(method_supported.keys())
+    results = []
+    for method in methods:
+        if method.endswith('-cbc'):
+            continue
+        key_len, iv_len, m = method_supported[method]
+        key = b'k' * key_len
+        iv = b'i' * iv_len
+        speed = {}
+        try:
+            for size in sizes:
+                cipher = m(method, key, iv, 1)
+                speed[size] = util.run_cipher(cipher, m(method, key, iv, 0),
+                                              size, total, False)
+        except Exception as e:
+            logging.warning('skip %s: %s' % (method, e))
+            continue
+        score = 1.0
+        for size in sizes:
+            score *= speed[size]
+        score **= 1.0 / len(sizes)
+        results.append({'method': method, 'speed': speed, 'score': score,
+                        'aead': isinstance(cipher, aead.AeadCryptoBase)})
+    results.sort(key=lambda r: -r['score'])
+    return results
+
+
+def auto_method(methods=AUTO_METHODS):
+    # the fastest of methods on this machine
+    results = bench_ciphers(methods)
+    if not results:
+        raise Exception('none of %s is available' % ', '.join(methods))
+    return results[0]['method']
+
+
 CIPHERS_TO_TEST = [
     'aes-128-cfb',
     'aes-256-cfb',
@@ -206,6 +337,8 @@ CIPHERS_TO_TEST = [
     'salsa20',
     'chacha20',
     'table',
+    'aes-128-gcm',
+    'chacha20-ietf-poly1305',
 ]
 
 
@@ -221,6 +354,26 @@ def test_encryptor():
         assert plain == plain2
 
 
+def test_key_cache():
+    global KEY_CACHE_SIZE
+    old_size = KEY_CACHE_SIZE
+    KEY_CACHE_SIZE = 4
+    cached_keys.clear()
+    try:
+        key = EVP_BytesToKey(b'port', 32, 16)
+        for i in range(10):
+            EVP_BytesToKey(b'salted %d' % i, 16, 16)
+            # a key in use stays while the one-off keys pass through
+            assert EVP_BytesToKey(b'port', 32, 16) == key
+        assert len(cached_keys) == 4
+        assert (b'port', 32, 16) in cached_keys
+        assert (b'salted 0', 16, 16) not in cached_keys
+        assert EVP_BytesToKey('port', 32, 16) == key
+    finally:
+        KEY_CACHE_SIZE = old_size
+        cached_keys.clear()
+
+
 def test_encrypt_all():
     from os import urandom
     plain = urandom(10240)
@@ -231,6 +384,55 @@ def test_encrypt_all():
         assert plain == plain2
 
 
+def test_cipher_pool():
+    from os import urandom
+    pool = CipherPool()
+    for method in CIPHERS_TO_TEST:
+        logging.warn(method)
+        key = encrypt_key(b'key', method)
+        for i in range(3):
+            plain = urandom(100 + i)
+            ref_iv = [encrypt_new_iv(method)]
+            cipher = pool.encrypt_all_iv(key, method, 1, plain, ref_iv)
+            assert cipher == encrypt_all_iv(key, method, 1, plain, ref_iv)
+            iv = [None]
+            assert pool.encrypt_all_iv(key, method, 0, cipher, iv) == plain
+            assert iv == ref_iv
+
+
+def test_aead_tamper():
+    from os import urandom
+    plain = urandom(100)
+    for method in ('aes-128-gcm', 'chacha20-ietf-poly1305'):
+        cipher = bytearray(encrypt_all(b'key', method, 1, plain))
+        cipher[-1] ^= 1
+        assert encrypt_all(b'key', method, 0, bytes(cipher)) == b''
+        cipher = bytearray(Encryptor(b'key', method).encrypt(plain))
+        cipher[-1] ^= 1
+        try:
+            Encryptor(b'key', method).decrypt(bytes(cipher))
+            assert False
+        except Exception as e:
+            assert 'authentication' in str(e)
+
+
+def test_bench_ciphers():
+    # rc4-md5 needs the legacy provider of OpenSSL 3, when it's missing the
+    # method is left out like any other that can't be loaded
+    methods = ['aes-128-cfb', 'aes-256-cfb', 'rc4-md5', 'aes-128-cbc']
+    results = bench_ciphers(methods, (64, 1400), 64 * 1024)
+    names = [r['method'] for r in results]
+    assert 'aes-128-cfb' in names and 'aes-256-cfb' in names
+    assert 'aes-128-cbc' not in names
+    assert set(names) <= set(methods)
+    assert results[0]['score'] >= results[-1]['score']
+    assert auto_method() in AUTO_METHODS
+
+
 if __name__ == '__main__':
+    test_key_cache()
     test_encrypt_all()
     test_encryptor()
+    test_cipher_pool()
+    test_aead_tamper()
+    test_bench_ciphers()
@@ -26,14 +26,16 @@ import time
 import socket
 import select
 import errno
+import heapq
 import logging
 from collections import defaultdict
 
 from shadowsocks import shell
 
 
-__all__ = ['EventLoop', 'POLL_NULL', 'POLL_IN', 'POLL_OUT', 'POLL_ERR',
-           'POLL_HUP', 'POLL_NVAL', 'EVENT_NAMES']
+__all__ = ['EventLoop', 'TimerWheel', 'Clock', 'clock', 'POLL_NULL', 'POLL_IN',
+           'POLL_OUT', 'POLL_ERR', 'POLL_HUP', 'POLL_NVAL', 'POLL_EDGE',
+           'EVENT_NAMES']
 
 POLL_NULL = 0x00
 POLL_IN = 0x01
@@ -41,6 +43,8 @@ POLL_OUT = 0x04
 POLL_ERR = 0x08
 POLL_HUP = 0x10
 POLL_NVAL = 0x20
+# EPOLLET, only registered when the loop runs edge-triggered on epoll
+POLL_EDGE = 0x80000000
 
 
 EVENT_NAMES = {
@@ -55,6 +59,9 @@ EVENT_NAMES = {
 # we check timeouts every TIMEOUT_PRECISION seconds
 TIMEOUT_PRECISION = 2
 
+# one slot per second, timeouts longer than this just go round again
+TIMER_WHEEL_SLOTS = 512
+
 
 class KqueueLoop(object):
 
@@ -73,10 +80,12 @@ class KqueueLoop(object):
         for e in events:
             self._kqueue.control([e], 0)
 
-    def poll(self, timeout):
+    def poll(self, timeout, maxevents=-1):
         if timeout < 0:
             timeout = None  # kqueue behaviour
-        events = self._kqueue.control(None, KqueueLoop.MAX_EVENTS, timeout)
+        if maxevents <= 0:
+            maxevents = KqueueLoop.MAX_EVENTS
+        events = self._kqueue.control(None, maxevents, timeout)
         results = defaultdict(lambda: POLL_NULL)
         for e in events:
             fd = e.ident
@@ -109,7 +118,7 @@ class SelectLoop(object):
         self._w_list = set()
         self._x_list = set()
 
-    def poll(self, timeout):
+    def poll(self, timeout, maxevents=-1):
         r, w, x = select.select(self._r_list, self._w_list, self._x_list,
                                 timeout)
         results = defaultdict(lambda: POLL_NULL)
@@ -142,8 +151,105 @@ class SelectLoop(object):
         pass
 
 
-class EventLoop(object):
+class Clock(object):
+    """Monotonic time, cached and refreshed once per poll iteration.
+
+    Rate limiters, caches and replay queues read `now` instead of asking
+    the kernel for the time on every packet.
+    """
+
     def __init__(self):
+        self.now = time.monotonic()
+
+    def update(self):
+        self.now = time.monotonic()
+        return self.now
+
+
+# shared by every loop in the process, monotonic time is process-wide anyway
+clock = Clock()
+
+
+class TimerWheel(object):
+    """Coarse-grained hashed timing wheel for idle timeouts.
+
+    Each registered object must carry an integer `last_activity`. Marking
+    activity only writes that field; the wheel checks it lazily when the
+    slot of the old deadline comes up and reschedules the object if it was
+    active in the meantime. Expiry costs amortized O(1) per tick, no matter
+    how many packets go through the connection.
+    """
+
+    def __init__(self, slots=TIMER_WHEEL_SLOTS, now=None):
+        if now is None:
+            now = time.monotonic()
+        self.now = int(now)
+        self._tick = self.now
+        self._slots = [{} for _ in range(slots)]
+        self._slot_of = {}
+
+    def __len__(self):
+        return len(self._slot_of)
+
+    def __contains__(self, obj):
+        return obj in self._slot_of
+
+    def _schedule(self, obj, timeout, callback, deadline):
+        # never schedule into the slot being processed or behind it
+        index = max(deadline, self._tick + 1) % len(self._slots)
+        self._slots[index][obj] = (timeout, callback)
+        self._slot_of[obj] = index
+
+    def add(self, obj, timeout, callback):
+        self.remove(obj)
+        obj.last_activity = self.now
+        self._schedule(obj, int(timeout), callback, self.now + int(timeout))
+
+    def remove(self, obj):
+        index = self._slot_of.pop(obj, None)
+        if index is not None:
+            self._slots[index].pop(obj, None)
+
+    def advance(self, now):
+        now = int(now)
+        self.now = now
+        if now <= self._tick:
+            return 0
+        c = 0
+        ticks = min(now - self._tick, len(self._slots))
+        for _ in range(ticks):
+            self._tick += 1
+            index = self._tick % len(self._slots)
+            slot = self._slots[index]
+            if not slot:
+                continue
+            entries = list(slot.items())
+            slot.clear()
+            for obj, entry in entries:
+                # a callback may have removed or re-added it meanwhile
+                if self._slot_of.get(obj) != index or obj in slot:
+                    continue
+                del self._slot_of[obj]
+                timeout, callback = entry
+                deadline = obj.last_activity + timeout
+                if deadline <= now:
+                    c += 1
+                    callback(obj)
+                else:
+                    self._schedule(obj, timeout, callback, deadline)
+        self._tick = now
+        if c:
+            logging.debug('%d timers expired' % c)
+        return c
+
+
+class EventLoop(object):
+    def __init__(self, edge_triggered=False, max_events=-1):
+        # edge_triggered: sockets added with POLL_EDGE are registered with
+        # EPOLLET. Their handlers have to read until EAGAIN and keep track of
+        # the events they care about themselves, modify() is never needed.
+        # max_events: most events returned by a single poll(), -1 for the
+        # implementation default
         if hasattr(select, 'epoll'):
             self._impl = select.epoll()
             model = 'epoll'
@@ -156,18 +262,27 @@ class EventLoop(object):
         else:
             raise Exception('can not find any available functions in select '
                             'package')
+        self.edge_triggered = edge_triggered and model == 'epoll'
+        self._max_events = max_events
         self._fdmap = {}  # (f, handler)
-        self._last_time = time.time()
+        self.now = clock.update()
+        self._last_time = self.now
+        self.timer_wheel = TimerWheel(now=self.now)
         self._periodic_callbacks = []
+        self._timers = []
+        self._timer_seq = 0
         self._stopping = False
-        logging.debug('using event model: %s', model)
+        logging.debug('using event model: %s%s', model,
+                      self.edge_triggered and ' (edge-triggered)' or '')
 
     def poll(self, timeout=None):
-        events = self._impl.poll(timeout)
+        events = self._impl.poll(timeout, self._max_events)
         return [(self._fdmap[fd][0], fd, event) for fd, event in events]
 
     def add(self, f, mode, handler):
         fd = f.fileno()
+        if not self.edge_triggered:
+            mode &= ~POLL_EDGE
         self._fdmap[fd] = (f, handler)
         self._impl.register(fd, mode)
 
@@ -186,6 +301,21 @@ class EventLoop(object):
     def remove_periodic(self, callback):
         self._periodic_callbacks.remove(callback)
 
+    def call_later(self, delay, callback):
+        # one-shot callback, run from the loop after `delay` seconds
+        self._timer_seq += 1
+        heapq.heappush(self._timers,
+                       (self.now + delay, self._timer_seq, callback))
+
+    def _run_timers(self, now):
+        timers = self._timers
+        while timers and timers[0][0] <= now:
+            callback = heapq.heappop(timers)[2]
+            try:
+                callback()
+            except (OSError, IOError) as e:
+                shell.print_exception(e)
+
     def modify(self, f, mode):
         fd = f.fileno()
         self._impl.modify(fd, mode)
@@ -197,8 +327,11 @@ class EventLoop(object):
         events = []
         while not self._stopping:
             asap = False
+            timeout = TIMEOUT_PRECISION
+            if self._timers:
+                timeout = max(0, min(timeout, self._timers[0][0] - self.now))
             try:
-                events = self.poll(TIMEOUT_PRECISION)
+                events = self.poll(timeout)
             except (OSError, IOError) as e:
                 if errno_from_exception(e) in (errno.EPIPE, errno.EINTR):
                     # EPIPE: Happens when the client closes the connection
@@ -212,22 +345,21 @@ class EventLoop(object):
                     traceback.print_exc()
                     continue
 
-            handle = False
+            now = self.now = clock.update()
             for sock, fd, event in events:
                 handler = self._fdmap.get(fd, None)
                 if handler is not None:
                     handler = handler[1]
                     try:
-                        handle = handler.handle_event(sock, fd, event) or handle
+                        handler.handle_event(sock, fd, event)
                     except (OSError, IOError) as e:
                         shell.print_exception(e)
-            now = time.time()
+            self._run_timers(now)
+            self.timer_wheel.advance(now)
             if asap or now - self._last_time >= TIMEOUT_PRECISION:
                 for callback in self._periodic_callbacks:
                     callback()
                 self._last_time = now
-            if events and not handle:
-                time.sleep(0.001)
 
     def __del__(self):
         self._impl.close()
@@ -256,3 +388,40 @@ def errno_from_exception(e):
 def get_sock_error(sock):
     error_number = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
     return socket.error(error_number, os.strerror(error_number))
+
+
+def test_timer_wheel():
+    class Conn(object):
+        last_activity = 0
+
+    expired = []
+    wheel = TimerWheel(slots=8, now=100)
+    a, b, c = Conn(), Conn(), Conn()
+    wheel.add(a, 3, expired.append)
+    wheel.add(b, 3, expired.append)
+    wheel.add(c, 20, expired.append)
+    assert len(wheel) == 3
+
+    wheel.advance(102)
+    b.last_activity = wheel.now
+    wheel.advance(103)
+    assert expired == [a]
+    assert b in wheel and a not in wheel
+
+    wheel.advance(105)
+    assert expired == [a, b]
+
+    # longer than the wheel, has to go round more than once
+    wheel.advance(119)
+    assert c in wheel
+    wheel.advance(120)
+    assert expired == [a, b, c]
+    assert len(wheel) == 0
+
+    # removing from inside a callback must not break the sweep
+    d, e = Conn(), Conn()
+    wheel.add(d, 1, lambda obj: wheel.remove(e))
+    wheel.add(e, 1, expired.append)
+    wheel.advance(1000)
+    assert len(wheel) == 0
+    assert expired == [a, b, c]
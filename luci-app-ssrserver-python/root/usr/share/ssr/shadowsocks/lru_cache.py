@@ -41,19 +41,33 @@ except:
 
 SWEEP_MAX_ITEMS = 1024
 
+
+class _MonotonicClock(object):
+    # reads the time on every access, used when no loop clock is given
+    @property
+    def now(self):
+        return time.monotonic()
+
+
 class LRUCache(collections.abc.MutableMapping):
-    """This class is not thread safe"""
+    """This class is not thread safe
 
-    def __init__(self, timeout=60, close_callback=None, *args, **kwargs):
+    clock is any object with a `now` attribute, e.g. eventloop.clock, so
+    caches living on the event loop don't read the time per access.
+    """
+
+    def __init__(self, timeout=60, close_callback=None, clock=None,
+                 *args, **kwargs):
         self.timeout = timeout
         self.close_callback = close_callback
+        self.clock = clock or _MonotonicClock()
         self._store = {}
         self._keys_to_last_time = OrderedDict()
         self.update(dict(*args, **kwargs))  # use the free update to set keys
 
     def __getitem__(self, key):
         # O(1)
-        t = time.time()
+        t = self.clock.now
         last_t = self._keys_to_last_time[key]
         del self._keys_to_last_time[key]
         self._keys_to_last_time[key] = t
@@ -61,7 +75,7 @@ class LRUCache(collections.abc.MutableMapping):
 
     def __setitem__(self, key, value):
         # O(1)
-        t = time.time()
+        t = self.clock.now
         if key in self._keys_to_last_time:
             del self._keys_to_last_time[key]
         self._keys_to_last_time[key] = t
@@ -89,7 +103,7 @@ class LRUCache(collections.abc.MutableMapping):
 
     def sweep(self, sweep_item_cnt = SWEEP_MAX_ITEMS):
         # O(n - m)
-        now = time.time()
+        now = self.clock.now
         c = 0
         while c < sweep_item_cnt:
             if len(self._keys_to_last_time) == 0:
@@ -110,7 +124,7 @@ class LRUCache(collections.abc.MutableMapping):
         return c < SWEEP_MAX_ITEMS
 
     def clear(self, keep):
-        now = time.time()
+        now = self.clock.now
         c = 0
         while len(self._keys_to_last_time) > keep:
             if len(self._keys_to_last_time) == 0:
@@ -175,5 +189,24 @@ def test():
     time.sleep(0.3)
     c.sweep()
 
+
+def test_clock():
+    class Clock(object):
+        now = 0
+
+    clock = Clock()
+    c = LRUCache(timeout=10, clock=clock)
+    c['a'] = 1
+    clock.now = 5
+    c['b'] = 2
+    clock.now = 12
+    c.sweep()
+    assert 'a' not in c
+    assert c['b'] == 2
+    clock.now = 30
+    c.sweep()
+    assert 'b' not in c
+
 if __name__ == '__main__':
     test()
+    test_clock()
@@ -127,6 +127,11 @@ class Manager(object):
                         self._send_control_data(b'ok')
                     elif command == 'ping':
                         self._send_control_data(b'pong')
+                    elif command == 'dns':
+                        stats = self._dns_resolver.get_server_stats()
+                        self._send_control_data(
+                            b'dns: ' + common.to_bytes(
+                                json.dumps(stats, separators=(',', ':'))))
                     else:
                         logging.error('unknown command %s', command)
 
@@ -134,6 +139,7 @@ class Manager(object):
         # commands:
         # add: {"server_port": 8000, "password": "foobar"}
         # remove: {"server_port": 8000"}
+        # dns: replies with the stats of each DNS server
         data = common.to_str(data)
         parts = data.split(':', 1)
         if len(parts) < 2:
@@ -249,6 +255,14 @@ def test():
     assert b'ok' in data
     logging.info('add and remove test passed')
 
+    cli.send(b'dns')
+    data, addr = cli.recvfrom(1506)
+    data = common.to_str(data)
+    assert data.startswith('dns: ')
+    stats = json.loads(data.split('dns:')[1])
+    assert all('rtt_ms' in v for v in stats.values())
+    logging.info('DNS stats test passed')
+
     # test statistics for TCP
     header = common.pack_addr(b'google.com') + struct.pack('>H', 80)
     data = encrypt.encrypt_all(b'asdfadsfasdf', 'aes-256-cfb', 1,
@@ -33,7 +33,7 @@ import hmac
 import hashlib
 
 import shadowsocks
-from shadowsocks import common, lru_cache, encrypt
+from shadowsocks import common, lru_cache, encrypt, eventloop
 from shadowsocks.obfsplugin import plain
 from shadowsocks.common import to_bytes, to_str, ord, chr
 
@@ -100,13 +100,13 @@ class client_queue(object):
         self.back = begin_id + 1
         self.alloc = {}
         self.enable = True
-        self.last_update = time.time()
+        self.last_update = eventloop.clock.now
 
     def update(self):
-        self.last_update = time.time()
+        self.last_update = eventloop.clock.now
 
     def is_active(self):
-        return time.time() - self.last_update < 60 * 3
+        return eventloop.clock.now - self.last_update < 60 * 3
 
     def re_enable(self, connection_id):
         self.enable = True
@@ -141,7 +141,7 @@ class client_queue(object):
 
 class obfs_auth_v2_data(object):
     def __init__(self):
-        self.client_id = lru_cache.LRUCache()
+        self.client_id = lru_cache.LRUCache(clock=eventloop.clock)
         self.local_client_id = b''
         self.connection_id = 0
         self.set_max_client(64) # max active client count
@@ -413,7 +413,7 @@ class obfs_auth_mu_data(object):
 
     def update(self, user_id, client_id, connection_id):
         if user_id not in self.user_id:
-            self.user_id[user_id] = lru_cache.LRUCache()
+            self.user_id[user_id] = lru_cache.LRUCache(clock=eventloop.clock)
         local_client_id = self.user_id[user_id]
 
         if client_id in local_client_id:
@@ -425,7 +425,7 @@ class obfs_auth_mu_data(object):
 
     def insert(self, user_id, client_id, connection_id):
         if user_id not in self.user_id:
-            self.user_id[user_id] = lru_cache.LRUCache()
+            self.user_id[user_id] = lru_cache.LRUCache(clock=eventloop.clock)
         local_client_id = self.user_id[user_id]
 
         if local_client_id.get(client_id, None) is None or not local_client_id[client_id].enable:
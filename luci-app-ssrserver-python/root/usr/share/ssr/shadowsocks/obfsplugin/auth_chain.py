@@ -35,10 +35,20 @@ import hashlib
 import bisect
 
 import shadowsocks
-from shadowsocks import common, lru_cache, encrypt
+from shadowsocks import common, lru_cache, encrypt, eventloop
 from shadowsocks.obfsplugin import plain
 from shadowsocks.common import to_bytes, to_str, ord, chr
 
+# one-shot HMAC, it skips building an hmac object for every frame
+if hasattr(hmac, 'digest'):
+    hmac_digest = hmac.digest
+else:
+    def hmac_digest(key, msg, digest):
+        return hmac.new(key, msg, digest).digest()
+
+FRAME_LEN = struct.Struct('<H')
+PACK_ID = struct.Struct('<I')
+
 
 def create_auth_chain_a(method):
     return auth_chain_a(method)
@@ -64,10 +74,10 @@ obfs_map = {
 }
 
 
-class xorshift128plus(object):
-    max_int = (1 << 64) - 1
-    mov_mask = (1 << (64 - 23)) - 1
+XORSHIFT_STATE = struct.Struct('<QQ')
 
+
+class xorshift128plus(object):
     def __init__(self):
         self.v0 = 0
         self.v1 = 0
@@ -76,24 +86,29 @@ class xorshift128plus(object):
         x = self.v0
         y = self.v1
         self.v0 = y
-        x ^= ((x & xorshift128plus.mov_mask) << 23)
-        x ^= (y ^ (x >> 17) ^ (y >> 26)) & xorshift128plus.max_int
+        # x stays below 2 ** 64 here, only the sum needs the 64 bit mask
+        x ^= (x & 0x1FFFFFFFFFF) << 23
+        x ^= y ^ (x >> 17) ^ (y >> 26)
         self.v1 = x
-        return (x + y) & xorshift128plus.max_int
+        return (x + y) & 0xFFFFFFFFFFFFFFFF
 
     def init_from_bin(self, bin):
-        bin += b'\0' * 16
-        self.v0 = struct.unpack('<Q', bin[:8])[0]
-        self.v1 = struct.unpack('<Q', bin[8:16])[0]
+        if len(bin) < 16:
+            bin += b'\0' * 16
+        self.v0, self.v1 = XORSHIFT_STATE.unpack_from(bin)
 
     def init_from_bin_len(self, bin, length):
-        bin += b'\0' * 16
-        bin = struct.pack('<H', length) + bin[2:]
-        self.v0 = struct.unpack('<Q', bin[:8])[0]
-        self.v1 = struct.unpack('<Q', bin[8:16])[0]
-
+        # runs twice for every frame, the four warm up rounds of next()
+        # are inlined on locals
+        if len(bin) < 16:
+            bin += b'\0' * 16
+        x, y = XORSHIFT_STATE.unpack_from(bin)
+        x = (x & 0xFFFFFFFFFFFF0000) | length
         for i in range(4):
-            self.next()
+            x ^= (x & 0x1FFFFFFFFFF) << 23
+            x, y = y, x ^ y ^ (x >> 17) ^ (y >> 26)
+        self.v0 = x
+        self.v1 = y
 
 
 def match_begin(str1, str2):
@@ -145,11 +160,11 @@ class client_queue(object):
         self.back = begin_id + 1
         self.alloc = {}
         self.enable = True
-        self.last_update = time.time()
+        self.last_update = eventloop.clock.now
         self.ref = 0
 
     def update(self):
-        self.last_update = time.time()
+        self.last_update = eventloop.clock.now
 
     def addref(self):
         self.ref += 1
@@ -159,7 +174,7 @@ class client_queue(object):
             self.ref -= 1
 
     def is_active(self):
-        return (self.ref > 0) and (time.time() - self.last_update < 60 * 10)
+        return (self.ref > 0) and (eventloop.clock.now - self.last_update < 60 * 10)
 
     def re_enable(self, connection_id):
         self.enable = True
@@ -204,7 +219,7 @@ class obfs_auth_chain_data(object):
 
     def update(self, user_id, client_id, connection_id):
         if user_id not in self.user_id:
-            self.user_id[user_id] = lru_cache.LRUCache()
+            self.user_id[user_id] = lru_cache.LRUCache(clock=eventloop.clock)
         local_client_id = self.user_id[user_id]
 
         if client_id in local_client_id:
@@ -216,7 +231,7 @@ class obfs_auth_chain_data(object):
 
     def insert(self, user_id, client_id, connection_id):
         if user_id not in self.user_id:
-            self.user_id[user_id] = lru_cache.LRUCache()
+            self.user_id[user_id] = lru_cache.LRUCache(clock=eventloop.clock)
         local_client_id = self.user_id[user_id]
 
         if local_client_id.get(client_id, None) is None or not local_client_id[client_id].enable:
@@ -408,28 +423,33 @@ class auth_chain_a(auth_base):
                          struct.pack('<I', self.server_info.data.connection_id)])
 
     def client_pre_encrypt(self, buf):
-        ret = b''
+        ret = []
         ogn_data_len = len(buf)
         if not self.has_sent_header:
             head_size = self.get_head_size(buf, 30)
             datalen = min(len(buf), random.randint(0, 31) + head_size)
-            ret += self.pack_auth_data(self.auth_data(), buf[:datalen])
+            ret.append(self.pack_auth_data(self.auth_data(), buf[:datalen]))
             buf = buf[datalen:]
             self.has_sent_header = True
-        while len(buf) > self.unit_len:
-            ret += self.pack_client_data(buf[:self.unit_len])
-            buf = buf[self.unit_len:]
-        ret += self.pack_client_data(buf)
-        return ret
+        pos = 0
+        while len(buf) - pos > self.unit_len:
+            ret.append(self.pack_client_data(buf[pos:pos + self.unit_len]))
+            pos += self.unit_len
+        ret.append(self.pack_client_data(buf[pos:]))
+        return b''.join(ret)
 
     def client_post_decrypt(self, buf):
         if self.raw_trans:
             return buf
-        self.recv_buf += buf
-        out_buf = b''
-        while len(self.recv_buf) > 4:
-            mac_key = self.user_key + struct.pack('<I', self.recv_id)
-            data_len = struct.unpack('<H', self.recv_buf[:2])[0] ^ struct.unpack('<H', self.last_server_hash[14:16])[0]
+        # walk the buffer with an offset, the consumed frames are dropped
+        # once at the end instead of after every frame
+        data = self.recv_buf + buf if self.recv_buf else buf
+        view = memoryview(data)
+        out_buf = []
+        pos = 0
+        while len(data) - pos > 4:
+            mac_key = self.user_key + PACK_ID.pack(self.recv_id)
+            data_len = FRAME_LEN.unpack_from(data, pos)[0] ^ FRAME_LEN.unpack_from(self.last_server_hash, 14)[0]
             rand_len = self.rnd_data_len(data_len, self.last_server_hash, self.random_server)
             length = data_len + rand_len
             if length >= 4096:
@@ -437,44 +457,47 @@ class auth_chain_a(auth_base):
                 self.recv_buf = b''
                 raise Exception('client_post_decrypt data error')
 
-            if length + 4 > len(self.recv_buf):
+            if length + 4 > len(data) - pos:
                 break
 
-            server_hash = hmac.new(mac_key, self.recv_buf[:length + 2], self.hashfunc).digest()
-            if server_hash[:2] != self.recv_buf[length + 2: length + 4]:
+            server_hash = hmac_digest(mac_key, view[pos:pos + length + 2], self.hashfunc)
+            if server_hash[:2] != data[pos + length + 2: pos + length + 4]:
                 logging.info('%s: checksum error, data %s'
-                             % (self.no_compatible_method, binascii.hexlify(self.recv_buf[:length])))
+                             % (self.no_compatible_method, binascii.hexlify(data[pos:pos + length])))
                 self.raw_trans = True
                 self.recv_buf = b''
                 raise Exception('client_post_decrypt data uncorrect checksum')
 
-            pos = 2
+            start = pos + 2
             if data_len > 0 and rand_len > 0:
-                pos = 2 + self.rnd_start_pos(rand_len, self.random_server)
-            out_buf += self.encryptor.decrypt(self.recv_buf[pos: data_len + pos])
+                start += self.rnd_start_pos(rand_len, self.random_server)
+            chunk = self.encryptor.decrypt(data[start: start + data_len])
             self.last_server_hash = server_hash
             if self.recv_id == 1:
-                self.server_info.tcp_mss = struct.unpack('<H', out_buf[:2])[0]
-                out_buf = out_buf[2:]
+                self.server_info.tcp_mss = FRAME_LEN.unpack_from(chunk)[0]
+                chunk = chunk[2:]
+            out_buf.append(chunk)
             self.recv_id = (self.recv_id + 1) & 0xFFFFFFFF
-            self.recv_buf = self.recv_buf[length + 4:]
+            pos += length + 4
 
-        return out_buf
+        self.recv_buf = data[pos:]
+        return b''.join(out_buf)
 
     def server_pre_encrypt(self, buf):
         if self.raw_trans:
             return buf
-        ret = b''
+        ret = []
         if self.pack_id == 1:
             tcp_mss = self.server_info.tcp_mss if self.server_info.tcp_mss < 1500 else 1500
             self.server_info.tcp_mss = tcp_mss
             buf = struct.pack('<H', tcp_mss) + buf
             self.unit_len = tcp_mss - self.client_over_head
-        while len(buf) > self.unit_len:
-            ret += self.pack_server_data(buf[:self.unit_len])
-            buf = buf[self.unit_len:]
-        ret += self.pack_server_data(buf)
-        return ret
+        pos = 0
+        while len(buf) - pos > self.unit_len:
+            ret.append(self.pack_server_data(buf[pos:pos + self.unit_len]))
+            pos += self.unit_len
+        ret.append(self.pack_server_data(buf[pos:]))
+        return b''.join(ret)
 
     def server_post_decrypt(self, buf):
         if self.raw_trans:
@@ -547,9 +570,13 @@ class auth_chain_a(auth_base):
             self.has_recv_header = True
             sendback = True
 
-        while len(self.recv_buf) > 4:
-            mac_key = self.user_key + struct.pack('<I', self.recv_id)
-            data_len = struct.unpack('<H', self.recv_buf[:2])[0] ^ struct.unpack('<H', self.last_client_hash[14:16])[0]
+        data = self.recv_buf
+        view = memoryview(data)
+        out_buf = []
+        pos = 0
+        while len(data) - pos > 4:
+            mac_key = self.user_key + PACK_ID.pack(self.recv_id)
+            data_len = FRAME_LEN.unpack_from(data, pos)[0] ^ FRAME_LEN.unpack_from(self.last_client_hash, 14)[0]
             rand_len = self.rnd_data_len(data_len, self.last_client_hash, self.random_client)
             length = data_len + rand_len
             if length >= 4096:
@@ -561,13 +588,13 @@ class auth_chain_a(auth_base):
                 else:
                     raise Exception('server_post_decrype data error')
 
-            if length + 4 > len(self.recv_buf):
+            if length + 4 > len(data) - pos:
                 break
 
-            client_hash = hmac.new(mac_key, self.recv_buf[:length + 2], self.hashfunc).digest()
-            if client_hash[:2] != self.recv_buf[length + 2: length + 4]:
+            client_hash = hmac_digest(mac_key, view[pos:pos + length + 2], self.hashfunc)
+            if client_hash[:2] != data[pos + length + 2: pos + length + 4]:
                 logging.info('%s: checksum error, data %s' % (
-                    self.no_compatible_method, binascii.hexlify(self.recv_buf[:length])
+                    self.no_compatible_method, binascii.hexlify(data[pos:pos + length])
                 ))
                 self.raw_trans = True
                 self.recv_buf = b''
@@ -577,15 +604,18 @@ class auth_chain_a(auth_base):
                     raise Exception('server_post_decrype data uncorrect checksum')
 
             self.recv_id = (self.recv_id + 1) & 0xFFFFFFFF
-            pos = 2
+            start = pos + 2
             if data_len > 0 and rand_len > 0:
-                pos = 2 + self.rnd_start_pos(rand_len, self.random_client)
-            out_buf += self.encryptor.decrypt(self.recv_buf[pos: data_len + pos])
+                start += self.rnd_start_pos(rand_len, self.random_client)
+            out_buf.append(self.encryptor.decrypt(data[start: start + data_len]))
             self.last_client_hash = client_hash
-            self.recv_buf = self.recv_buf[length + 4:]
+            pos += length + 4
             if data_len == 0:
                 sendback = True
 
+        if pos:
+            self.recv_buf = data[pos:]
+        out_buf = b''.join(out_buf)
         if out_buf:
             self.server_info.data.update(self.user_id, self.client_id, self.connection_id)
         return (out_buf, sendback)
@@ -838,3 +868,54 @@ class auth_chain_d(auth_chain_b):
         # random select a size in the leftover data_size_list0
         final_pos = pos + random.next() % (len(self.data_size_list0) - pos)
         return self.data_size_list0[final_pos] - other_data_size
+
+
+def test_xorshift128plus():
+    # the padding of every frame comes from this generator, the output
+    # must match the other implementations bit for bit
+    random = xorshift128plus()
+    random.init_from_bin(hashlib.md5(b'xorshift').digest())
+    assert [random.next() for i in range(6)] == [
+        12039366971204121633, 10303276909576875600, 11913144581466564792,
+        2083602203173288822, 9077670214820860107, 14418904654249833214]
+    random.init_from_bin(b'\x01\x02')
+    assert [random.next() for i in range(3)] == [
+        4303389249, 8606778434, 36099174371987969]
+    random.init_from_bin_len(hashlib.md5(b'xorshift').digest(), 1000)
+    assert [random.next() for i in range(3)] == [
+        9077949390419702681, 13847273240687588361, 15123235667736182216]
+
+
+def test_rnd_data_len():
+    from shadowsocks import obfs
+    sizes = (0, 1, 100, 500, 1000, 1299, 1350, 1439, 1440, 2000)
+    # (rnd_data_len, rnd_start_pos) for each size
+    expected = {
+        'auth_chain_a': [(234, 176), (370, 37), (305, 70), (410, 29), (71, 26),
+                         (32, 1), (20, 7), (15, 10), (5, 4), (0, 0)],
+        'auth_chain_b': [(11, 0), (163, 137), (462, 164), (583, 221), (0, 0),
+                         (0, 0), (0, 0), (0, 0), (0, 0), (0, 0)],
+        'auth_chain_c': [(118, 28), (561, 508), (680, 5), (62, 5), (156, 111),
+                         (23, 6), (20, 7), (0, 0), (0, 0), (0, 0)],
+        'auth_chain_d': [(449, 338), (1382, 565), (173, 129), (299, 159),
+                         (83, 49), (84, 61), (33, 7), (0, 0), (0, 0), (0, 0)],
+    }
+    random = xorshift128plus()
+    for name in sorted(expected):
+        protocol = obfs_map[name][0](name)
+        info = obfs.server_info(protocol.init_data())
+        info.protocol_param = ''
+        info.key = hashlib.md5(b'key').digest()
+        info.overhead = 4
+        protocol.set_server_info(info)
+        got = []
+        for size in sizes:
+            last_hash = hashlib.md5(b'%d' % size).digest()
+            rand_len = protocol.rnd_data_len(size, last_hash, random)
+            got.append((rand_len, protocol.rnd_start_pos(rand_len, random)))
+        assert got == expected[name], name
+
+
+if __name__ == '__main__':
+    test_xorshift128plus()
+    test_rnd_data_len()
@@ -27,7 +27,7 @@ import base64
 import datetime
 import random
 
-from shadowsocks import common
+from shadowsocks import common, eventloop
 from shadowsocks.obfsplugin import plain
 from shadowsocks.common import to_bytes, to_str, ord, chr
 
@@ -49,6 +49,12 @@ obfs_map = {
         'random_head_compatible': (create_random_head_obfs,),
 }
 
+# the largest request header we wait for
+MAX_HEADER_SIZE = 65536
+# bytes of an unfinished header a connection may send per second before it
+# is cut off, a real client sends its whole header in the first packet
+HEADER_BYTES_PER_SECOND = 16384
+
 def match_begin(str1, str2):
     if len(str1) >= len(str2):
         if str1[:len(str2)] == str2:
@@ -62,7 +68,11 @@ class http_simple(plain.plain):
         self.has_recv_header = False
         self.host = None
         self.port = 0
-        self.recv_buffer = b''
+        self.recv_buffer = bytearray()
+        # where the search for the end of the header resumes
+        self.recv_scan_pos = 0
+        self.header_window = 0
+        self.header_window_bytes = 0
         # TODO user config user_agent
         self.user_agent = [b"Mozilla/5.0 (Windows NT 6.3; WOW64; rv:40.0) Gecko/20100101 Firefox/40.0",
             b"Mozilla/5.0 (Windows NT 6.3; WOW64; rv:40.0) Gecko/20100101 Firefox/44.0",
@@ -136,31 +146,26 @@ class http_simple(plain.plain):
         self.has_sent_header = True
         return header + buf
 
-    def get_data_from_http_header(self, buf):
-        ret_buf = b''
-        lines = buf.split(b'\r\n')
-        if lines and len(lines) > 1:
-            hex_items = lines[0].split(b'%')
-            if hex_items and len(hex_items) > 1:
-                for index in range(1, len(hex_items)):
-                    if len(hex_items[index]) < 2:
-                        ret_buf += binascii.unhexlify('0' + hex_items[index])
-                        break
-                    elif len(hex_items[index]) > 2:
-                        ret_buf += binascii.unhexlify(hex_items[index][:2])
-                        break
-                    else:
-                        ret_buf += binascii.unhexlify(hex_items[index])
-                return ret_buf
-        return b''
-
-    def get_host_from_http_header(self, buf):
-        ret_buf = b''
-        lines = buf.split(b'\r\n')
-        if lines and len(lines) > 1:
-            for line in lines:
-                if match_begin(line, b"Host: "):
-                    return common.to_str(line[6:])
+    def parse_http_header(self, head):
+        # the data hex encoded in the request line and the Host, one pass
+        # over the header lines
+        lines = head.split(b'\r\n')
+        hex_items = lines[0].split(b'%')
+        data = []
+        for item in hex_items[1:]:
+            if len(item) < 2:
+                data.append(b'0' + item)
+                break
+            elif len(item) > 2:
+                data.append(item[:2])
+                break
+            data.append(item)
+        host = None
+        for line in lines[1:]:
+            if match_begin(line, b"Host: "):
+                host = common.to_str(line[6:])
+                break
+        return binascii.unhexlify(b''.join(data)), host
 
     def not_match_return(self, buf):
         self.has_sent_header = True
@@ -174,47 +179,63 @@ class http_simple(plain.plain):
         self.has_recv_header = True
         return (b'E'*2048, False, False)
 
+    def header_rate_exceeded(self, size):
+        now = int(eventloop.clock.now)
+        if now != self.header_window:
+            self.header_window = now
+            self.header_window_bytes = 0
+        self.header_window_bytes += size
+        return self.header_window_bytes > HEADER_BYTES_PER_SECOND
+
     def server_decode(self, buf):
         if self.has_recv_header:
             return (buf, True, False)
 
         self.recv_buffer += buf
+        read_len = len(buf)
         buf = self.recv_buffer
         if len(buf) > 10:
             if match_begin(buf, b'GET ') or match_begin(buf, b'POST '):
-                if len(buf) > 65536:
+                if len(buf) > MAX_HEADER_SIZE:
                     self.recv_buffer = None
                     logging.warn('http_simple: over size')
-                    return self.not_match_return(buf)
+                    return self.not_match_return(bytes(buf))
             else: #not http header, run on original protocol
                 self.recv_buffer = None
                 logging.debug('http_simple: not match begin')
-                return self.not_match_return(buf)
+                return self.not_match_return(bytes(buf))
         else:
             return (b'', True, False)
 
-        if b'\r\n\r\n' in buf:
-            datas = buf.split(b'\r\n\r\n', 1)
-            ret_buf = self.get_data_from_http_header(buf)
-            host = self.get_host_from_http_header(buf)
-            if host and self.server_info.obfs_param:
-                pos = host.find(":")
-                if pos >= 0:
-                    host = host[:pos]
-                hosts = self.server_info.obfs_param.split(',')
-                if host not in hosts:
-                    return self.not_match_return(buf)
-            if len(ret_buf) < 4:
-                return self.error_return(buf)
-            if len(datas) > 1:
-                ret_buf += datas[1]
-            if len(ret_buf) >= 13:
-                self.has_recv_header = True
-                return (ret_buf, True, False)
-            return self.not_match_return(buf)
-        else:
+        # only the new bytes and the three before them can complete the
+        # terminator, a header trickled in byte by byte stays linear
+        pos = buf.find(b'\r\n\r\n', self.recv_scan_pos)
+        if pos < 0:
+            self.recv_scan_pos = len(buf) - 3
+            if self.header_rate_exceeded(read_len):
+                self.recv_buffer = None
+                logging.warn('http_simple: header sent too fast')
+                return self.error_return(bytes(buf))
             return (b'', True, False)
 
+        buf = bytes(buf)
+        self.recv_buffer = None
+        ret_buf, host = self.parse_http_header(buf[:pos])
+        if host and self.server_info.obfs_param:
+            pos_port = host.find(":")
+            if pos_port >= 0:
+                host = host[:pos_port]
+            hosts = self.server_info.obfs_param.split(',')
+            if host not in hosts:
+                return self.not_match_return(buf)
+        if len(ret_buf) < 4:
+            return self.error_return(buf)
+        ret_buf += buf[pos + 4:]
+        if len(ret_buf) >= 13:
+            self.has_recv_header = True
+            return (ret_buf, True, False)
+        return self.not_match_return(buf)
+
 class http_post(http_simple):
     def __init__(self, method):
         super(http_post, self).__init__(method)
@@ -313,3 +334,46 @@ class random_head(plain.plain):
         # (buffer_to_recv, is_need_decrypt, is_need_to_encode_and_send_back)
         return (b'', False, True)
 
+
+
+def test_server_decode():
+    from shadowsocks import obfs
+
+    def create(method):
+        protocol = obfs_map[method][0](method)
+        info = obfs.server_info(b'')
+        info.obfs_param = 'a.com'
+        info.host = 'a.com'
+        info.port = 8080
+        info.iv = b'\0' * 16
+        info.head_len = 30
+        protocol.set_server_info(info)
+        return protocol
+
+    data = os.urandom(300)
+    for method in ('http_simple', 'http_post'):
+        wire = create(method).client_encode(data)
+        assert create(method).server_decode(wire) == (data, True, False)
+        server = create(method)
+        out = [server.server_decode(wire[i:i + 1])[0]
+               for i in range(len(wire))]
+        assert b''.join(out) == data
+
+    # an unfinished header is waited for up to the rate cap, past it the
+    # connection is cut off. The clock stays put so it is all one second
+    eventloop.clock.now = float(int(eventloop.clock.now))
+    try:
+        server = create('http_simple_compatible')
+        head = b'GET /%00%01 HTTP/1.1\r\n'
+        assert server.server_decode(head) == (b'', True, False)
+        assert server.server_decode(
+            b'a' * (HEADER_BYTES_PER_SECOND - len(head))) == (b'', True, False)
+        assert not server.has_recv_header
+        assert server.server_decode(b'a') == (b'E' * 2048, False, False)
+        assert server.has_recv_header
+    finally:
+        eventloop.clock.update()
+
+
+if __name__ == '__main__':
+    test_server_decode()
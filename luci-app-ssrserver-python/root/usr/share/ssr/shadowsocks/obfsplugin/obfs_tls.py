@@ -33,7 +33,7 @@ import string
 from shadowsocks import common
 from shadowsocks.obfsplugin import plain
 from shadowsocks.common import to_bytes, to_str, ord
-from shadowsocks import lru_cache
+from shadowsocks import lru_cache, eventloop
 
 def create_tls_ticket_auth_obfs(method):
     return tls_ticket_auth(method)
@@ -53,7 +53,7 @@ def match_begin(str1, str2):
 
 class obfs_auth_data(object):
     def __init__(self):
-        self.client_data = lru_cache.LRUCache(60 * 5)
+        self.client_data = lru_cache.LRUCache(60 * 5, clock=eventloop.clock)
         self.client_id = os.urandom(32)
         self.startup_time = int(time.time() - 60 * 30) & 0xFFFFFFFF
         self.ticket_buf = {}
@@ -30,7 +30,7 @@ if __name__ == '__main__':
     sys.path.insert(0, os.path.join(file_path, '../'))
 
 from shadowsocks import shell, daemon, eventloop, tcprelay, udprelay, \
-    asyncdns, manager, common
+    asyncdns, manager, common, workers
 
 
 def main():
@@ -68,9 +68,76 @@ def main():
         manager.run(config)
         return
 
+    if int(config['workers']) > 1 and config['reuse_port'] and \
+            os.name == 'posix':
+        run_workers(config)
+    else:
+        run(config)
+
+
+def run_workers(config):
+    # each worker binds its own sockets with SO_REUSEPORT and the kernel
+    # balances connections between them, the workers count their transfer
+    # into a shared table the master reads
+    transfer_table = workers.TransferTable(int(config['workers']),
+                                           int(config['transfer_slots']))
+
+    def worker(index, sock):
+        worker_config = config.copy()
+        worker_config['workers'] = 1
+        transfer_table.attach(index)
+        run(worker_config, sock, transfer_table)
+
+    children = workers.fork_workers(int(config['workers']), worker)
+    loop = eventloop.EventLoop()
+    channels = []
+
+    def on_close(channel):
+        logging.warn('a worker exited')
+        channels.remove(channel)
+        if not channels:
+            loop.stop()
+
+    def log_transfer():
+        total = transfer_table.snapshot()
+        for port in total:
+            logging.debug('transfer of %d: u %d d %d' %
+                          (port, total[port][0], total[port][1]))
+
+    for index, (pid, sock) in enumerate(children):
+        channel = workers.Channel(sock, None, on_close)
+        channel.add_to_loop(loop)
+        channels.append(channel)
+    loop.add_periodic(log_transfer)
+
+    def handler(signum, _):
+        for pid, _ in children:
+            try:
+                os.kill(pid, signum)
+                os.waitpid(pid, 0)
+            except OSError:  # child may already exited
+                pass
+        sys.exit()
+
+    signal.signal(signal.SIGTERM, handler)
+    signal.signal(signal.SIGQUIT, handler)
+    signal.signal(signal.SIGINT, handler)
+
+    loop.run()
+    for pid, _ in children:
+        try:
+            os.waitpid(pid, 0)
+        except OSError:
+            pass
+
+
+def run(config, channel_sock=None, transfer_table=None):
     tcp_servers = []
     udp_servers = []
-    dns_resolver = asyncdns.DNSResolver(config['black_hostname_list'])
+    dns_resolver = asyncdns.DNSResolver(config['black_hostname_list'],
+                                        config['dns_min_ttl'],
+                                        config['dns_max_ttl'],
+                                        config['dns_negative_ttl'])
     if int(config['workers']) > 1:
         stat_counter_dict = None
     else:
@@ -123,8 +190,10 @@ def main():
                 a_config['server'] = a_config['server_ipv6']
                 logging.info("starting server at [%s]:%d" %
                              (a_config['server'], int(port)))
-                tcp_servers.append(tcprelay.TCPRelay(a_config, dns_resolver, False, stat_counter=stat_counter_dict))
-                udp_servers.append(udprelay.UDPRelay(a_config, dns_resolver, False, stat_counter=stat_counter_dict))
+                tcp_servers.append(tcprelay.TCPRelay(a_config, dns_resolver, False, stat_counter=stat_counter_dict,
+                                                     transfer_table=transfer_table))
+                udp_servers.append(udprelay.UDPRelay(a_config, dns_resolver, False, stat_counter=stat_counter_dict,
+                                                     transfer_table=transfer_table))
                 if a_config['server_ipv6'] == b"::":
                     ipv6_ok = True
             except Exception as e:
@@ -143,8 +212,10 @@ def main():
             a_config['out_bindv6'] = bindv6
             logging.info("starting server at %s:%d" %
                          (a_config['server'], int(port)))
-            tcp_servers.append(tcprelay.TCPRelay(a_config, dns_resolver, False, stat_counter=stat_counter_dict))
-            udp_servers.append(udprelay.UDPRelay(a_config, dns_resolver, False, stat_counter=stat_counter_dict))
+            tcp_servers.append(tcprelay.TCPRelay(a_config, dns_resolver, False, stat_counter=stat_counter_dict,
+                                                 transfer_table=transfer_table))
+            udp_servers.append(udprelay.UDPRelay(a_config, dns_resolver, False, stat_counter=stat_counter_dict,
+                                                 transfer_table=transfer_table))
         except Exception as e:
             if not ipv6_ok:
                 shell.print_exception(e)
@@ -164,9 +235,15 @@ def main():
         signal.signal(signal.SIGINT, int_handler)
 
         try:
-            loop = eventloop.EventLoop()
+            loop = eventloop.EventLoop(config['edge_triggered'],
+                                       config['max_events'])
             dns_resolver.add_to_loop(loop)
             list(map(lambda s: s.add_to_loop(loop), tcp_servers + udp_servers))
+            if channel_sock is not None:
+                # a SO_REUSEPORT worker, stop when the master goes away
+                channel = workers.Channel(channel_sock, lambda msg: None,
+                                          lambda c: loop.stop())
+                channel.add_to_loop(loop)
 
             daemon.set_user(config.get('user', None))
             loop.run()
@@ -23,8 +23,10 @@ import json
 import sys
 import getopt
 import logging
+import tempfile
 from shadowsocks.common import to_bytes, to_str, IPNetwork, PortRange
 from shadowsocks import encrypt
+from shadowsocks.crypto import table
 
 VERBOSE_LEVEL = 5
 
@@ -120,6 +122,10 @@ def check_config(config, is_local):
     if config.get('timeout', 300) > 600:
         logging.warning('warning: your timeout %d seems too long' %
                         int(config.get('timeout')))
+    if config.get('buffer_low_watermark', 0) > \
+            config.get('buffer_high_watermark', 0):
+        logging.warning('warning: buffer_low_watermark is above '
+                        'buffer_high_watermark, using the high one')
     if config.get('password') in [b'mypassword']:
         logging.error('DON\'T USE DEFAULT PASSWORD! Please change it in your '
                       'config.json!')
@@ -145,7 +151,8 @@ def get_config(is_local):
     else:
         shortopts = 'hd:s:p:k:m:O:o:G:g:c:t:vq'
         longopts = ['help', 'fast-open', 'pid-file=', 'log-file=', 'workers=',
-                    'forbidden-ip=', 'user=', 'manager-address=', 'version']
+                    'reuse-port', 'forbidden-ip=', 'user=', 'manager-address=',
+                    'version', 'bench-ciphers', 'bench-ciphers-json']
     try:
         optlist, args = getopt.getopt(sys.argv[1:], shortopts, longopts)
         for key, value in optlist:
@@ -157,6 +164,9 @@ def get_config(is_local):
             elif key == '--version':
                 print_shadowsocks()
                 sys.exit(0)
+            elif key in ('--bench-ciphers', '--bench-ciphers-json'):
+                print_bench_ciphers(key == '--bench-ciphers-json')
+                sys.exit(0)
             else:
                 continue
 
@@ -204,6 +214,8 @@ def get_config(is_local):
                 config['fast_open'] = True
             elif key == '--workers':
                 config['workers'] = int(value)
+            elif key == '--reuse-port':
+                config['reuse_port'] = True
             elif key == '--manager-address':
                 config['manager_address'] = value
             elif key == '--user':
@@ -246,6 +258,14 @@ def get_config(is_local):
     config['udp_cache'] = int(config.get('udp_cache', 64))
     config['fast_open'] = config.get('fast_open', False)
     config['workers'] = config.get('workers', 1)
+    config['transfer_slots'] = int(config.get('transfer_slots', 4096))
+    config['reuse_port'] = config.get('reuse_port', False)
+    config['edge_triggered'] = config.get('edge_triggered', False)
+    config['max_events'] = int(config.get('max_events', -1))
+    config['buffer_high_watermark'] = int(config.get('buffer_high_watermark', 64))
+    config['buffer_low_watermark'] = int(config.get('buffer_low_watermark', 16))
+    config['table_cache_dir'] = to_str(config.get('table_cache_dir',
+        os.path.join(tempfile.gettempdir(), 'ssr-table-cache')))
     config['pid-file'] = config.get('pid-file', '/var/run/shadowsocksr.pid')
     config['log-file'] = config.get('log-file', '/var/log/shadowsocksr.log')
     config['verbose'] = config.get('verbose', False)
@@ -261,6 +281,9 @@ def get_config(is_local):
             config['server'] = to_str(config['server'])
     else:
         config['server'] = to_str(config.get('server', '0.0.0.0'))
+        config['dns_min_ttl'] = int(config.get('dns_min_ttl', 10))
+        config['dns_max_ttl'] = int(config.get('dns_max_ttl', 3600))
+        config['dns_negative_ttl'] = int(config.get('dns_negative_ttl', 60))
         config['black_hostname_list'] = to_str(config.get('black_hostname_list', '')).split(',')
         if len(config['black_hostname_list']) == 1 and config['black_hostname_list'][0] == '':
             config['black_hostname_list'] = []
@@ -300,6 +323,7 @@ def get_config(is_local):
                         format='%(asctime)s %(levelname)-8s %(filename)s:%(lineno)s %(message)s',
                         datefmt='%Y-%m-%d %H:%M:%S')
 
+    table.set_cache_dir(config['table_cache_dir'])
     check_config(config, is_local)
 
     return config
@@ -360,8 +384,12 @@ Proxy options:
   -t TIMEOUT             timeout in seconds, default: 300
   --fast-open            use TCP_FASTOPEN, requires Linux 3.7+
   --workers WORKERS      number of workers, available on Unix/Linux
+  --reuse-port           workers bind their own sockets with SO_REUSEPORT
   --forbidden-ip IPLIST  comma seperated IP list forbidden to connect
   --manager-address ADDR optional server manager UDP address, see wiki
+  --bench-ciphers        time every encryption method on this machine and
+                         print them fastest first
+  --bench-ciphers-json   the same as JSON
 
 General options:
   -h, --help             show this help message and exit
@@ -377,6 +405,23 @@ Online help: <https://github.com/shadowsocks/shadowsocks>
 ''')
 
 
+def print_bench_ciphers(as_json=False):
+    results = encrypt.bench_ciphers()
+    if as_json:
+        print(json.dumps(results, indent=4))
+        return
+    sizes = encrypt.BENCH_SIZES
+    print('rank  %-24s' % 'method' +
+          ''.join('%9s' % ('%d B' % size) for size in sizes) +
+          '    score  (MB/s)')
+    for i, r in enumerate(results):
+        method = r['method'] + (' *' if r['aead'] else '')
+        print('%4d  %-24s' % (i + 1, method) +
+              ''.join('%9.1f' % (r['speed'][size] / 1e6) for size in sizes) +
+              '%9.1f' % (r['score'] / 1e6))
+    print('* AEAD, authenticated without an auth_* protocol')
+
+
 def _decode_list(data):
     rv = []
     for item in data:
@@ -18,7 +18,7 @@
 from __future__ import absolute_import, division, print_function, \
     with_statement
 
-import time
+import os
 import socket
 import errno
 import struct
@@ -28,13 +28,11 @@ import traceback
 import random
 import platform
 import threading
+import collections
 
-from shadowsocks import encrypt, obfs, eventloop, shell, common, lru_cache, version
+from shadowsocks import encrypt, obfs, eventloop, shell, common, version
 from shadowsocks.common import pre_parse_header, parse_header
 
-# we clear at most TIMEOUTS_CLEAN_SIZE timeouts each time
-TIMEOUTS_CLEAN_SIZE = 512
-
 MSG_FASTOPEN = 0x20000000
 
 # SOCKS command definition
@@ -93,12 +91,72 @@ WAIT_STATUS_READWRITING = WAIT_STATUS_READING | WAIT_STATUS_WRITING
 NETWORK_MTU = 1500
 TCP_MSS = NETWORK_MTU - 40
 BUF_SIZE = 32 * 1024
+# edge-triggered mode: reads per event before giving other sockets a turn
+EDGE_READ_BATCH = 16
 UDP_MAX_BUF_SIZE = 65536
+# queued KB above which the other side of a stream stops being read, it is
+# read again once the queue has drained below the low watermark; defaults of
+# buffer_high_watermark and buffer_low_watermark
+WRITE_HIGH_WATERMARK = 64
+WRITE_LOW_WATERMARK = 16
+# buffers handed to one sendmsg, well below IOV_MAX everywhere
+SENDMSG_MAX_BUFS = 64
+# bytes moved per splice, the default capacity of a pipe
+SPLICE_SIZE = 64 * 1024
+SPLICE_FLAGS = getattr(os, 'SPLICE_F_MOVE', 0) | \
+    getattr(os, 'SPLICE_F_NONBLOCK', 0)
+# happy eyeballs (rfc8305): seconds the first address gets to connect before
+# an address of the other family is tried alongside it
+CONNECT_ATTEMPT_DELAY = 0.25
+
+class WriteQueue(object):
+    # data waiting for a socket to become writable, flushed with a single
+    # sendmsg; what was sent of the first buffer is kept as an offset so
+    # a partial send never copies the rest
+    def __init__(self):
+        self._bufs = collections.deque()
+        self._offset = 0
+        self.size = 0
+
+    def __len__(self):
+        return len(self._bufs)
+
+    def append(self, data):
+        if data:
+            self._bufs.append(data)
+            self.size += len(data)
+
+    def flush(self, sock):
+        # send as much as the socket takes, EAGAIN is raised to the caller
+        first = memoryview(self._bufs[0])[self._offset:]
+        if len(self._bufs) == 1 or not hasattr(sock, 'sendmsg'):
+            sent = sock.send(first)
+        else:
+            bufs = [first]
+            for i in range(1, min(len(self._bufs), SENDMSG_MAX_BUFS)):
+                bufs.append(self._bufs[i])
+            sent = sock.sendmsg(bufs)
+        self.size -= sent
+        sent += self._offset
+        while self._bufs and sent >= len(self._bufs[0]):
+            sent -= len(self._bufs.popleft())
+        self._offset = sent
+        return self.size
+
+    def pop_all(self):
+        # take the unsent buffers out of the queue
+        bufs = list(self._bufs)
+        if bufs and self._offset:
+            bufs[0] = bufs[0][self._offset:]
+        self._bufs.clear()
+        self._offset = 0
+        self.size = 0
+        return bufs
 
 class SpeedTester(object):
     def __init__(self, max_speed = 0):
         self.max_speed = max_speed * 1024
-        self.last_time = time.time()
+        self.last_time = eventloop.clock.now
         self.sum_len = 0
 
     def update_limit(self, max_speed):
@@ -106,7 +164,7 @@ class SpeedTester(object):
 
     def add(self, data_len):
         if self.max_speed > 0:
-            cut_t = time.time()
+            cut_t = eventloop.clock.now
             self.sum_len -= (cut_t - self.last_time) * self.max_speed
             if self.sum_len < 0:
                 self.sum_len = 0
@@ -115,7 +173,7 @@ class SpeedTester(object):
 
     def isExceed(self):
         if self.max_speed > 0:
-            cut_t = time.time()
+            cut_t = eventloop.clock.now
             self.sum_len -= (cut_t - self.last_time) * self.max_speed
             if self.sum_len < 0:
                 self.sum_len = 0
@@ -123,6 +181,12 @@ class SpeedTester(object):
             return self.sum_len >= self.max_speed
         return False
 
+    def wait_time(self):
+        # seconds until isExceed() turns False again
+        if self.max_speed > 0 and self.sum_len >= self.max_speed:
+            return (self.sum_len - self.max_speed) / self.max_speed + 0.001
+        return 0
+
 class TCPRelayHandler(object):
     def __init__(self, server, fd_to_handlers, loop, local_sock, config,
                  dns_resolver, is_local):
@@ -135,6 +199,11 @@ class TCPRelayHandler(object):
         self._local_sock_fd = None
         self._remote_sock_fd = None
         self._remotev6_sock_fd = None
+        # happy eyeballs: the connect to the other address family, and
+        # (hostname, port, family) of the first one until it is started
+        self._remote_sock_alt = None
+        self._remote_alt_sock_fd = None
+        self._connect_race = None
         self._remote_udp = False
         self._config = config
         self._dns_resolver = dns_resolver
@@ -156,6 +225,14 @@ class TCPRelayHandler(object):
         self._protocol = obfs.obfs(config['protocol'])
         self._overhead = self._obfs.get_overhead(self._is_local) + self._protocol.get_overhead(self._is_local)
         self._recv_buffer_size = BUF_SIZE - self._overhead
+        # with no cipher, obfs or protocol the stream passes through as it
+        # is, and once it does the bytes can stay in the kernel
+        self._can_splice = hasattr(os, 'splice') and \
+            common.to_str(self._encryptor.method) == 'none' and \
+            common.to_str(config['obfs']) in ('plain', 'origin') and \
+            common.to_str(config['protocol']) in ('plain', 'origin')
+        self._splice_pipes = None
+        self._splice_pending = [0, 0]
 
         server_info = obfs.server_info(server.obfs_data)
         server_info.host = config['server']
@@ -202,8 +279,8 @@ class TCPRelayHandler(object):
         self._ignore_bind_list = config.get('ignore_bind', [])
 
         self._fastopen_connected = False
-        self._data_to_write_to_local = []
-        self._data_to_write_to_remote = []
+        self._data_to_write_to_local = WriteQueue()
+        self._data_to_write_to_remote = WriteQueue()
         self._udp_data_send_buffer = b''
         self._upstream_status = WAIT_STATUS_READING
         self._downstream_status = WAIT_STATUS_INIT
@@ -215,7 +292,7 @@ class TCPRelayHandler(object):
             self._chosen_server = self._get_a_server()
 
         self.last_activity = 0
-        self._update_activity()
+        self._server.add_handler(self)
         self._server.add_connection(1)
         self._server.stat_add(self._client_address[0], 1)
         self._add_ref = 1
@@ -223,6 +300,15 @@ class TCPRelayHandler(object):
         self.speed_tester_d = SpeedTester(config.get("speed_limit_per_con", 0))
         self._recv_u_max_size = BUF_SIZE
         self._recv_d_max_size = BUF_SIZE
+        self._throttled_u = False
+        self._throttled_d = False
+        self._write_high = int(config.get('buffer_high_watermark', WRITE_HIGH_WATERMARK)) * 1024
+        self._write_low = min(int(config.get('buffer_low_watermark', WRITE_LOW_WATERMARK)) * 1024,
+                              self._write_high)
+        # edge-triggered: the events each socket waits for, by fd
+        self._edge = loop.edge_triggered
+        self._events = {}
+        self._recv_more = False
         self._recv_pack_id = 0
         self._udp_send_pack_id = 0
         self._udpv6_send_pack_id = 0
@@ -231,7 +317,7 @@ class TCPRelayHandler(object):
         local_sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
         self._local_sock_fd = local_sock.fileno()
         fd_to_handlers[self._local_sock_fd] = self
-        loop.add(local_sock, eventloop.POLL_IN | eventloop.POLL_ERR, self._server)
+        self._add_to_loop(local_sock, eventloop.POLL_IN | eventloop.POLL_ERR)
         self._stage = STAGE_INIT
 
     def __hash__(self):
@@ -301,22 +387,91 @@ class TCPRelayHandler(object):
                 self._upstream_status = status
                 dirty = True
         if dirty:
-            if self._local_sock:
-                event = eventloop.POLL_ERR
-                if self._downstream_status & WAIT_STATUS_WRITING:
-                    event |= eventloop.POLL_OUT
-                if self._upstream_status & WAIT_STATUS_READING:
-                    event |= eventloop.POLL_IN
-                self._loop.modify(self._local_sock, event)
-            if self._remote_sock:
-                event = eventloop.POLL_ERR
-                if self._downstream_status & WAIT_STATUS_READING:
-                    event |= eventloop.POLL_IN
-                if self._upstream_status & WAIT_STATUS_WRITING:
-                    event |= eventloop.POLL_OUT
-                self._loop.modify(self._remote_sock, event)
-                if self._remote_sock_v6:
-                    self._loop.modify(self._remote_sock_v6, event)
+            self._update_poll()
+
+    def _update_poll(self):
+        # register the events we wait for, a throttled stream isn't read
+        if self._local_sock:
+            event = eventloop.POLL_ERR
+            if self._downstream_status & WAIT_STATUS_WRITING:
+                event |= eventloop.POLL_OUT
+            if self._upstream_status & WAIT_STATUS_READING and \
+                    not self._throttled_u:
+                event |= eventloop.POLL_IN
+            self._set_events(self._local_sock, event)
+        if self._remote_sock:
+            event = eventloop.POLL_ERR
+            if self._downstream_status & WAIT_STATUS_READING and \
+                    not self._throttled_d:
+                event |= eventloop.POLL_IN
+            if self._upstream_status & WAIT_STATUS_WRITING:
+                event |= eventloop.POLL_OUT
+            self._set_events(self._remote_sock, event)
+            if self._remote_sock_v6:
+                self._set_events(self._remote_sock_v6, event)
+
+    def _add_to_loop(self, sock, event):
+        if self._edge:
+            # registered once for everything, we filter by self._events
+            self._events[sock.fileno()] = event
+            event = eventloop.POLL_IN | eventloop.POLL_OUT | \
+                eventloop.POLL_ERR | eventloop.POLL_EDGE
+        self._loop.add(sock, event, self._server)
+
+    def _set_events(self, sock, event):
+        if not self._edge:
+            self._loop.modify(sock, event)
+            return
+        fd = sock.fileno()
+        kick = event & ~self._events.get(fd, 0) & \
+            (eventloop.POLL_IN | eventloop.POLL_OUT)
+        self._events[fd] = event
+        if kick:
+            # the edge may already have passed while we weren't listening
+            self._loop.call_later(0, lambda: self._on_kick(sock, fd, kick))
+
+    def _on_kick(self, sock, fd, event):
+        if self._stage != STAGE_DESTROYED and fd in self._events:
+            self.handle_event(sock, fd, event)
+
+    def _check_speed(self, stream):
+        # throttle the stream and return False when over the speed limit
+        if stream == STREAM_UP:
+            speed_testers = (self.speed_tester_u, self._server.speed_tester_u(self._user_id))
+        else:
+            speed_testers = (self.speed_tester_d, self._server.speed_tester_d(self._user_id))
+        if not any([t.isExceed() for t in speed_testers]):
+            return True
+        if stream == STREAM_UP:
+            self._recv_u_max_size = self._tcp_mss - self._overhead
+        else:
+            self._recv_d_max_size = self._tcp_mss - self._overhead
+        self._throttle(stream, speed_testers)
+        return False
+
+    def _throttle(self, stream, speed_testers):
+        # the token bucket is empty, stop polling the reading side of the
+        # stream and re-arm it when the bucket has refilled
+        if stream == STREAM_UP:
+            if self._throttled_u:
+                return
+            self._throttled_u = True
+        else:
+            if self._throttled_d:
+                return
+            self._throttled_d = True
+        self._update_poll()
+        delay = max([t.wait_time() for t in speed_testers])
+        self._loop.call_later(delay, lambda: self._unthrottle(stream))
+
+    def _unthrottle(self, stream):
+        if self._stage == STAGE_DESTROYED:
+            return
+        if stream == STREAM_UP:
+            self._throttled_u = False
+        else:
+            self._throttled_d = False
+        self._update_poll()
 
     def _write_to_sock(self, data, sock):
         # write data to sock
@@ -324,7 +479,6 @@ class TCPRelayHandler(object):
         # and update the stream to wait for writing
         if not sock:
             return False
-        uncomplete = False
         if self._remote_udp and sock == self._remote_sock:
             try:
                 self._udp_data_send_buffer += data
@@ -362,63 +516,80 @@ class TCPRelayHandler(object):
                 #trace = traceback.format_exc()
                 #logging.error(trace)
                 error_no = eventloop.errno_from_exception(e)
-                if error_no in (errno.EAGAIN, errno.EINPROGRESS,
-                                errno.EWOULDBLOCK):
-                    uncomplete = True
-                else:
+                if error_no not in (errno.EAGAIN, errno.EINPROGRESS,
+                                    errno.EWOULDBLOCK):
                     shell.print_exception(e)
                     logging.error("exception from %s:%d" % (self._client_address[0], self._client_address[1]))
                     self.destroy()
                     return False
             return True
+        if sock == self._local_sock:
+            stream, queue = STREAM_DOWN, self._data_to_write_to_local
+        elif sock == self._remote_sock:
+            stream, queue = STREAM_UP, self._data_to_write_to_remote
         else:
-            try:
-                if self._encrypt_correct:
-                    if sock == self._remote_sock:
-                        self._server.add_transfer_u(self._user, len(data))
-                self._update_activity(len(data))
-                if data:
-                    l = len(data)
-                    s = sock.send(data)
-                    if s < l:
-                        data = data[s:]
-                        uncomplete = True
-                else:
-                    return
-            except (OSError, IOError) as e:
-                error_no = eventloop.errno_from_exception(e)
-                if error_no in (errno.EAGAIN, errno.EINPROGRESS,
+            logging.error('write_all_to_sock:unknown socket from %s:%d' % (self._client_address[0], self._client_address[1]))
+            return False
+        if self._encrypt_correct:
+            if sock == self._remote_sock:
+                self._server.add_transfer_u(self._user, len(data))
+        self._update_activity(len(data))
+        if not data:
+            return
+        # behind data that is already waiting, it goes out when that does
+        queue.append(data)
+        if len(queue) == 1 and not self._flush(queue, sock):
+            return False
+        self._update_write_stream(stream, queue)
+        return True
+
+    def _flush(self, queue, sock):
+        try:
+            queue.flush(sock)
+        except (OSError, IOError) as e:
+            error_no = eventloop.errno_from_exception(e)
+            if error_no not in (errno.EAGAIN, errno.EINPROGRESS,
                                 errno.EWOULDBLOCK):
-                    uncomplete = True
-                else:
-                    #traceback.print_exc()
-                    shell.print_exception(e)
-                    logging.error("exception from %s:%d" % (self._client_address[0], self._client_address[1]))
-                    self.destroy()
-                    return False
-            except Exception as e:
+                #traceback.print_exc()
                 shell.print_exception(e)
                 logging.error("exception from %s:%d" % (self._client_address[0], self._client_address[1]))
                 self.destroy()
                 return False
-        if uncomplete:
-            if sock == self._local_sock:
-                self._data_to_write_to_local.append(data)
-                self._update_stream(STREAM_DOWN, WAIT_STATUS_WRITING)
-            elif sock == self._remote_sock:
-                self._data_to_write_to_remote.append(data)
-                self._update_stream(STREAM_UP, WAIT_STATUS_WRITING)
-            else:
-                logging.error('write_all_to_sock:unknown socket from %s:%d' % (self._client_address[0], self._client_address[1]))
-        else:
-            if sock == self._local_sock:
-                self._update_stream(STREAM_DOWN, WAIT_STATUS_READING)
-            elif sock == self._remote_sock:
-                self._update_stream(STREAM_UP, WAIT_STATUS_READING)
-            else:
-                logging.error('write_all_to_sock:unknown socket from %s:%d' % (self._client_address[0], self._client_address[1]))
+        except Exception as e:
+            shell.print_exception(e)
+            logging.error("exception from %s:%d" % (self._client_address[0], self._client_address[1]))
+            self.destroy()
+            return False
         return True
 
+    def _update_write_stream(self, stream, queue):
+        # wait for the socket to be writable while data is queued, and stop
+        # reading the other side above the high watermark until the queue
+        # has drained below the low one
+        if not queue:
+            status = WAIT_STATUS_READING
+        elif queue.size > self._write_high:
+            status = WAIT_STATUS_WRITING
+        elif queue.size > self._write_low and \
+                self._stream_status(stream) == WAIT_STATUS_WRITING:
+            status = WAIT_STATUS_WRITING
+        else:
+            status = WAIT_STATUS_READWRITING
+        self._update_stream(stream, status)
+
+    def _stream_status(self, stream):
+        if stream == STREAM_DOWN:
+            return self._downstream_status
+        return self._upstream_status
+
+    def _queue_to_remote(self, data):
+        # before the remote is connected, counted here as _write_to_sock
+        # would, flushing the queue doesn't count again
+        if self._encrypt_correct:
+            self._server.add_transfer_u(self._user, len(data))
+        self._update_activity(len(data))
+        self._data_to_write_to_remote.append(data)
+
     def _handle_server_dns_resolved(self, error, remote_addr, server_addr, data):
         if error:
             return
@@ -536,7 +707,9 @@ class TCPRelayHandler(object):
                 data = self._encryptor.encrypt(data)
                 data = self._obfs.client_encode(data)
         if data:
-            self._data_to_write_to_remote.append(data)
+            self._queue_to_remote(data)
+            # the client may send a lot before the remote has connected
+            self._update_write_stream(STREAM_UP, self._data_to_write_to_remote)
         if self._is_local and not self._fastopen_connected and \
                 self._config['fast_open']:
             # for sslocal and fastopen, we basically wait for data and use
@@ -547,15 +720,12 @@ class TCPRelayHandler(object):
                 remote_sock = \
                     self._create_remote_socket(self._chosen_server[0],
                                                self._chosen_server[1])
-                self._loop.add(remote_sock, eventloop.POLL_ERR, self._server)
-                data = b''.join(self._data_to_write_to_remote)
+                self._add_to_loop(remote_sock, eventloop.POLL_ERR)
+                data = b''.join(self._data_to_write_to_remote.pop_all())
                 l = len(data)
                 s = remote_sock.sendto(data, MSG_FASTOPEN, self._chosen_server)
                 if s < l:
-                    data = data[s:]
-                    self._data_to_write_to_remote = [data]
-                else:
-                    self._data_to_write_to_remote = []
+                    self._data_to_write_to_remote.append(data[s:])
                 self._update_stream(STREAM_UP, WAIT_STATUS_READWRITING)
             except (OSError, IOError) as e:
                 if eventloop.errno_from_exception(e) == errno.EINPROGRESS:
@@ -659,13 +829,13 @@ class TCPRelayHandler(object):
                     data_to_send = self._encryptor.encrypt(data)
                     data_to_send = self._obfs.client_encode(data_to_send)
                 if data_to_send:
-                    self._data_to_write_to_remote.append(data_to_send)
+                    self._queue_to_remote(data_to_send)
                 # notice here may go into _handle_dns_resolved directly
                 self._dns_resolver.resolve(self._chosen_server[0],
                                            self._handle_dns_resolved)
             else:
                 if len(data) > header_length:
-                    self._data_to_write_to_remote.append(data[header_length:])
+                    self._queue_to_remote(data[header_length:])
                 # notice here may go into _handle_dns_resolved directly
                 self._dns_resolver.resolve(remote_addr,
                                            self._handle_dns_resolved)
@@ -696,6 +866,21 @@ class TCPRelayHandler(object):
                 except Exception as e:
                     logging.warn("bind %s fail" % (bind_addr,))
 
+    def _check_forbidden(self, sa):
+        if self._forbidden_iplist:
+            if common.to_str(sa[0]) in self._forbidden_iplist:
+                if self._remote_address:
+                    raise Exception('IP %s is in forbidden list, when connect to %s:%d via port %d by UID %d' %
+                        (common.to_str(sa[0]), self._remote_address[0], self._remote_address[1], self._server._listen_port, self._user_id))
+                raise Exception('IP %s is in forbidden list, reject' %
+                                common.to_str(sa[0]))
+        if self._forbidden_portset:
+            if sa[1] in self._forbidden_portset:
+                if self._remote_address:
+                    raise Exception('Port %d is in forbidden list, when connect to %s:%d via port %d by UID %d' %
+                        (sa[1], self._remote_address[0], self._remote_address[1], self._server._listen_port, self._user_id))
+                raise Exception('Port %d is in forbidden list, reject' % sa[1])
+
     def _create_remote_socket(self, ip, port):
         if self._remote_udp:
             addrs_v6 = socket.getaddrinfo("::", 0, 0, socket.SOCK_DGRAM, socket.SOL_UDP)
@@ -706,19 +891,7 @@ class TCPRelayHandler(object):
             raise Exception("getaddrinfo failed for %s:%d" % (ip, port))
         af, socktype, proto, canonname, sa = addrs[0]
         if not self._remote_udp and not self._is_redirect:
-            if self._forbidden_iplist:
-                if common.to_str(sa[0]) in self._forbidden_iplist:
-                    if self._remote_address:
-                        raise Exception('IP %s is in forbidden list, when connect to %s:%d via port %d by UID %d' %
-                            (common.to_str(sa[0]), self._remote_address[0], self._remote_address[1], self._server._listen_port, self._user_id))
-                    raise Exception('IP %s is in forbidden list, reject' %
-                                    common.to_str(sa[0]))
-            if self._forbidden_portset:
-                if sa[1] in self._forbidden_portset:
-                    if self._remote_address:
-                        raise Exception('Port %d is in forbidden list, when connect to %s:%d via port %d by UID %d' %
-                            (sa[1], self._remote_address[0], self._remote_address[1], self._server._listen_port, self._user_id))
-                    raise Exception('Port %d is in forbidden list, reject' % sa[1])
+            self._check_forbidden(sa)
         remote_sock = socket.socket(af, socktype, proto)
         self._remote_sock = remote_sock
         self._remote_sock_fd = remote_sock.fileno()
@@ -744,6 +917,106 @@ class TCPRelayHandler(object):
                 self._socket_bind_addr(remote_sock, af)
         return remote_sock
 
+    def _connect_remote(self, remote_sock, remote_addr, remote_port):
+        try:
+            remote_sock.connect((remote_addr, remote_port))
+        except (OSError, IOError) as e:
+            if eventloop.errno_from_exception(e) in (errno.EINPROGRESS,
+                    errno.EWOULDBLOCK):
+                pass # always goto here
+            else:
+                raise e
+        addr, port = remote_sock.getsockname()[:2]
+        common.connect_log('TCP connecting %s(%s):%d from %s:%d by user %d' %
+            (common.to_str(self._remote_address[0]), common.to_str(remote_addr), remote_port, addr, port, self._user_id))
+
+    def _start_alt_connect(self):
+        # the first connect is slow or failed, try the other address family
+        if self._stage != STAGE_CONNECTING or not self._connect_race:
+            return
+        hostname, port, family = self._connect_race
+        self._connect_race = None
+        if family == socket.AF_INET6:
+            family = socket.AF_INET
+        else:
+            family = socket.AF_INET6
+        ip = self._dns_resolver.get_cached(hostname, family)
+        if not ip:
+            return
+        remote_sock = None
+        try:
+            addrs = socket.getaddrinfo(ip, port, 0, socket.SOCK_STREAM, socket.SOL_TCP)
+            if len(addrs) == 0:
+                raise Exception("getaddrinfo failed for %s:%d" % (ip, port))
+            af, socktype, proto, canonname, sa = addrs[0]
+            self._check_forbidden(sa)
+            remote_sock = socket.socket(af, socktype, proto)
+            remote_sock.setblocking(False)
+            remote_sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
+            if not self._is_local:
+                self._socket_bind_addr(remote_sock, af)
+            self._connect_remote(remote_sock, ip, port)
+        except Exception as e:
+            shell.print_exception(e)
+            if remote_sock:
+                remote_sock.close()
+            return
+        self._remote_sock_alt = remote_sock
+        self._remote_alt_sock_fd = remote_sock.fileno()
+        self._fd_to_handlers[self._remote_alt_sock_fd] = self
+        self._add_to_loop(remote_sock, eventloop.POLL_ERR | eventloop.POLL_OUT)
+
+    def _close_remote_sock(self, sock, fd):
+        try:
+            self._loop.removefd(fd)
+        except Exception as e:
+            shell.print_exception(e)
+        try:
+            del self._fd_to_handlers[fd]
+        except Exception as e:
+            shell.print_exception(e)
+        self._events.pop(fd, None)
+        sock.close()
+
+    def _close_alt_remote(self):
+        self._close_remote_sock(self._remote_sock_alt, self._remote_alt_sock_fd)
+        self._remote_sock_alt = None
+        self._remote_alt_sock_fd = None
+
+    def _use_alt_remote(self):
+        # the other connect takes over, the first one is dropped
+        self._close_remote_sock(self._remote_sock, self._remote_sock_fd)
+        self._remote_sock = self._remote_sock_alt
+        self._remote_sock_fd = self._remote_alt_sock_fd
+        self._remote_sock_alt = None
+        self._remote_alt_sock_fd = None
+        self._update_poll()
+
+    def _connect_failover(self):
+        # the connect failed, go on with the other address family if there is
+        # one, without waiting for the delay
+        if self._stage != STAGE_CONNECTING or self._remote_udp:
+            return False
+        if not self._remote_sock_alt:
+            self._start_alt_connect()
+        if not self._remote_sock_alt:
+            return False
+        logging.debug('connect to %s:%d failed, trying the other address' %
+                      self._remote_address)
+        self._use_alt_remote()
+        return True
+
+    def _on_alt_remote_event(self, event):
+        if event & eventloop.POLL_ERR:
+            # the first connect is still going, let it carry on alone
+            logging.debug('alternative connect failed: %s' %
+                          eventloop.get_sock_error(self._remote_sock_alt))
+            self._close_alt_remote()
+        elif event & eventloop.POLL_OUT:
+            self._use_alt_remote()
+            self._on_remote_write()
+        return True
+
     def _handle_dns_resolved(self, result, error):
         if error:
             self._log_error(error)
@@ -773,36 +1046,27 @@ class TCPRelayHandler(object):
                         remote_sock = self._create_remote_socket(remote_addr,
                                                                  remote_port)
                         if self._remote_udp:
-                            self._loop.add(remote_sock,
-                                           eventloop.POLL_IN,
-                                           self._server)
+                            self._add_to_loop(remote_sock, eventloop.POLL_IN)
                             if self._remote_sock_v6:
-                                self._loop.add(self._remote_sock_v6,
-                                        eventloop.POLL_IN,
-                                        self._server)
+                                self._add_to_loop(self._remote_sock_v6,
+                                                  eventloop.POLL_IN)
                         else:
-                            try:
-                                remote_sock.connect((remote_addr, remote_port))
-                            except (OSError, IOError) as e:
-                                if eventloop.errno_from_exception(e) in (errno.EINPROGRESS,
-                                        errno.EWOULDBLOCK):
-                                    pass # always goto here
-                                else:
-                                    raise e
-                            addr, port = self._remote_sock.getsockname()[:2]
-                            common.connect_log('TCP connecting %s(%s):%d from %s:%d by user %d' %
-                                (common.to_str(self._remote_address[0]), common.to_str(remote_addr), remote_port, addr, port, self._user_id))
-
-                            self._loop.add(remote_sock,
-                                       eventloop.POLL_ERR | eventloop.POLL_OUT,
-                                       self._server)
+                            self._connect_remote(remote_sock, remote_addr,
+                                                 remote_port)
+                            self._add_to_loop(remote_sock,
+                                       eventloop.POLL_ERR | eventloop.POLL_OUT)
+                            if result[0] != ip and not self._is_redirect:
+                                # the name may have an address of the other
+                                # family too, race it if this one is slow
+                                self._connect_race = (result[0], remote_port,
+                                                      common.is_ip(ip))
+                                self._loop.call_later(CONNECT_ATTEMPT_DELAY,
+                                                      self._start_alt_connect)
                         self._stage = STAGE_CONNECTING
                         self._update_stream(STREAM_UP, WAIT_STATUS_READWRITING)
                         self._update_stream(STREAM_DOWN, WAIT_STATUS_READING)
                         if self._remote_udp:
-                            while self._data_to_write_to_remote:
-                                data = self._data_to_write_to_remote[0]
-                                del self._data_to_write_to_remote[0]
+                            for data in self._data_to_write_to_remote.pop_all():
                                 self._write_to_sock(data, self._remote_sock)
                     return
                 except Exception as e:
@@ -812,10 +1076,15 @@ class TCPRelayHandler(object):
                     logging.error("exception from %s:%d" % (self._client_address[0], self._client_address[1]))
         self.destroy()
 
-    def _get_read_size(self, sock, recv_buffer_size, up):
+    def _recv(self, sock, recv_buffer_size):
+        # read into the relay's buffer, the returned view is only valid until
+        # the next read of any handler on this relay
+        view = self._server.recv_view
+        return view[:sock.recv_into(view, recv_buffer_size)]
+
+    def _get_read_size(self, buffer_size, recv_buffer_size, up):
         if self._overhead == 0:
-            return recv_buffer_size
-        buffer_size = len(sock.recv(recv_buffer_size, socket.MSG_PEEK))
+            return buffer_size
         frame_size = self._tcp_mss - self._overhead
         if up:
             buffer_size = min(buffer_size, self._recv_u_max_size)
@@ -829,19 +1098,109 @@ class TCPRelayHandler(object):
             buffer_size = int(buffer_size / frame_size) * frame_size
         return buffer_size
 
+    def _read_pieces(self, data, recv_buffer_size, up):
+        # cut one read into the sizes the frames of the protocol are built
+        # from, the pieces are copied out of the shared buffer up front
+        pieces = []
+        while data:
+            size = self._get_read_size(len(data), recv_buffer_size, up)
+            pieces.append(bytes(data[:size]))
+            data = data[size:]
+        return pieces
+
+    def _splice_start(self):
+        # switch to splice once nothing is left in our own queues, from now
+        # on the bytes go socket to pipe to socket
+        if self._remote_udp or not self._encrypt_correct:
+            self._can_splice = False
+            return
+        if self._data_to_write_to_local or self._data_to_write_to_remote:
+            # tried again on the next read
+            return
+        self._can_splice = False
+        try:
+            flags = os.O_NONBLOCK | os.O_CLOEXEC
+            self._splice_pipes = (os.pipe2(flags), os.pipe2(flags))
+        except (OSError, IOError) as e:
+            shell.print_exception(e)
+
+    def _splice_read(self, stream):
+        if stream == STREAM_UP:
+            sock = self._local_sock
+        else:
+            sock = self._remote_sock
+        self._recv_more = False
+        try:
+            size = os.splice(sock.fileno(), self._splice_pipes[stream][1],
+                             SPLICE_SIZE, flags=SPLICE_FLAGS)
+        except (OSError, IOError) as e:
+            if eventloop.errno_from_exception(e) in \
+                    (errno.ETIMEDOUT, errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            size = 0
+        if not size:
+            self.destroy()
+            return
+        # a pipe fills by buffers, not bytes, so a short splice doesn't mean
+        # the socket is drained, only EAGAIN does
+        self._recv_more = True
+        if stream == STREAM_UP:
+            self.speed_tester_u.add(size)
+            self._server.speed_tester_u(self._user_id).add(size)
+            self._server.add_transfer_u(self._user, size)
+        else:
+            self.speed_tester_d.add(size)
+            self._server.speed_tester_d(self._user_id).add(size)
+            self._server.add_transfer_d(self._user, size)
+        self._update_activity(size)
+        self._splice_pending[stream] += size
+        self._splice_write(stream)
+
+    def _splice_write(self, stream):
+        # empty the pipe into the other socket, the reading side waits while
+        # anything is left in it
+        if stream == STREAM_UP:
+            sock = self._remote_sock
+        else:
+            sock = self._local_sock
+        try:
+            while self._splice_pending[stream]:
+                size = os.splice(self._splice_pipes[stream][0], sock.fileno(),
+                                 self._splice_pending[stream],
+                                 flags=SPLICE_FLAGS)
+                if not size:
+                    break
+                self._splice_pending[stream] -= size
+        except (OSError, IOError) as e:
+            if eventloop.errno_from_exception(e) not in \
+                    (errno.EAGAIN, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                shell.print_exception(e)
+                logging.error("exception from %s:%d" % (self._client_address[0], self._client_address[1]))
+                self.destroy()
+                return
+        if self._splice_pending[stream]:
+            self._update_stream(stream, WAIT_STATUS_WRITING)
+        else:
+            self._update_stream(stream, WAIT_STATUS_READING)
+
     def _on_local_read(self):
         # handle all local read events and dispatch them to methods for
         # each stage
         if not self._local_sock:
             return
-        is_local = self._is_local
-        if is_local:
-            recv_buffer_size = self._get_read_size(self._local_sock, self._recv_buffer_size, True)
+        if self._can_splice and self._stage == STAGE_STREAM:
+            self._splice_start()
+        if self._splice_pipes:
+            self._splice_read(STREAM_UP)
+            return
+        if self._is_local:
+            recv_buffer_size = self._recv_buffer_size
         else:
             recv_buffer_size = BUF_SIZE
         data = None
+        self._recv_more = False
         try:
-            data = self._local_sock.recv(recv_buffer_size)
+            data = self._recv(self._local_sock, recv_buffer_size)
         except (OSError, IOError) as e:
             if eventloop.errno_from_exception(e) in \
                     (errno.ETIMEDOUT, errno.EAGAIN, errno.EWOULDBLOCK):
@@ -849,7 +1208,18 @@ class TCPRelayHandler(object):
         if not data:
             self.destroy()
             return
+        self._recv_more = len(data) >= recv_buffer_size
+
+        if self._is_local:
+            for piece in self._read_pieces(data, recv_buffer_size, True):
+                self._handle_local_data(piece)
+                if self._stage == STAGE_DESTROYED:
+                    return
+        else:
+            self._handle_local_data(bytes(data))
 
+    def _handle_local_data(self, data):
+        is_local = self._is_local
         self.speed_tester_u.add(len(data))
         self._server.speed_tester_u(self._user_id).add(len(data))
         ogn_data = data
@@ -882,10 +1252,12 @@ class TCPRelayHandler(object):
                         if not self._protocol.obfs.server_info.recv_iv:
                             iv_len = len(self._protocol.obfs.server_info.iv)
                             self._protocol.obfs.server_info.recv_iv = obfs_decode[0][:iv_len]
-                        data = self._encryptor.decrypt(obfs_decode[0])
-                    else:
-                        data = obfs_decode[0]
                     try:
+                        if obfs_decode[1]:
+                            # AEAD methods raise when a chunk fails to authenticate
+                            data = self._encryptor.decrypt(obfs_decode[0])
+                        else:
+                            data = obfs_decode[0]
                         data, sendback = self._protocol.server_post_decrypt(data)
                         if sendback:
                             backdata = self._protocol.server_pre_encrypt(b'')
@@ -928,7 +1300,13 @@ class TCPRelayHandler(object):
 
     def _on_remote_read(self, is_remote_sock):
         # handle all remote read events
+        if self._can_splice and self._stage == STAGE_STREAM:
+            self._splice_start()
+        if self._splice_pipes:
+            self._splice_read(STREAM_DOWN)
+            return
         data = None
+        self._recv_more = False
         try:
             if self._remote_udp:
                 if is_remote_sock:
@@ -944,22 +1322,39 @@ class TCPRelayHandler(object):
                     data = b'\x00\x04' + ip + port + data
                 size = len(data) + 2
                 data = struct.pack('>H', size) + data
+                self._recv_more = True
                 #logging.info('UDP over TCP recvfrom %s:%d %d bytes to %s:%d' % (addr[0], addr[1], len(data), self._client_address[0], self._client_address[1]))
             else:
                 if self._is_local:
                     recv_buffer_size = BUF_SIZE
                 else:
-                    recv_buffer_size = self._get_read_size(self._remote_sock, self._recv_buffer_size, False)
-                data = self._remote_sock.recv(recv_buffer_size)
-                self._recv_pack_id += 1
+                    recv_buffer_size = self._recv_buffer_size
+                data = self._recv(self._remote_sock, recv_buffer_size)
+                self._recv_more = len(data) >= recv_buffer_size
         except (OSError, IOError) as e:
             if eventloop.errno_from_exception(e) in \
                     (errno.ETIMEDOUT, errno.EAGAIN, errno.EWOULDBLOCK, 10035): #errno.WSAEWOULDBLOCK
                 return
+            # a failed connect can show up here before the error event
+            if self._connect_failover():
+                return
         if not data:
             self.destroy()
             return
 
+        if self._remote_udp:
+            self._handle_remote_data(data)
+        elif self._is_local:
+            self._recv_pack_id += 1
+            self._handle_remote_data(bytes(data))
+        else:
+            for piece in self._read_pieces(data, recv_buffer_size, False):
+                self._recv_pack_id += 1
+                self._handle_remote_data(piece)
+                if self._stage == STAGE_DESTROYED:
+                    return
+
+    def _handle_remote_data(self, data):
         self.speed_tester_d.add(len(data))
         self._server.speed_tester_d(self._user_id).add(len(data))
         if self._encryptor is not None:
@@ -977,8 +1372,8 @@ class TCPRelayHandler(object):
                 if not self._protocol.obfs.server_info.recv_iv:
                     iv_len = len(self._protocol.obfs.server_info.iv)
                     self._protocol.obfs.server_info.recv_iv = obfs_decode[0][:iv_len]
-                data = self._encryptor.decrypt(obfs_decode[0])
                 try:
+                    data = self._encryptor.decrypt(obfs_decode[0])
                     data = self._protocol.client_post_decrypt(data)
                     if self._recv_pack_id == 1:
                         self._tcp_mss = self._protocol.get_server_info().tcp_mss
@@ -1007,22 +1402,29 @@ class TCPRelayHandler(object):
 
     def _on_local_write(self):
         # handle local writable event
+        if self._splice_pipes:
+            self._splice_write(STREAM_DOWN)
+            return
         if self._data_to_write_to_local:
-            data = b''.join(self._data_to_write_to_local)
-            self._data_to_write_to_local = []
-            self._write_to_sock(data, self._local_sock)
-        else:
-            self._update_stream(STREAM_DOWN, WAIT_STATUS_READING)
+            if not self._flush(self._data_to_write_to_local, self._local_sock):
+                return
+        self._update_write_stream(STREAM_DOWN, self._data_to_write_to_local)
 
     def _on_remote_write(self):
         # handle remote writable event
+        if self._stage == STAGE_CONNECTING:
+            # connected, the race is over
+            self._connect_race = None
+            if self._remote_sock_alt:
+                self._close_alt_remote()
         self._stage = STAGE_STREAM
+        if self._splice_pipes:
+            self._splice_write(STREAM_UP)
+            return
         if self._data_to_write_to_remote:
-            data = b''.join(self._data_to_write_to_remote)
-            self._data_to_write_to_remote = []
-            self._write_to_sock(data, self._remote_sock)
-        else:
-            self._update_stream(STREAM_UP, WAIT_STATUS_READING)
+            if not self._flush(self._data_to_write_to_remote, self._remote_sock):
+                return
+        self._update_write_stream(STREAM_UP, self._data_to_write_to_remote)
 
     def _on_local_error(self):
         if self._local_sock:
@@ -1033,6 +1435,8 @@ class TCPRelayHandler(object):
         self.destroy()
 
     def _on_remote_error(self):
+        if self._connect_failover():
+            return
         if self._remote_sock:
             err = eventloop.get_sock_error(self._remote_sock)
             if err.errno not in [errno.ECONNRESET]:
@@ -1052,16 +1456,19 @@ class TCPRelayHandler(object):
         if self._user is not None and self._user not in self._server.server_users:
             self.destroy()
             return True
+        if fd == self._remote_alt_sock_fd:
+            return self._on_alt_remote_event(event)
+        if self._edge and fd in self._events:
+            return self._handle_edge_event(sock, fd, event)
         if fd == self._remote_sock_fd or fd == self._remotev6_sock_fd:
             if event & eventloop.POLL_ERR:
                 handle = True
                 self._on_remote_error()
             elif event & (eventloop.POLL_IN | eventloop.POLL_HUP):
-                if not self.speed_tester_d.isExceed() and not self._server.speed_tester_d(self._user_id).isExceed():
+                # a hang up is still reported while throttled, drain it
+                if event & eventloop.POLL_HUP or self._check_speed(STREAM_DOWN):
                     handle = True
                     self._on_remote_read(sock == self._remote_sock)
-                else:
-                    self._recv_d_max_size = self._tcp_mss - self._overhead
             elif event & eventloop.POLL_OUT:
                 handle = True
                 self._on_remote_write()
@@ -1070,11 +1477,9 @@ class TCPRelayHandler(object):
                 handle = True
                 self._on_local_error()
             elif event & (eventloop.POLL_IN | eventloop.POLL_HUP):
-                if not self.speed_tester_u.isExceed() and not self._server.speed_tester_u(self._user_id).isExceed():
+                if event & eventloop.POLL_HUP or self._check_speed(STREAM_UP):
                     handle = True
                     self._on_local_read()
-                else:
-                    self._recv_u_max_size = self._tcp_mss - self._overhead
             elif event & eventloop.POLL_OUT:
                 handle = True
                 self._on_local_write()
@@ -1092,6 +1497,43 @@ class TCPRelayHandler(object):
 
         return handle
 
+    def _handle_edge_event(self, sock, fd, event):
+        # an edge is reported only once, so read until the socket is drained
+        # and handle every event in the mask, not just the first one
+        is_local_sock = fd == self._local_sock_fd
+        if event & eventloop.POLL_ERR:
+            if is_local_sock:
+                self._on_local_error()
+            else:
+                self._on_remote_error()
+            return True
+        stream = is_local_sock and STREAM_UP or STREAM_DOWN
+        if event & (eventloop.POLL_IN | eventloop.POLL_HUP):
+            for i in range(EDGE_READ_BATCH):
+                if self._stage == STAGE_DESTROYED:
+                    return True
+                if not event & eventloop.POLL_HUP:
+                    if not self._events[fd] & eventloop.POLL_IN or \
+                            not self._check_speed(stream):
+                        break
+                if is_local_sock:
+                    self._on_local_read()
+                else:
+                    self._on_remote_read(sock == self._remote_sock)
+                if not self._recv_more:
+                    break
+            else:
+                # still more to read, let the other sockets have a turn
+                self._loop.call_later(0, lambda: self._on_kick(
+                    sock, fd, eventloop.POLL_IN))
+        if event & eventloop.POLL_OUT and self._stage != STAGE_DESTROYED \
+                and self._events[fd] & eventloop.POLL_OUT:
+            if is_local_sock:
+                self._on_local_write()
+            else:
+                self._on_remote_write()
+        return True
+
     def _log_error(self, e):
         logging.error('%s when handling connection from %s:%d' %
                       (e, self._client_address[0], self._client_address[1]))
@@ -1143,6 +1585,9 @@ class TCPRelayHandler(object):
                 shell.print_exception(e)
             self._remote_sock_v6.close()
             self._remote_sock_v6 = None
+        if self._remote_sock_alt:
+            logging.debug('destroying remote_alt')
+            self._close_alt_remote()
         if self._local_sock:
             logging.debug('destroying local')
             try:
@@ -1163,6 +1608,11 @@ class TCPRelayHandler(object):
             self._protocol.dispose()
             self._protocol = None
         self._encryptor = None
+        if self._splice_pipes:
+            for pipe in self._splice_pipes:
+                os.close(pipe[0])
+                os.close(pipe[1])
+            self._splice_pipes = None
         self._dns_resolver.remove_callback(self._handle_dns_resolved)
         self._server.remove_handler(self)
         if self._add_ref > 0:
@@ -1170,7 +1620,8 @@ class TCPRelayHandler(object):
             self._server.stat_add(self._client_address[0], -1)
 
 class TCPRelay(object):
-    def __init__(self, config, dns_resolver, is_local, stat_callback=None, stat_counter=None):
+    def __init__(self, config, dns_resolver, is_local, stat_callback=None, stat_counter=None,
+                 transfer_table=None):
         self._config = config
         self._is_local = is_local
         self._dns_resolver = dns_resolver
@@ -1194,8 +1645,7 @@ class TCPRelay(object):
             common.connect_log = logging.info
 
         self._timeout = config['timeout']
-        self._timeout_cache = lru_cache.LRUCache(timeout=self._timeout,
-                                         close_callback=self._close_tcp_client)
+        self._timer_wheel = None
 
         if is_local:
             listen_addr = config['local_address']
@@ -1216,6 +1666,9 @@ class TCPRelay(object):
         af, socktype, proto, canonname, sa = addrs[0]
         server_socket = socket.socket(af, socktype, proto)
         server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if config.get('reuse_port', False):
+            # every worker binds the port, the kernel spreads connections
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         server_socket.bind(sa)
         server_socket.setblocking(False)
         if config['fast_open']:
@@ -1229,6 +1682,9 @@ class TCPRelay(object):
         self._server_socket_fd = server_socket.fileno()
         self._stat_counter = stat_counter
         self._stat_callback = stat_callback
+        self._transfer_table = transfer_table
+        # every handler reads into this, the loop runs one handler at a time
+        self.recv_view = memoryview(bytearray(BUF_SIZE))
 
     def add_to_loop(self, loop):
         if self._eventloop:
@@ -1236,13 +1692,16 @@ class TCPRelay(object):
         if self._closed:
             raise Exception('already closed')
         self._eventloop = loop
+        self._timer_wheel = loop.timer_wheel
         self._eventloop.add(self._server_socket,
                             eventloop.POLL_IN | eventloop.POLL_ERR, self)
         self._eventloop.add_periodic(self.handle_periodic)
 
+    def add_handler(self, client):
+        self._timer_wheel.add(client, self._timeout, self._close_tcp_client)
+
     def remove_handler(self, client):
-        if hash(client) in self._timeout_cache:
-            del self._timeout_cache[hash(client)]
+        self._timer_wheel.remove(client)
 
     def add_connection(self, val):
         self.server_connections += val
@@ -1309,19 +1768,37 @@ class TCPRelay(object):
     def add_transfer_u(self, user, transfer):
         if user is None:
             self.server_transfer_ul += transfer
+            if self._transfer_table is not None:
+                self._transfer_table.add(self._listen_port, transfer, 0)
         else:
             if user not in self.server_user_transfer_ul:
                 self.server_user_transfer_ul[user] = 0
             self.server_user_transfer_ul[user] += transfer + self.server_transfer_ul
+            if self._transfer_table is not None:
+                # the bytes counted to the port before the user was known
+                # move to the user, as they do in the counters above
+                if self.server_transfer_ul:
+                    self._transfer_table.add(self._listen_port, -self.server_transfer_ul, 0)
+                self._transfer_table.add(struct.unpack('<I', user)[0],
+                                         transfer + self.server_transfer_ul, 0)
             self.server_transfer_ul = 0
 
     def add_transfer_d(self, user, transfer):
         if user is None:
             self.server_transfer_dl += transfer
+            if self._transfer_table is not None:
+                self._transfer_table.add(self._listen_port, 0, transfer)
         else:
             if user not in self.server_user_transfer_dl:
                 self.server_user_transfer_dl[user] = 0
             self.server_user_transfer_dl[user] += transfer + self.server_transfer_dl
+            if self._transfer_table is not None:
+                # the bytes counted to the port before the user was known
+                # move to the user, as they do in the counters above
+                if self.server_transfer_dl:
+                    self._transfer_table.add(self._listen_port, 0, -self.server_transfer_dl)
+                self._transfer_table.add(struct.unpack('<I', user)[0],
+                                         0, transfer + self.server_transfer_dl)
             self.server_transfer_dl = 0
 
     def speed_tester_u(self, uid):
@@ -1386,10 +1863,7 @@ class TCPRelay(object):
         if data_len and self._stat_callback:
             self._stat_callback(self._listen_port, data_len)
 
-        self._timeout_cache[hash(client)] = client
-
-    def _sweep_timeout(self):
-        self._timeout_cache.sweep()
+        client.last_activity = self._timer_wheel.now
 
     def _close_tcp_client(self, client):
         if client.remote_address:
@@ -1462,7 +1936,6 @@ class TCPRelay(object):
                 logging.info('closed TCP port %d', self._listen_port)
             for handler in list(self._fd_to_handlers.values()):
                 handler.destroy()
-        self._sweep_timeout()
 
     def close(self, next_tick=False):
         logging.debug('TCP close')
@@ -1474,3 +1947,259 @@ class TCPRelay(object):
             self._server_socket.close()
             for handler in list(self._fd_to_handlers.values()):
                 handler.destroy()
+
+
+def test_write_queue():
+    a, b = socket.socketpair()
+    a.setblocking(False)
+    queue = WriteQueue()
+    data = [os.urandom(100000) for i in range(5)]
+    for d in data:
+        queue.append(d)
+    queue.append(b'')
+    assert len(queue) == 5 and queue.size == 500000
+    got = []
+    while queue:
+        try:
+            queue.flush(a)
+        except (OSError, IOError) as e:
+            assert eventloop.errno_from_exception(e) in (errno.EAGAIN, errno.EWOULDBLOCK)
+        got.append(b.recv(1 << 20))
+    while sum(map(len, got)) < 500000:
+        got.append(b.recv(1 << 20))
+    assert b''.join(got) == b''.join(data)
+    assert queue.size == 0
+    queue.append(b'abc')
+    queue.append(b'def')
+    queue.flush(a)
+    assert b.recv(10) == b'abcdef'
+    a.close()
+    b.close()
+
+
+def _test_config(**kwargs):
+    config = {'server': '127.0.0.1', 'server_port': 0, 'password': 'test',
+              'method': 'none', 'protocol': 'origin', 'protocol_param': '',
+              'obfs': 'plain', 'obfs_param': '', 'timeout': 60,
+              'fast_open': False, 'verbose': 0}
+    config.update(kwargs)
+    return config
+
+
+def _test_run(loop, seconds):
+    # run the loop for a while, the test drives the other end in between
+    loop._stopping = False
+    loop.call_later(seconds, loop.stop)
+    loop.run()
+
+
+def _test_echo_server(family=socket.AF_INET, host='127.0.0.1'):
+    listener = socket.socket(family, socket.SOCK_STREAM)
+    listener.bind((host, 0))
+    listener.listen(8)
+
+    def serve(conn):
+        while True:
+            data = conn.recv(65536)
+            if not data:
+                break
+            conn.sendall(data)
+        conn.close()
+
+    def accept():
+        while True:
+            try:
+                conn = listener.accept()[0]
+            except (OSError, IOError):
+                return
+            t = threading.Thread(target=serve, args=(conn,))
+            t.daemon = True
+            t.start()
+
+    t = threading.Thread(target=accept)
+    t.daemon = True
+    t.start()
+    return listener
+
+
+def test_splice():
+    from shadowsocks import asyncdns
+    if not hasattr(os, 'splice'):
+        return
+    echo = _test_echo_server()
+    loop = eventloop.EventLoop()
+    relay = TCPRelay(_test_config(), asyncdns.DNSResolver(), False)
+    relay.add_to_loop(loop)
+    client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    client.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    client.connect(relay._server_socket.getsockname())
+    client.sendall(b'\x01' + socket.inet_aton('127.0.0.1') +
+                   struct.pack('>H', echo.getsockname()[1]))
+    _test_run(loop, 0.2)
+    handler = list(set(relay._fd_to_handlers.values()))[0]
+    assert handler._stage == STAGE_STREAM and handler._can_splice
+
+    # with something queued the switch waits for a later read
+    handler._data_to_write_to_remote.append(b'queued')
+    handler._splice_start()
+    assert handler._can_splice and handler._splice_pipes is None
+    handler._data_to_write_to_remote.pop_all()
+
+    # the client doesn't read, the pipe to it can't be emptied at once
+    client.setblocking(False)
+    data = os.urandom(16 * 1024 * 1024)
+    sent = 0
+    for i in range(1000):
+        try:
+            sent += client.send(data[sent:sent + 65536])
+        except (OSError, IOError):
+            pass
+        _test_run(loop, 0.005)
+        if handler._splice_pending[STREAM_DOWN]:
+            break
+    assert handler._splice_pipes is not None
+    assert handler._splice_pending[STREAM_DOWN]
+
+    got = []
+    received = 0
+    for i in range(20000):
+        if sent < len(data):
+            try:
+                sent += client.send(data[sent:sent + 65536])
+            except (OSError, IOError):
+                pass
+        _test_run(loop, 0.001)
+        while True:
+            try:
+                chunk = client.recv(1 << 20)
+            except (OSError, IOError):
+                break
+            got.append(chunk)
+            received += len(chunk)
+        if received == len(data):
+            break
+    assert b''.join(got) == data
+    assert relay.server_transfer_ul == len(data)
+    assert relay.server_transfer_dl == len(data)
+
+    # EOF from the client ends the connection and frees the pipes
+    client.close()
+    _test_run(loop, 0.1)
+    assert handler._stage == STAGE_DESTROYED
+    assert handler._splice_pipes is None
+    assert not relay._fd_to_handlers
+    relay.close()
+    echo.close()
+
+
+def _test_connect_race(mode, edge_triggered):
+    from shadowsocks import asyncdns
+    echo = _test_echo_server()
+    port = echo.getsockname()[1]
+    # dual.test resolves to ::1 first, there nobody listens (refused) or
+    # the listener's backlog is full and the SYN goes unanswered (stall)
+    keep = []
+    if mode == 'stall':
+        listener = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+        listener.bind(('::1', port))
+        listener.listen(0)
+        keep.append(listener)
+        for i in range(4):
+            sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+            sock.setblocking(False)
+            sock.connect_ex(('::1', port))
+            keep.append(sock)
+    loop = eventloop.EventLoop(edge_triggered)
+    dns_resolver = asyncdns.DNSResolver()
+    dns_resolver.add_to_loop(loop)
+    dns_resolver._cache_answer(b'dual.test', asyncdns.QTYPE_AAAA, '::1', 600)
+    dns_resolver._cache_answer(b'dual.test', asyncdns.QTYPE_A,
+                               '127.0.0.1', 600)
+    relay = TCPRelay(_test_config(), dns_resolver, False)
+    relay.add_to_loop(loop)
+
+    # note every remote connect, the first one may fail within a poll
+    connects = []
+    connect_remote = TCPRelayHandler._connect_remote
+
+    def record_connect(self, remote_sock, remote_addr, remote_port):
+        connects.append(remote_sock)
+        connect_remote(self, remote_sock, remote_addr, remote_port)
+
+    TCPRelayHandler._connect_remote = record_connect
+    try:
+        client = socket.create_connection(
+            relay._server_socket.getsockname())
+        client.sendall(b'\x03\x09dual.test' + struct.pack('>H', port) +
+                       b'hello')
+        start = eventloop.clock.update()
+        for i in range(200):
+            _test_run(loop, 0.005)
+            handlers = list(set(relay._fd_to_handlers.values()))
+            if handlers and handlers[0]._stage == STAGE_STREAM:
+                break
+    finally:
+        TCPRelayHandler._connect_remote = connect_remote
+    elapsed = eventloop.clock.update() - start
+    handler = handlers[0]
+    assert handler._stage == STAGE_STREAM
+    assert len(connects) == 2
+    first, alt = connects
+    assert first.family == socket.AF_INET6
+    assert handler._remote_sock is alt and alt.family == socket.AF_INET
+    if mode == 'stall':
+        # the other address only starts after the delay
+        assert elapsed >= CONNECT_ATTEMPT_DELAY
+    else:
+        assert elapsed < CONNECT_ATTEMPT_DELAY
+    # the losing socket is closed and out of the loop
+    assert first.fileno() == -1
+    assert handler._remote_sock_alt is None
+    assert set(relay._fd_to_handlers) == set([handler._local_sock_fd,
+                                              handler._remote_sock_fd])
+
+    client.settimeout(0)
+    got = b''
+    for i in range(100):
+        _test_run(loop, 0.005)
+        try:
+            got += client.recv(100)
+        except (OSError, IOError):
+            pass
+        if got == b'hello':
+            break
+    assert got == b'hello'
+    client.close()
+    _test_run(loop, 0.05)
+    assert not relay._fd_to_handlers
+    relay.close()
+    dns_resolver.close()
+    echo.close()
+    for sock in keep:
+        sock.close()
+
+
+def test_connect_race():
+    from shadowsocks import asyncdns
+    if not socket.has_ipv6:
+        return
+    try:
+        sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+        sock.bind(('::1', 0))
+        sock.close()
+    except (OSError, IOError):
+        return
+    ipv6_support = asyncdns.IPV6_CONNECTION_SUPPORT
+    asyncdns.IPV6_CONNECTION_SUPPORT = True
+    try:
+        for edge_triggered in (False, True):
+            _test_connect_race('refused', edge_triggered)
+            _test_connect_race('stall', edge_triggered)
+    finally:
+        asyncdns.IPV6_CONNECTION_SUPPORT = ipv6_support
+
+
+if __name__ == '__main__':
+    test_write_queue()
+    test_splice()
+    test_connect_race()
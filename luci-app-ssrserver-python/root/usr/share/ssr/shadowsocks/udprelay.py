@@ -128,7 +128,8 @@ def client_key(source_addr, server_af):
     return '%s:%s:%d' % (source_addr[0], source_addr[1], server_af)
 
 class UDPRelay(object):
-    def __init__(self, config, dns_resolver, is_local, stat_callback=None, stat_counter=None):
+    def __init__(self, config, dns_resolver, is_local, stat_callback=None, stat_counter=None,
+                 transfer_table=None):
         self._config = config
         if config.get('connect_verbose_info', 0) > 0:
             common.connect_log = logging.info
@@ -145,13 +146,16 @@ class UDPRelay(object):
         self._dns_resolver = dns_resolver
         self._password = common.to_bytes(config['password'])
         self._method = config['method']
+        self._cipher_pool = encrypt.CipherPool()
         self._timeout = config['timeout']
         self._is_local = is_local
         self._udp_cache_size = config['udp_cache']
         self._cache = lru_cache.LRUCache(timeout=config['udp_timeout'],
-                                         close_callback=self._close_client_pair)
+                                         close_callback=self._close_client_pair,
+                                         clock=eventloop.clock)
         self._cache_dns_client = lru_cache.LRUCache(timeout=10,
-                                         close_callback=self._close_client_pair)
+                                         close_callback=self._close_client_pair,
+                                         clock=eventloop.clock)
         self._client_fd_to_server_addr = {}
         #self._dns_cache = lru_cache.LRUCache(timeout=1800)
         self._eventloop = None
@@ -189,7 +193,8 @@ class UDPRelay(object):
         self._data_to_write_to_server_socket = []
 
         self._timeout_cache = lru_cache.LRUCache(timeout=self._timeout,
-                                         close_callback=self._close_tcp_client)
+                                         close_callback=self._close_tcp_client,
+                                         clock=eventloop.clock)
 
         self._bind = config.get('out_bind', '')
         self._bindv6 = config.get('out_bindv6', '')
@@ -211,10 +216,13 @@ class UDPRelay(object):
                             (self._listen_addr, self._listen_port))
         af, socktype, proto, canonname, sa = addrs[0]
         server_socket = socket.socket(af, socktype, proto)
+        if config.get('reuse_port', False):
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         server_socket.bind((self._listen_addr, self._listen_port))
         server_socket.setblocking(False)
         self._server_socket = server_socket
         self._stat_callback = stat_callback
+        self._transfer_table = transfer_table
 
     def _get_a_server(self):
         server = self._config['server']
@@ -275,19 +283,37 @@ class UDPRelay(object):
     def add_transfer_u(self, user, transfer):
         if user is None:
             self.server_transfer_ul += transfer
+            if self._transfer_table is not None:
+                self._transfer_table.add(self._listen_port, transfer, 0)
         else:
             if user not in self.server_user_transfer_ul:
                 self.server_user_transfer_ul[user] = 0
             self.server_user_transfer_ul[user] += transfer + self.server_transfer_ul
+            if self._transfer_table is not None:
+                # the bytes counted to the port before the user was known
+                # move to the user, as they do in the counters above
+                if self.server_transfer_ul:
+                    self._transfer_table.add(self._listen_port, -self.server_transfer_ul, 0)
+                self._transfer_table.add(struct.unpack('<I', user)[0],
+                                         transfer + self.server_transfer_ul, 0)
             self.server_transfer_ul = 0
 
     def add_transfer_d(self, user, transfer):
         if user is None:
             self.server_transfer_dl += transfer
+            if self._transfer_table is not None:
+                self._transfer_table.add(self._listen_port, 0, transfer)
         else:
             if user not in self.server_user_transfer_dl:
                 self.server_user_transfer_dl[user] = 0
             self.server_user_transfer_dl[user] += transfer + self.server_transfer_dl
+            if self._transfer_table is not None:
+                # the bytes counted to the port before the user was known
+                # move to the user, as they do in the counters above
+                if self.server_transfer_dl:
+                    self._transfer_table.add(self._listen_port, 0, -self.server_transfer_dl)
+                self._transfer_table.add(struct.unpack('<I', user)[0],
+                                         0, transfer + self.server_transfer_dl)
             self.server_transfer_dl = 0
 
     def _close_client_pair(self, client_pair):
@@ -352,7 +378,7 @@ class UDPRelay(object):
                 data = data[3:]
         else:
             ref_iv = [0]
-            data = encrypt.encrypt_all_iv(self._protocol.obfs.server_info.key, self._method, 0, data, ref_iv)
+            data = self._cipher_pool.encrypt_all_iv(self._protocol.obfs.server_info.key, self._method, 0, data, ref_iv)
             # decrypt data
             if not data:
                 logging.debug('UDP handle_server: data is empty after decrypt')
@@ -454,7 +480,7 @@ class UDPRelay(object):
                 self._protocol.obfs.server_info.iv = ref_iv[0]
                 data = self._protocol.client_udp_pre_encrypt(data)
                 #logging.debug("%s" % (binascii.hexlify(data),))
-                data = encrypt.encrypt_all_iv(self._protocol.obfs.server_info.key, self._method, 1, data, ref_iv)
+                data = self._cipher_pool.encrypt_all_iv(self._protocol.obfs.server_info.key, self._method, 1, data, ref_iv)
                 if not data:
                     return
             else:
@@ -508,14 +534,14 @@ class UDPRelay(object):
             ref_iv = [encrypt.encrypt_new_iv(self._method)]
             self._protocol.obfs.server_info.iv = ref_iv[0]
             data = self._protocol.server_udp_pre_encrypt(data, client_uid)
-            response = encrypt.encrypt_all_iv(self._protocol.obfs.server_info.key, self._method, 1,
-                                           data, ref_iv)
+            response = self._cipher_pool.encrypt_all_iv(self._protocol.obfs.server_info.key, self._method, 1,
+                                                        data, ref_iv)
             if not response:
                 return
         else:
             ref_iv = [0]
-            data = encrypt.encrypt_all_iv(self._protocol.obfs.server_info.key, self._method, 0,
-                                       data, ref_iv)
+            data = self._cipher_pool.encrypt_all_iv(self._protocol.obfs.server_info.key, self._method, 0,
+                                                    data, ref_iv)
             if not data:
                 return
             self._protocol.obfs.server_info.recv_iv = ref_iv[0]
@@ -532,7 +558,7 @@ class UDPRelay(object):
             if client_uid:
                 self.add_transfer_d(client_uid, len(response))
             else:
-                self.server_transfer_dl += len(response)
+                self.add_transfer_d(None, len(response))
             self.write_to_server_socket(response, client_addr[0])
             if client_dns_pair:
                 logging.debug("remove dns client %s:%d" % (client_addr[0][0], client_addr[0][1]))
@@ -0,0 +1,309 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# worker processes that bind their own listening sockets with SO_REUSEPORT,
+# the master talks to each of them over a socketpair and reads their transfer
+# from a table in shared memory
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import os
+import mmap
+import socket
+import struct
+import pickle
+import logging
+import threading
+
+from shadowsocks import eventloop, shell
+
+__all__ = ['Channel', 'TransferTable', 'fork_workers']
+
+BUF_SIZE = 65536
+
+# slots per worker in the transfer table, one per port or multi user id,
+# transfer_slots in the config overrides it
+TRANSFER_SLOTS = 4096
+# sequence number at the start of each region, padded so the slots stay
+# 8 byte aligned
+SEQ = struct.Struct('<I4x')
+# id, used, upload, download; 24 bytes so the counters stay 8 byte aligned
+SLOT = struct.Struct('<IIqq')
+# a worker killed in the middle of a write leaves its sequence odd for good,
+# the reader takes what it sees after this many tries
+SNAPSHOT_RETRIES = 100
+
+
+class Channel(object):
+    """Length-prefixed pickled messages over one end of a socketpair.
+
+    Both ends belong to our own processes, nothing else can write to it.
+    """
+
+    def __init__(self, sock, callback, close_callback=None):
+        self._sock = sock
+        self._callback = callback
+        self._close_callback = close_callback
+        self._loop = None
+        self._buf = b''
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    def add_to_loop(self, loop):
+        self._loop = loop
+        loop.add(self._sock, eventloop.POLL_IN | eventloop.POLL_ERR, self)
+
+    def send(self, msg):
+        if self._sock is None:
+            return
+        data = pickle.dumps(msg, pickle.HIGHEST_PROTOCOL)
+        self._sock.sendall(struct.pack('>I', len(data)) + data)
+
+    def handle_event(self, sock, fd, event):
+        data = None
+        if event & (eventloop.POLL_IN | eventloop.POLL_HUP):
+            data = self._sock.recv(BUF_SIZE)
+        if not data:
+            self.close()
+            return True
+        self._buf += data
+        while len(self._buf) >= 4:
+            length = struct.unpack('>I', self._buf[:4])[0]
+            if len(self._buf) < length + 4:
+                break
+            msg = pickle.loads(self._buf[4:length + 4])
+            self._buf = self._buf[length + 4:]
+            try:
+                self._callback(msg)
+            except Exception as e:
+                shell.print_exception(e)
+        return True
+
+    def close(self):
+        if self._sock is None:
+            return
+        if self._loop:
+            self._loop.remove(self._sock)
+            self._loop = None
+        self._sock.close()
+        self._sock = None
+        if self._close_callback is not None:
+            self._close_callback(self)
+
+
+def fork_workers(count, target):
+    # fork `count` children running target(index, sock) and return a list
+    # of (pid, sock) for the master, children never return from here
+    workers = []
+    for i in range(count):
+        master_sock, worker_sock = socket.socketpair()
+        pid = os.fork()
+        if pid == 0:
+            master_sock.close()
+            for _, sock in workers:
+                sock.close()
+            code = 1
+            try:
+                target(i, worker_sock)
+                code = 0
+            except Exception as e:
+                shell.print_exception(e)
+            finally:
+                # never fall back into the master's code
+                os._exit(code)
+        worker_sock.close()
+        workers.append((pid, master_sock))
+    logging.info('started %d workers' % count)
+    return workers
+
+
+class TransferTable(object):
+    """Transfer counters keyed by port or user id, shared between processes.
+
+    The table is an anonymous shared mmap created before forking, so every
+    worker sees the same pages. Each worker only writes the region it
+    attached to, the readers sum all regions and never take a lock. The
+    writer keeps the sequence at the start of its region odd while it
+    changes a slot, a reader copies the region again until the sequence was
+    even and the same before and after, so it never sees half of a 64 bit
+    counter on 32 bit machines. The loop and the db thread of one process
+    both write its region and share a lock.
+    """
+
+    def __init__(self, regions, slots=TRANSFER_SLOTS):
+        self._regions = regions
+        self._slots = slots
+        self._region_size = SEQ.size + slots * SLOT.size
+        self._mem = mmap.mmap(-1, regions * self._region_size)
+        self._lock = threading.Lock()
+        self._base = 0
+        self._seq = 0
+        self._offsets = {}
+        self._full = False
+
+    def attach(self, region):
+        # called once in the forked worker that writes this region
+        self._base = region * self._region_size
+        self._seq = SEQ.unpack_from(self._mem, self._base)[0]
+        self._offsets = {}
+
+    def _write(self, offset, key, used, u, d):
+        self._seq = (self._seq + 1) & 0xffffffff
+        SEQ.pack_into(self._mem, self._base, self._seq)
+        SLOT.pack_into(self._mem, offset, key, used, u, d)
+        self._seq = (self._seq + 1) & 0xffffffff
+        SEQ.pack_into(self._mem, self._base, self._seq)
+
+    def _find(self, key):
+        # only keys missing from _offsets get here, they have no slot in our
+        # region yet, so the first free one will do
+        start = key % self._slots
+        for i in range(self._slots):
+            offset = self._base + SEQ.size + \
+                ((start + i) % self._slots) * SLOT.size
+            if not SLOT.unpack_from(self._mem, offset)[1]:
+                return offset
+        if not self._full:
+            self._full = True
+            logging.error('transfer table is full, transfer of new ports '
+                          'and users will not be counted')
+        return None
+
+    def add(self, key, u, d):
+        with self._lock:
+            offset = self._offsets.get(key)
+            if offset is None:
+                offset = self._find(key)
+                if offset is None:
+                    return
+                self._offsets[key] = offset
+            _, _, old_u, old_d = SLOT.unpack_from(self._mem, offset)
+            self._write(offset, key, 1, old_u + u, old_d + d)
+
+    def remove(self, key):
+        # a stopped port or removed user gives its slot back, if it comes
+        # back it counts from zero. Every process frees its own region
+        with self._lock:
+            offset = self._offsets.pop(key, None)
+            if offset is None:
+                return
+            self._write(offset, 0, 0, 0, 0)
+            self._full = False
+
+    def _read_region(self, region):
+        start = region * self._region_size
+        end = start + self._region_size
+        for i in range(SNAPSHOT_RETRIES):
+            data = self._mem[start:end]
+            seq = SEQ.unpack_from(data)[0]
+            if not seq & 1 and SEQ.unpack_from(self._mem, start)[0] == seq:
+                break
+        return data
+
+    def snapshot(self):
+        # {id: [u, d]} summed over all workers
+        ret = {}
+        for region in range(self._regions):
+            data = self._read_region(region)
+            for key, used, u, d in SLOT.iter_unpack(data[SEQ.size:]):
+                if not used:
+                    continue
+                if key not in ret:
+                    ret[key] = [0, 0]
+                ret[key][0] += u
+                ret[key][1] += d
+        return ret
+
+    def close(self):
+        self._mem.close()
+
+
+def test_channel():
+    got = []
+    a, b = socket.socketpair()
+    loop = eventloop.EventLoop()
+    channel = Channel(b, got.append, lambda c: loop.stop())
+    channel.add_to_loop(loop)
+    sender = Channel(a, None)
+    sender.send(('transfer', {1: [2, 3]}))
+    sender.send(('new_server', 8388, {'password': b'x' * 100000}))
+    a.close()
+    loop.run()
+    assert got[0] == ('transfer', {1: [2, 3]})
+    assert got[1][2]['password'] == b'x' * 100000
+
+
+def test_transfer_table():
+    table = TransferTable(2, slots=4)
+    table.add(8388, 10, 20)
+    table.add(8388, 1, 2)
+    pid = os.fork()
+    if pid == 0:
+        table.attach(1)
+        table.add(8388, 100, 200)
+        table.add(1000, 5, 6)
+        table.add(1004, 7, 8)
+        os._exit(0)
+    os.waitpid(pid, 0)
+    assert table.snapshot() == {8388: [111, 222], 1000: [5, 6], 1004: [7, 8]}
+    table.add(1000, -5, 0)
+    assert table.snapshot()[1000] == [0, 6]
+    for key in range(4):
+        table.add(key + 1, 1, 1)
+    assert 4 not in table.snapshot()
+    # a freed slot is taken by the next new key, the slots of 1000 in the
+    # other region stay
+    table.remove(1000)
+    table.add(4, 1, 1)
+    assert table.snapshot()[1000] == [5, 6]
+    assert table.snapshot()[4] == [1, 1]
+    table.add(1000, 1, 0)
+    assert table.snapshot()[1000] == [5, 6]
+    table.remove(4)
+    table.add(1000, 1, 0)
+    assert table.snapshot()[1000] == [6, 6]
+    table.close()
+
+
+def test_transfer_table_consistent():
+    # every value the writer leaves is a multiple of step, one torn between
+    # its two 32 bit halves would not be
+    step = (1 << 32) + 1
+    table = TransferTable(2, slots=4)
+    pid = os.fork()
+    if pid == 0:
+        table.attach(1)
+        for i in range(20000):
+            table.add(8388, step, step)
+        os._exit(0)
+    while True:
+        done = os.waitpid(pid, os.WNOHANG)[0]
+        u, d = table.snapshot().get(8388, [0, 0])
+        assert u % step == 0 and d % step == 0
+        if done:
+            break
+    assert table.snapshot()[8388] == [20000 * step, 20000 * step]
+    # a writer that died in the middle of a write doesn't hang the reader
+    SEQ.pack_into(table._mem, table._region_size, 1)
+    assert table.snapshot()[8388] == [20000 * step, 20000 * step]
+    table.close()
+
+
+if __name__ == '__main__':
+    test_channel()
+    test_transfer_table()
+    test_transfer_table_consistent()
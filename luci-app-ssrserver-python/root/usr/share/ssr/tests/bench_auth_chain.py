@@ -0,0 +1,91 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Decoding speed of the auth_chain protocols, in process with no sockets.
+#
+# A client instance frames the data, the server instance decodes it in reads
+# of the given size; then the server frames the reply and the client decodes
+# it. Large reads hold many frames, which is where the decoder's handling of
+# its receive buffer shows.
+#
+# usage: python tests/bench_auth_chain.py [MB] [read_size]
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../'))
+
+from shadowsocks import obfs, encrypt
+
+PROTOCOLS = ('auth_chain_a', 'auth_chain_b', 'auth_chain_c', 'auth_chain_d')
+
+
+def make_info(data, iv, key):
+    info = obfs.server_info(data)
+    info.host = '127.0.0.1'
+    info.port = 8388
+    info.users = {}
+    info.update_user_func = lambda uid: None
+    info.client = '127.0.0.1'
+    info.client_port = 12345
+    info.protocol_param = ''
+    info.obfs_param = ''
+    info.iv = iv
+    info.recv_iv = iv
+    info.key_str = b'bench'
+    info.key = key
+    info.head_len = 30
+    info.tcp_mss = 1460
+    info.buffer_size = 32768
+    info.overhead = 4
+    return info
+
+
+def decode_speed(encode, decode, data, read_size):
+    wire = encode(data)
+    start = time.time()
+    out = []
+    for i in range(0, len(wire), read_size):
+        out.append(decode(wire[i:i + read_size]))
+    used = time.time() - start
+    return out, len(data) / used / 1e6
+
+
+def bench(protocol, size, read_size):
+    iv = os.urandom(16)
+    key = encrypt.encrypt_key(b'bench', 'aes-128-cfb')
+    client = obfs.obfs(protocol)
+    client.set_server_info(make_info(client.init_data(), iv, key))
+    server = obfs.obfs(protocol)
+    server.set_server_info(make_info(server.init_data(), iv, key))
+    # the first packet carries the auth header
+    head = b'\x01\x7f\x00\x00\x01\x00\x50'
+    server.server_post_decrypt(client.client_pre_encrypt(head))
+
+    data = os.urandom(size)
+    out, up = decode_speed(client.client_pre_encrypt,
+                           lambda b: server.server_post_decrypt(b)[0],
+                           data, read_size)
+    assert b''.join(out) == data
+    out, down = decode_speed(server.server_pre_encrypt,
+                             client.client_post_decrypt, data, read_size)
+    assert b''.join(out) == data
+    return up, down
+
+
+def main():
+    size = int(float(sys.argv[1]) * 1024 * 1024) if len(sys.argv) > 1 \
+        else 8 * 1024 * 1024
+    read_size = int(sys.argv[2]) if len(sys.argv) > 2 else 65536
+    print('decode MB/s, %d byte reads' % read_size)
+    for protocol in PROTOCOLS:
+        print('  %-14s server %7.1f  client %7.1f' %
+              ((protocol,) + bench(protocol, size, read_size)))
+
+
+if __name__ == '__main__':
+    main()
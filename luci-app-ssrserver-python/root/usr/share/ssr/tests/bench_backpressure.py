@@ -0,0 +1,94 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Peak memory of the server while a client pushes data it can't pass on.
+#
+# The remote is a listener whose backlog is full, so the server stays in the
+# connecting stage while the client keeps sending. Without back-pressure the
+# server reads everything into its queue; with buffer_high_watermark it stops
+# reading the client and the data stays in the kernel buffers.
+#
+# usage: python tests/bench_backpressure.py [seconds] [high_watermark_kb]
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import os
+import sys
+import json
+import time
+import errno
+import socket
+import struct
+import tempfile
+import subprocess
+
+SERVER_PORT = 18410
+REMOTE_PORT = 18411
+
+
+def stalled_remote():
+    # never accepts, once the backlog is full a connect hangs
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', REMOTE_PORT))
+    sock.listen(0)
+    fillers = []
+    for i in range(4):
+        s = socket.socket()
+        s.setblocking(False)
+        s.connect_ex(('127.0.0.1', REMOTE_PORT))
+        fillers.append(s)
+    return [sock] + fillers
+
+
+def peak_rss(pid):
+    with open('/proc/%d/status' % pid) as f:
+        for line in f:
+            if line.startswith('VmHWM'):
+                return int(line.split()[1])
+    return 0
+
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+    config = {'server': '127.0.0.1', 'server_port': SERVER_PORT,
+              'password': 'bench', 'method': 'none', 'protocol': 'origin',
+              'obfs': 'plain', 'timeout': 120, 'forbidden_ip': ''}
+    if len(sys.argv) > 2:
+        config['buffer_high_watermark'] = int(sys.argv[2])
+    fd, path = tempfile.mkstemp(suffix='.json')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(config, f)
+    keep = stalled_remote()
+    server = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          '../shadowsocks/server.py')
+    p = subprocess.Popen([sys.executable, server, '-c', path, '-q', '-q'])
+    try:
+        time.sleep(1.5)
+        sock = socket.create_connection(('127.0.0.1', SERVER_PORT))
+        sock.sendall(b'\x01' + socket.inet_aton('127.0.0.1') +
+                     struct.pack('>H', REMOTE_PORT))
+        sock.setblocking(False)
+        chunk = b'x' * 65536
+        sent = 0
+        end = time.time() + seconds
+        while time.time() < end:
+            try:
+                sent += sock.send(chunk)
+            except (OSError, IOError) as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+                time.sleep(0.01)
+        print('client sent %.1f MB while connecting, server peak RSS %d KB' %
+              (sent / 1e6, peak_rss(p.pid)))
+        sock.close()
+    finally:
+        p.kill()
+        p.wait()
+        os.unlink(path)
+        for s in keep:
+            s.close()
+
+
+if __name__ == '__main__':
+    main()
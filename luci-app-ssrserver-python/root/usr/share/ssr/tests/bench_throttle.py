@@ -0,0 +1,167 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Latency of unthrottled connections while throttled ones saturate the loop.
+#
+# Two relays share one event loop: one with speed_limit_per_con, one without.
+# A blaster process keeps many connections on the limited relay busy in both
+# directions, the main process measures request/response round trips through
+# the unlimited relay and prints the percentiles.
+#
+# usage: python tests/bench_throttle.py [throttled_conns] [seconds]
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import os
+import sys
+import json
+import time
+import errno
+import socket
+import struct
+import selectors
+import tempfile
+import threading
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../'))
+
+from shadowsocks import shell, eventloop, tcprelay, asyncdns
+
+ECHO_PORT = 18400
+FREE_PORT = 18401
+LIMITED_PORT = 18402
+SPEED_LIMIT = 64  # KB/s per connection
+
+
+def header(port):
+    return b'\x01' + socket.inet_aton('127.0.0.1') + struct.pack('>H', port)
+
+
+def echo_server():
+    sock = socket.socket()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('127.0.0.1', ECHO_PORT))
+    sock.listen(1024)
+
+    def serve(conn):
+        conn.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
+        while True:
+            data = conn.recv(65536)
+            if not data:
+                break
+            conn.sendall(data)
+        conn.close()
+
+    def accept():
+        while True:
+            conn, _ = sock.accept()
+            t = threading.Thread(target=serve, args=(conn,))
+            t.daemon = True
+            t.start()
+
+    t = threading.Thread(target=accept)
+    t.daemon = True
+    t.start()
+
+
+def run_server():
+    fd, path = tempfile.mkstemp(suffix='.json')
+    with os.fdopen(fd, 'w') as f:
+        json.dump({'server': '127.0.0.1', 'server_port': FREE_PORT,
+                   'password': 'bench', 'method': 'none',
+                   'protocol': 'origin', 'obfs': 'plain', 'timeout': 60,
+                   'forbidden_ip': ''}, f)
+    sys.argv = [sys.argv[0], '-c', path, '-q', '-q']
+    config = shell.get_config(False)
+    os.unlink(path)
+    limited = config.copy()
+    limited['server_port'] = LIMITED_PORT
+    limited['speed_limit_per_con'] = SPEED_LIMIT
+
+    loop = eventloop.EventLoop()
+    dns_resolver = asyncdns.DNSResolver()
+    dns_resolver.add_to_loop(loop)
+    tcprelay.TCPRelay(config, dns_resolver, False).add_to_loop(loop)
+    tcprelay.TCPRelay(limited, dns_resolver, False).add_to_loop(loop)
+    loop.run()
+
+
+def run_blaster(conns):
+    sel = selectors.DefaultSelector()
+    chunk = os.urandom(16 * 1024)
+    for i in range(conns):
+        sock = socket.create_connection(('127.0.0.1', LIMITED_PORT))
+        sock.sendall(header(ECHO_PORT))
+        sock.setblocking(False)
+        sel.register(sock, selectors.EVENT_READ | selectors.EVENT_WRITE)
+    while True:
+        for key, mask in sel.select():
+            try:
+                if mask & selectors.EVENT_READ:
+                    if not key.fileobj.recv(65536):
+                        sel.unregister(key.fileobj)
+                        continue
+                if mask & selectors.EVENT_WRITE:
+                    key.fileobj.send(chunk)
+            except (OSError, IOError) as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+
+
+def measure(seconds):
+    sock = socket.create_connection(('127.0.0.1', FREE_PORT))
+    sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
+    sock.sendall(header(ECHO_PORT))
+    samples = []
+    msg = b'x' * 64
+    end = time.time() + seconds
+    while time.time() < end:
+        t = time.time()
+        sock.sendall(msg)
+        got = 0
+        while got < len(msg):
+            data = sock.recv(65536)
+            if not data:
+                raise Exception('connection closed')
+            got += len(data)
+        samples.append(time.time() - t)
+        time.sleep(0.005)
+    sock.close()
+    return sorted(samples)
+
+
+def main():
+    conns = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 10
+    echo_server()
+    me = os.path.abspath(__file__)
+    server = subprocess.Popen([sys.executable, me, '--server'])
+    time.sleep(1.5)
+    blaster = subprocess.Popen([sys.executable, me, '--blaster', str(conns)])
+    try:
+        time.sleep(2)
+        samples = measure(seconds)
+    finally:
+        blaster.kill()
+        server.kill()
+        blaster.wait()
+        server.wait()
+
+    def pct(p):
+        return samples[min(len(samples) - 1, int(len(samples) * p))] * 1000
+
+    print('%d throttled conns at %d KB/s, %d round trips' %
+          (conns, SPEED_LIMIT, len(samples)))
+    print('p50 %.2f ms  p99 %.2f ms  max %.2f ms' %
+          (pct(0.5), pct(0.99), samples[-1] * 1000))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--server':
+        run_server()
+    elif len(sys.argv) > 2 and sys.argv[1] == '--blaster':
+        run_blaster(int(sys.argv[2]))
+    else:
+        main()
@@ -0,0 +1,126 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# UDP packets per second, with a new cipher context per packet and with the
+# contexts kept in an encrypt.CipherPool.
+#
+# First the crypto the server does for one request/response pair, decrypt a
+# client datagram and encrypt the reply, in a loop for both paths. Then small
+# datagrams end to end through a server to a local UDP echo.
+#
+# usage: python tests/bench_udp.py [method] [seconds]
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import os
+import sys
+import json
+import time
+import socket
+import struct
+import tempfile
+import threading
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../'))
+
+from shadowsocks import encrypt
+
+SERVER_PORT = 18420
+ECHO_PORT = 18421
+PAYLOAD = b'x' * 64
+
+
+def header(port):
+    return b'\x01' + socket.inet_aton('127.0.0.1') + struct.pack('>H', port)
+
+
+def crypto_pps(method, seconds, pool):
+    key = encrypt.encrypt_key(b'bench', method)
+    request = encrypt.encrypt_all(b'bench', method, 1,
+                                  header(ECHO_PORT) + PAYLOAD)
+    reply = header(ECHO_PORT) + PAYLOAD
+    if pool is None:
+        encrypt_all_iv = encrypt.encrypt_all_iv
+    else:
+        encrypt_all_iv = pool.encrypt_all_iv
+    count = 0
+    end = time.time() + seconds
+    while time.time() < end:
+        for i in range(1000):
+            ref_iv = [0]
+            assert encrypt_all_iv(key, method, 0, request, ref_iv) == reply
+            ref_iv = [encrypt.encrypt_new_iv(method)]
+            encrypt_all_iv(key, method, 1, reply, ref_iv)
+        count += 1000
+    return count / seconds
+
+
+def echo_server():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', ECHO_PORT))
+
+    def serve():
+        while True:
+            data, addr = sock.recvfrom(65536)
+            sock.sendto(data, addr)
+
+    t = threading.Thread(target=serve)
+    t.daemon = True
+    t.start()
+
+
+def relay_pps(method, seconds):
+    # keeps 32 datagrams in flight, a lost one is replaced after a timeout
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(0.5)
+    request = header(ECHO_PORT) + PAYLOAD
+    server = ('127.0.0.1', SERVER_PORT)
+    for i in range(32):
+        sock.sendto(encrypt.encrypt_all(b'bench', method, 1, request), server)
+    count = 0
+    end = time.time() + seconds
+    while time.time() < end:
+        try:
+            data = sock.recv(65536)
+        except socket.timeout:
+            data = None
+        if data:
+            assert encrypt.encrypt_all(b'bench', method, 0, data) == request
+            count += 1
+        sock.sendto(encrypt.encrypt_all(b'bench', method, 1, request), server)
+    sock.close()
+    return count / seconds
+
+
+def main():
+    method = sys.argv[1] if len(sys.argv) > 1 else 'aes-256-cfb'
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 5
+    print('%s, crypto per request/response pair' % method)
+    print('  new context per packet %8d pps' %
+          crypto_pps(method, seconds, None))
+    print('  CipherPool             %8d pps' %
+          crypto_pps(method, seconds, encrypt.CipherPool()))
+
+    fd, path = tempfile.mkstemp(suffix='.json')
+    with os.fdopen(fd, 'w') as f:
+        json.dump({'server': '127.0.0.1', 'server_port': SERVER_PORT,
+                   'password': 'bench', 'method': method,
+                   'protocol': 'origin', 'obfs': 'plain', 'timeout': 60,
+                   'forbidden_ip': ''}, f)
+    echo_server()
+    server = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          '../shadowsocks/server.py')
+    p = subprocess.Popen([sys.executable, server, '-c', path, '-q', '-q'])
+    try:
+        time.sleep(1.5)
+        print('  through the server     %8d pps' % relay_pps(method, seconds))
+    finally:
+        p.kill()
+        p.wait()
+        os.unlink(path)
+
+
+if __name__ == '__main__':
+    main()
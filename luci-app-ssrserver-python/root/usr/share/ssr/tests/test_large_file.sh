@@ -1,14 +1,15 @@
 #!/bin/bash
 
-PYTHON="coverage run -p"
+PYTHON=${PYTHON:-"coverage run -p"}
 URL=http://127.0.0.1/file
+CONFIG=${1:-tests/aes.json}
 
 mkdir -p tmp
 
-$PYTHON shadowsocks/local.py -c tests/aes.json &
+$PYTHON shadowsocks/local.py -c $CONFIG &
 LOCAL=$!
 
-$PYTHON shadowsocks/server.py -c tests/aes.json --forbidden-ip "" &
+$PYTHON shadowsocks/server.py -c $CONFIG --forbidden-ip "" &
 SERVER=$!
 
 sleep 3